@@ -89,7 +89,11 @@ config_vars = {
     'geodesic_dll_path': os.path.abspath( \
             os.path.join(os.path.abspath(os.path.dirname(__file__)), \
             "toolbox", "lib", "geodesic", "geodesic.dll")),
-    'population_field':  'Pop'
+    'population_field':  'Pop',
+    'distance_tile_size': 512, # rows and columns per tile when computing
+                               # distance matrices; bounds memory use.
+    'distance_workers': 1 # worker processes used to compute distance
+                          # matrix tiles; 0 uses one per CPU core.
 }
 # have to update afterward so data_dir is set.
 config_vars['example_gdb'] = os.path.join(config_vars['data_dir'], 'example.gdb')
@@ -14,6 +14,7 @@ for path in [local_path, os.path.join(local_path, 'toolbox')]:
 # import local settings
 import config
 import utils
+from scripts import haplotype_table
 settings = config.settings()
 
 # get the paths for our toolboxes
@@ -269,6 +270,8 @@ class CompareEncounters(object):
                             pop = None
                         row[1] = pop
                         cur.updateRow(row)
+                # populations changed; recount haplotypes by them when next used.
+                haplotype_table.invalidate(layer.dataSource, field_name)
                             
             except Exception as e:
                 msg = "Error adding {} column.".format(field_name)
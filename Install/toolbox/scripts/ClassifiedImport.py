@@ -30,6 +30,15 @@ import sys
 # local imports
 import utils
 import config
+import append_import
+import column_groups
+import dates
+import feature_import
+import genotype_qc
+import haplotype_table
+import import_record
+import merge_import
+import table_import
 
 """
 Enable local imports; redirect config calls to general config
@@ -54,52 +63,36 @@ def add_install_path():
 add_install_path()
 settings = config.settings()
 
-def main(input_table=None, sr=None, output_loc=None,
-    output_gdb=None, output_fc=None, genetic=None,
-    identification=None, location=None, other=None,
-    mode='toolbox', protected_map=config.protected_columns):
-
-    # set mode based on how script is called.
-    settings.mode = mode
-
-    # First, create a geodatabase for all our future results.
-    # TODO: can we generate this from a single value?
-    gdb_path = os.path.abspath(os.path.join(output_loc, output_gdb + '.gdb'))
-
-    # if the user is calling this from the command-line, they won't have necessarily
-    # entered a full path for the FC output. Infer it from the input instead.
-    if output_fc.lower().find('gdb') == -1:
-        output_fc =  os.path.join(gdb_path, output_fc)
-
-    # check if we received a value spatial reference -- if not, use WGS84.
-    if sr in ('', None):
-        # default spatial reference can be redefined.
-        sr = config.sr
-
-    try:
-        # only try to create this GDB if it doesn't already exist.
-        if not os.path.exists(gdb_path):
-            # Process: Create File GDB
-            # SYNTAX: CreateFileGDB_management (out_folder_path, out_name, {out_version})
-            arcpy.CreateFileGDB_management(output_loc, output_gdb, "CURRENT")
-            utils.msg("File geodatabase successfully created: %s" % gdb_path)
-        else:
-            utils.msg("File geodatabase already exists, skipping creation.")
-    except Exception as e:
-        utils.msg("Error creating file geodatabase", mtype='error', exception=e)
-        sys.exit()
+def location_columns(location):
+    """ The (x, y) columns from the semicolon separated location columns."""
+    if location is None:
+        raise Exception("Required location columns not set.")
 
-    # TODO: WE NEED TO DO A FULL CLASSIFICATION OF THE INPUT AND MANUALLY BUILD UP THE LAYER...
-    # We'll have two columns per locus, need to import correctly
-
-    # Start things off by importing the table directly. We still need to edit the header
-    # because of ArcGIS' restrictions on table names.
+    # 'location', ArcGIS passes semicolon separated values
+    loc_parts = location.split(";")
 
-    # do we have a text-based file?
-    file_type = utils.file_type(input_table)
-    if file_type == 'Text':
-        # Generate a temporary copy of the input CSV which corrects it for
-        # ArcGIS, stripping invalid column label characters.
+    # TODO: ArcGIS doesn't preserve order; do we need separate fields for these? or some other approach?
+    if loc_parts[0].lower() in ['x', 'longitude', 'lon']:
+        (x, y) = loc_parts[:2]
+    else:
+        (y, x) = loc_parts[:2]
+    return (x, y)
+
+def import_with_tables(input_table, file_type, gdb_path, output_fc, x, y,
+    sr, protected_map):
+    """
+    Import through a geodatabase table: TableToTable, a calculated date
+    field, an XY event layer and CopyFeatures. Used with engine='table'.
+    Returns the temporary XY layer, to be deleted once the import is
+    complete.
+    """
+    # compressed text is streamed straight into the geodatabase in chunks,
+    # without writing out a decompressed copy.
+    is_compressed = utils.compression(input_table) is not None
+    if not is_compressed:
+        # Generate a temporary copy of the input CSV, or of the workbook's
+        # first sheet, which corrects it for ArcGIS, stripping invalid
+        # column label characters.
         data_table = utils.validate_table(input_table)
 
         # TODO: use field mapping to handle the date-time field?
@@ -112,15 +105,21 @@ def main(input_table=None, sr=None, output_loc=None,
         arcpy.env.overwriteOutput = settings.overwrite
 
         # generate table name based on input name
-        (label, ext) = os.path.splitext(os.path.basename(input_table))
+        (label, ext) = os.path.splitext(os.path.basename( \
+                utils.uncompressed_name(input_table)))
 
         # Validate label will produce a valid table name from our input file
         validated_label = arcpy.ValidateTableName(label)
 
-        # write out our filtered table to ArcGIS
-        arcpy.TableToTable_conversion(data_table, gdb_path, validated_label)
+        if is_compressed:
+            row_count = table_import.import_table(input_table, \
+                    os.path.join(gdb_path, validated_label), protected_map)
+            utils.msg("Read {} rows from compressed input.".format(row_count))
+        else:
+            # write out our filtered table to ArcGIS
+            arcpy.TableToTable_conversion(data_table, gdb_path, validated_label)
 
-        if file_type == 'Text':
+        if not is_compressed:
             # Delete the temporary table with validated names;
             # temp file is stored in the same spot as the original.
             temp_dir = os.path.dirname(input_table)
@@ -141,43 +140,34 @@ def main(input_table=None, sr=None, output_loc=None,
         # TODO: make date field defined elsewhere.
         input_time_field = "Date_Time"
         field_name = 'Date_formatted'
-        expression = 'formatDate(!{input_time_field}!)'.format(
-            input_time_field=input_time_field)
-        code_block = """
-import dateutil.parser
-def formatDate(input_date):
-    parsed_date = dateutil.parser.parse(input_date)
-    return parsed_date.strftime("%m/%d/%Y %H:%M:%S")"""
         # check if a formatted date field exists; if so skip this step
         if field_name.lower() not in fields:
             arcpy.AddField_management(input_csv, field_name, 'DATE')
-            arcpy.CalculateField_management(input_csv, field_name, expression, "PYTHON_9.3", code_block)
+            # parse the whole column at once, rather than row by row.
+            with arcpy.da.SearchCursor(input_csv, [input_time_field]) as cursor:
+                values = numpy.array([row[0] or '' for row in cursor])
+            (parsed, failed) = dates.parse_dates(values)
+            # report dates we couldn't read, but keep importing.
+            failures = dates.describe_failures(values, failed & (values != ''))
+            if failures is not None:
+                utils.msg(failures, mtype='warning')
+            lookup = dict(zip(values.tolist(), \
+                    [None if bad else date for (date, bad) in \
+                    zip(parsed.tolist(), failed.tolist())]))
+            with arcpy.da.UpdateCursor(input_csv, [input_time_field, field_name]) as cursor:
+                for row in cursor:
+                    cursor.updateRow([row[0], lookup.get(row[0] or '')])
             utils.msg("Added a formatted date field: {field_name}.".format(field_name=field_name))
     except Exception as e:
         utils.msg("Error parsing date information", mtype='error', exception=e)
         sys.exit()
 
-    # coordinate columns
-    x = y = None
-
     # Convert the table to a temporary spatial feature
     try:
-        if location is None:
-            raise Exception("Required location columns not set.")
-
         # A temporary XY Layer needed to create the feature class.
         # NOTE: This table is deleted when the script finishes
         temporary_layer = input_csv + '_xy_temp'
 
-        # 'location', ArcGIS passes semicolon separated values
-        loc_parts = location.split(";")
-
-        # TODO: ArcGIS doesn't preserve order; do we need separate fields for these? or some other approach?
-        if loc_parts[0].lower() in ['x', 'longitude', 'lon']:
-            (x, y) = loc_parts[:2]
-        else:
-            (y, x) = loc_parts[:2]
-
         # Process: Make XY Event Layer.  This layer is temporary and will be
         # deleted upon script completion.
         # SYNTAX: arcpy.MakeXYEventLayer_management(table, in_x_field,
@@ -204,34 +194,14 @@ def formatDate(input_date):
         utils.msg("Error copying features to a feature class", mtype='error', exception=e)
         sys.exit()
 
-    utils.msg("Feature Class successfully created, your SRGD file has been imported!")
+    return temporary_layer
 
-    try:
-        haplotype_table = os.path.join(gdb_path, "{}_{}".format(validated_label, 'Haplotypes'))
-
-        # look up our haplotype data
-        haplotypes = utils.Haplotype(output_fc)
-        
-        # create a dictionary for inserting records
-        dts = {'names': ('code', 'haplotype', 'count'),
-                       'formats': (numpy.uint16, 'S6', numpy.uint8)}
-
-        # create a numpy formatted structure from this data
-        array = numpy.rec.fromrecords(haplotypes.indexed, dtype=dts)
-
-        # output the new table
-        arcpy.da.NumPyArrayToTable(array, haplotype_table)
-        
-        utils.msg("Haplotype table created: \n {}".format(haplotype_table))
-
-    except Exception as e:
-        utils.msg("Error creating supplemental haplotype table", mtype='error', exception=e)
-        sys.exit()
-
-
-
-    # Because we can't pass around objects between this process and the calling
-    # addin environment, dump out the settings to our shared configuration file.
+def update_config(output_fc, x, y, genetic, identification, location, other):
+    """
+    Because we can't pass around objects between this process and the
+    calling addin environment, dump out the settings to our shared
+    configuration file.
+    """
     try:
         config.update('fc_path', output_fc.strip())
         config.update('x_coord', x)
@@ -266,9 +236,197 @@ def formatDate(input_date):
         utils.msg(msg, mtype='error', exception=e)
         sys.exit()
 
+def main(input_table=None, sr=None, output_loc=None,
+    output_gdb=None, output_fc=None, genetic=None,
+    identification=None, location=None, other=None,
+    mode='toolbox', protected_map=config.protected_columns,
+    engine='numpy', append=False):
+
+    # set mode based on how script is called.
+    settings.mode = mode
+
+    # First, create a geodatabase for all our future results.
+    # TODO: can we generate this from a single value?
+    gdb_path = os.path.abspath(os.path.join(output_loc, output_gdb + '.gdb'))
+
+    # if the user is calling this from the command-line, they won't have necessarily
+    # entered a full path for the FC output. Infer it from the input instead.
+    if output_fc.lower().find('gdb') == -1:
+        output_fc =  os.path.join(gdb_path, output_fc)
+
+    # check if we received a value spatial reference -- if not, use WGS84.
+    if sr in ('', None):
+        # default spatial reference can be redefined.
+        sr = config.sr
+
+    try:
+        # only try to create this GDB if it doesn't already exist.
+        if not os.path.exists(gdb_path):
+            # Process: Create File GDB
+            # SYNTAX: CreateFileGDB_management (out_folder_path, out_name, {out_version})
+            arcpy.CreateFileGDB_management(output_loc, output_gdb, "CURRENT")
+            utils.msg("File geodatabase successfully created: %s" % gdb_path)
+        else:
+            utils.msg("File geodatabase already exists, skipping creation.")
+    except Exception as e:
+        utils.msg("Error creating file geodatabase", mtype='error', exception=e)
+        sys.exit()
+
+    # TODO: WE NEED TO DO A FULL CLASSIFICATION OF THE INPUT AND MANUALLY BUILD UP THE LAYER...
+    # We'll have two columns per locus, need to import correctly
+
+    # Start things off by importing the table directly. We still need to edit the header
+    # because of ArcGIS' restrictions on table names.
+
+    # several files, given as a list, separated by semicolons or matched by
+    # a glob pattern, are merged into a single feature class.
+    input_files = merge_import.input_files(input_table)
+    merging = len(input_files) > 1
+    if len(input_files) == 1:
+        input_table = input_files[0]
+    elif not input_files:
+        utils.msg("No input files match %s" % input_table, mtype='error')
+        sys.exit()
+
+    # do we have a text-based file?
+    try:
+        file_type = utils.file_type(input_files[0])
+        for input_file in input_files[1:]:
+            utils.file_type(input_file)
+    except utils.UnknownType as e:
+        utils.msg("Unable to import this type of file", mtype='error', exception=e)
+        sys.exit()
+
+    if not merging:
+        # type the columns we weren't given types for from a scan of the
+        # whole file; the toolbox dialog only reads the header.
+        try:
+            protected_map = column_groups.import_types(input_table, \
+                    protected_map)
+        except Exception as e:
+            utils.msg("Error reading column types", mtype='error', exception=e)
+            sys.exit()
+
+    # coordinate columns
+    try:
+        (x, y) = location_columns(location)
+    except Exception as e:
+        utils.msg("Error reading location columns", mtype='error', exception=e)
+        sys.exit()
+
+    if append and arcpy.Exists(output_fc):
+        # only write the rows which are new or changed since the last import.
+        try:
+            if merging:
+                raise Exception("Only a single file can be appended.")
+            (inserted, updated) = append_import.append_features(input_table, \
+                    output_fc, x, y)
+            utils.msg("Appended {} new and {} changed rows to {}".format( \
+                    inserted, updated, output_fc))
+        except Exception as e:
+            utils.msg("Error appending %s" % input_table, mtype='error', exception=e)
+            sys.exit()
+        update_config(output_fc, x, y, genetic, identification, location, other)
+        return
+
+    # skip the import if these files were already imported the same way.
+    try:
+        signature = import_record.signature(input_files, sr, protected_map, \
+                {'genetic': genetic, 'identification': identification, \
+                'location': location, 'other': other})
+        if import_record.is_current(output_fc, signature):
+            utils.msg("Input is unchanged since it was imported to %s, " \
+                    "skipping import." % output_fc)
+            update_config(output_fc, x, y, genetic, identification, \
+                    location, other)
+            return
+        import_record.clear(output_fc)
+    except Exception as e:
+        utils.msg("Error checking for an earlier import", mtype='error', exception=e)
+        sys.exit()
+
+    # genotypes are checked as they're imported, and reported next to the
+    # geodatabase.
+    id_fields = identification.split(";") if identification else []
+    id_field = id_fields[0] if id_fields else None
+    temporary_layer = None
+    # hashes of each row by key, when they're found on the way.
+    hashes = None
+    if merging:
+        try:
+            arcpy.env.overwriteOutput = True
+            (count, conflicts) = merge_import.import_merged(input_files, \
+                    output_fc, x, y, sr, protected_map, id_fields)
+            utils.msg("Merged {} features from {} files: \n {}".format( \
+                    count, len(input_files), output_fc))
+        except Exception as e:
+            utils.msg("Error merging input files", mtype='error', exception=e)
+            sys.exit()
+    elif engine == 'numpy':
+        # parse the file straight into arrays, and write out the features a
+        # chunk at a time.
+        try:
+            # for this step, overwrite any existing results
+            arcpy.env.overwriteOutput = True
+            if feature_import.fits_in_memory(input_table):
+                (header, columns) = feature_import.read_columns(input_table)
+                genotype_qc.check_genotypes(header, columns, output_fc, \
+                        id_field)
+                feature_import.import_columns(header, columns, \
+                        output_fc, x, y, sr, protected_map)
+                hashes = append_import.column_hashes(header, columns) or {}
+            else:
+                # compressed and large files are streamed from disk instead.
+                genotype_qc.check_file(input_table, output_fc, id_field)
+                hashes = {}
+                feature_import.import_features(input_table, output_fc, x, y, \
+                        sr, protected_map, append_import.hashed_chunks( \
+                        feature_import.read_chunks(input_table), hashes))
+            utils.msg("Features succesfully created: \n %s" % output_fc)
+        except Exception as e:
+            utils.msg("Error importing %s as features" % input_table, mtype='error', exception=e)
+            sys.exit()
+    else:
+        try:
+            genotype_qc.check_file(input_table, output_fc, id_field)
+        except Exception as e:
+            utils.msg("Unable to check genotypes: {0}".format(e), \
+                    mtype='warning')
+        temporary_layer = import_with_tables(input_table, file_type, \
+                gdb_path, output_fc, x, y, sr, protected_map)
+
+    utils.msg("Feature Class successfully created, your SRGD file has been imported!")
+
+    try:
+        # drop counts left by an earlier import to the same feature class;
+        # looking up our haplotype data counts it into a fresh table, which
+        # tools read from rather than scanning the features.
+        haplotype_table.invalidate(output_fc)
+        haplotypes = utils.Haplotype(output_fc)
+        table_path = haplotype_table.table_path(output_fc)
+        if haplotypes.defined and table_path is not None:
+            utils.msg("Haplotype table created: \n {}".format(table_path))
+
+    except Exception as e:
+        utils.msg("Error creating supplemental haplotype table", mtype='error', exception=e)
+        sys.exit()
+
+    try:
+        import_record.write_record(output_fc, signature)
+        # hash each row, so later appends only write what's changed.
+        if hashes is None and not merging:
+            hashes = append_import.table_hashes(input_table)
+        import_record.write_row_hashes(output_fc, hashes or {})
+    except Exception as e:
+        utils.msg("Error recording import", mtype='error', exception=e)
+        sys.exit()
+
+    update_config(output_fc, x, y, genetic, identification, location, other)
+
     # clean up: remove intermediate steps.
     try:
-        arcpy.Delete_management(temporary_layer)
+        if temporary_layer is not None:
+            arcpy.Delete_management(temporary_layer)
     except Exception as e:
         utils.msg("Unable to delete temporary layer", mtype='error', exception=e)
         sys.exit()
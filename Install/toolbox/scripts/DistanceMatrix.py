@@ -10,15 +10,27 @@ import arcpy
 import os
 import sys
 import ctypes
+import numpy
 from collections import OrderedDict
 
 # local imports
 import utils
 import config
+import cost_distance
+import geodesy
+import matrix_store
+import matrix_writer
+from matrix_store import MatrixStore, CondensedStore
+from spatial_index import SphericalIndex
 settings = config.settings()
 
+# matrix types which only the NumPy engines can produce.
+numpy_matrix_types = ('condensed', 'sparse', 'triplets')
+
 def main(input_fc=None, dist_unit="Kilometers", matrix_type="Square", \
-        output_matrix=None, force_cpp=False, mode=settings.mode):
+        output_matrix=None, force_cpp=False, engine=None, precision='float64', \
+        max_distance=None, cost_raster=None, order_by=None, compress=False, \
+        mode=settings.mode):
    
     # does the input fc exist?
     if not arcpy.Exists(input_fc):
@@ -38,11 +50,75 @@ def main(input_fc=None, dist_unit="Kilometers", matrix_type="Square", \
     else:
         is_spagedi = False
 
+    # text outputs can be gzip compressed as they're written.
+    if compress in ('true', True) and \
+            matrix_type not in ('condensed', 'sparse') and \
+            not matrix_writer.is_compressed(output_matrix):
+        output_matrix = "{0}.gz".format(output_matrix)
+
+    # sparse matrices only keep pairs closer than a maximum distance,
+    # given in the output units.
+    if matrix_type in ('sparse', 'triplets'):
+        if max_distance in (None, ''):
+            utils.msg("Sparse matrices require a maximum distance.", \
+                    mtype='error')
+            sys.exit()
+        max_distance = float(max_distance)
+
+    # least-cost distances over a raster replace the geodesic engines.
+    if cost_raster in ('', None):
+        cost_raster = None
+    elif matrix_type in ('sparse', 'triplets'):
+        utils.msg("Sparse matrices can't be computed over a cost raster.", \
+                mtype='error')
+        sys.exit()
+    elif not arcpy.Exists(cost_raster):
+        utils.msg("Cost raster, %s, doesn't exist." % cost_raster, \
+                mtype='error')
+        sys.exit()
+
+    # with a population field, distances are between population centroids
+    # rather than individual points; only the NumPy engines support this.
+    if order_by in ('', None):
+        order_by = None
+    elif cost_raster is not None:
+        utils.msg("Population distances can't be computed over a cost " \
+                "raster.", mtype='error')
+        sys.exit()
+    else:
+        engine = 'numpy'
+        force_cpp = False
+
     # yes, all this mucking about is necessary to get a row count
     row_count = int(arcpy.GetCount_management(input_fc).getOutput(0))
  
-    geodesic_cpp_fn = load_geodesic_dll()
-    if geodesic_cpp_fn is not None and row_count > 200 or force_cpp:
+    # pick an engine: the ArcObjects DLL for large inputs where it's
+    # available, otherwise the NumPy engine, which runs everywhere.
+    if force_cpp:
+        engine = 'cpp'
+    geodesic_cpp_fn = None
+    # the DLL writes plain text output itself.
+    if engine in (None, 'cpp') and matrix_type not in numpy_matrix_types \
+            and cost_raster is None and \
+            not matrix_writer.is_compressed(output_matrix):
+        geodesic_cpp_fn = load_geodesic_dll()
+
+    if cost_raster is not None:
+        if matrix_type == 'condensed':
+            output_matrix = utils.add_file_extension(output_matrix, 'npy')
+        run_cost_distance(input_fc, cost_raster, unit_factor, output_matrix, \
+                row_count, is_spagedi, matrix_type == 'condensed', precision)
+    elif matrix_type in ('sparse', 'triplets'):
+        if matrix_type == 'sparse':
+            output_matrix = utils.add_file_extension(output_matrix, 'npz')
+        run_geodesic_sparse(input_fc, unit_factor, output_matrix, \
+                max_distance, matrix_type == 'triplets', order_by)
+    elif matrix_type == 'condensed':
+        # only the NumPy engine writes the binary condensed format.
+        output_matrix = utils.add_file_extension(output_matrix, 'npy')
+        run_geodesic_condensed(input_fc, unit_factor, output_matrix, \
+                precision, order_by=order_by)
+    elif geodesic_cpp_fn is not None and (row_count > 200 or engine == 'cpp'):
         desc = arcpy.Describe(input_fc)
         # To run this, we need the full path to the input, not just the 
         # short one handed to us.
@@ -57,8 +133,14 @@ def main(input_fc=None, dist_unit="Kilometers", matrix_type="Square", \
         elif returncode == -2:
             utils.msg("Cannot open the input file.", mtype='error')
         elif returncode == -3:
-            utils.msg("The input matrix is too large! consider" + \
-                    "subsetting your results.", mtype='error')
+            # the DLL holds the full matrix in memory; hand over to the
+            # tiled engine, which works from disk instead.
+            utils.msg("The input matrix is too large for the high-" + \
+                    "performance module, using the tiled engine.", \
+                    mtype='warning')
+            run_geodesic_numpy(input_fc, unit_factor, output_matrix, \
+                    row_count, is_spagedi)
+            returncode = 0
         elif returncode == -3:
             utils.msg("This tool requires point features as input.", \
                     mtype='error')
@@ -70,9 +152,12 @@ def main(input_fc=None, dist_unit="Kilometers", matrix_type="Square", \
         
         if returncode != 0:
             sys.exit()
-    else:
+    elif engine == 'gp':
         run_geodesic_gp(input_fc, unit_factor, output_matrix, \
                 row_count, is_spagedi)
+    else:
+        run_geodesic_numpy(input_fc, unit_factor, output_matrix, \
+                row_count, is_spagedi, order_by=order_by)
 
     utils.msg("Created distance matrix successfully: {0}".format(output_matrix))
 
@@ -84,16 +169,302 @@ def load_geodesic_dll():
         try:
             loaded_dll = ctypes.cdll.LoadLibrary(dll_path)
         except Exception as e:
-            msg = "Failed to load high-speed geodesic library."
-            utils.msg(msg, mtype='error', exception=e)
+            msg = "Failed to load high-speed geodesic library, " + \
+                    "using the NumPy engine: {}".format(e)
+            utils.msg(msg, mtype='warning')
             return None
         fn = loaded_dll.CalculatePairwiseGeodesicDistances
         fn.argtypes = [ctypes.c_wchar_p, ctypes.c_wchar_p, ctypes.c_double, ctypes.c_bool]
         fn.restype = ctypes.c_int
     else:
         msg = "Unable to locate high-speed geodesic DLL at: {}".format(dll_path)
+        utils.msg(msg, mtype='warning')
+    return fn
+
+def read_points(input_fc, sr):
+    """ OIDs and geographic (lat, lon) coordinates of the input points."""
+    # distances are computed on the ellipsoid, so projected data is read
+    # back in its underlying geographic coordinate system.
+    gcs = sr
+    if sr.type == 'Projected':
+        gcs = sr.GCS
+    points = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            ['OID@', 'SHAPE@Y', 'SHAPE@X'], spatial_reference=gcs)
+    return (points['OID@'], points['SHAPE@Y'], points['SHAPE@X'])
+
+def read_populations(input_fc, sr, order_by):
+    """ Population labels and geographic (lat, lon) centroids of the
+        populations in order_by, and the number of points in each."""
+    gcs = sr
+    if sr.type == 'Projected':
+        gcs = sr.GCS
+    points = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            [order_by, 'SHAPE@Y', 'SHAPE@X'], spatial_reference=gcs, \
+            skip_nulls=True)
+    skipped = int(arcpy.GetCount_management(input_fc).getOutput(0)) - \
+            len(points)
+    if skipped:
+        utils.msg("Skipped {0} points with no {1} value.".format(skipped, \
+                order_by), mtype='warning')
+
+    # only label each distinct value once, with the same population labels
+    # as the exporters write. Values which differ only by their spaces end
+    # up with the same label, and so in the same population.
+    (values, value_index) = numpy.unique(points[order_by], \
+            return_inverse=True)
+    names = [unicode(v).replace(u" ", u"_").encode('utf-8') for v in values]
+    (names, name_index) = numpy.unique(names, return_inverse=True)
+    (groups, lats, lons, counts) = geodesy.group_centroids( \
+            points['SHAPE@Y'], points['SHAPE@X'], name_index[value_index])
+    return (names[groups], lats, lons, counts)
+
+def input_points(input_fc, order_by=None):
+    """ OIDs, coordinates and ellipsoid of the input, for the NumPy engines.
+        With a population field, the population labels and centroids are
+        returned in place of the individual points."""
+    desc = arcpy.Describe(input_fc)
+    sr = desc.spatialReference
+    if sr.type not in ['Geographic', 'Projected']:
+        msg = "This tools only works with geographic or projected data."
         utils.msg(msg, mtype='error')
-    return fn                
+        sys.exit()
+
+    utils.msg("Finding all input points...")
+    if order_by is None:
+        (oids, lats, lons) = read_points(input_fc, sr)
+    else:
+        (oids, lats, lons, counts) = read_populations(input_fc, sr, order_by)
+        utils.msg("Found {0} populations among {1} points.".format( \
+                len(oids), counts.sum()))
+    (a, f) = geodesy.ellipsoid(sr)
+    return (oids, lats, lons, a, f)
+
+def distinct_locations(lats, lons):
+    """ The distinct locations among the input points, and the position of
+        each point's location among them."""
+    # samples often share coordinates (e.g. multiple biopsies from one
+    # encounter); only compute each distinct pair of locations once.
+    (location_lats, location_lons, inverse) = \
+            geodesy.unique_locations(lats, lons)
+    utils.msg("Found {0} distinct locations among {1} points.".format(
+            len(location_lats), len(lats)))
+    return (location_lats, location_lons, inverse)
+
+def temporary_store(store_type, output_dir, count):
+    """ A temporary store for the distances between count locations."""
+    # keep the backing store next to the output; it's the same size as the
+    # final matrix, so it belongs wherever there is room for the result.
+    try:
+        return store_type.temporary(output_dir, count)
+    except Exception as e:
+        msg = "Unable to create the distance matrix backing store."
+        utils.msg(msg, mtype='error', exception=e)
+        sys.exit()
+
+def fill_store(store, lats, lons, a, f, unit_factor, tile_size):
+    """ Compute the distances between the given points into store. The
+        store's files are removed if the distances can't be computed."""
+    progress = Progress()
+    try:
+        utils.msg("Computing distances...")
+        # distance, always returned in meters, scale by our
+        # expected result units.
+        store.fill(lats, lons, a, f, unit_factor, tile_size, \
+                progress.update, utils.worker_count())
+        utils.msg("Distance matrix calculations complete.")
+    except Exception as e:
+        store.close(delete=True)
+        utils.msg("Error creating distance matrix.", mtype='error', exception=e)
+        sys.exit()
+
+def compute_locations(lats, lons, a, f, unit_factor, output_dir, tile_size):
+    """ Distances between the distinct locations among the input points,
+        in a temporary memory-mapped store. Also returns the position of
+        each point's location within the store."""
+    (location_lats, location_lons, inverse) = distinct_locations(lats, lons)
+    store = temporary_store(MatrixStore, output_dir, len(location_lats))
+    fill_store(store, location_lats, location_lons, a, f, unit_factor, \
+            tile_size)
+    return (store, inverse)
+
+def run_geodesic_numpy(input_fc, unit_factor, output_matrix, row_count, \
+        is_spagedi, tile_size=None, order_by=None):
+    """ Compute the matrix tile by tile into a memory-mapped store with the
+        vectorized ellipsoidal distance kernel in geodesy.py, then stream
+        it out to the requested format."""
+    if tile_size is None:
+        tile_size = int(settings.distance_tile_size)
+
+    (oids, lats, lons, a, f) = input_points(input_fc, order_by)
+    output_dir = os.path.dirname(os.path.abspath(output_matrix))
+    (store, inverse) = compute_locations(lats, lons, a, f, unit_factor, \
+            output_dir, tile_size)
+
+    try:
+        utils.msg("Writing results to disk...")
+        write_square(store, oids, output_matrix, is_spagedi, inverse)
+    except Exception as e:
+        utils.msg("Error creating distance matrix.", mtype='error', exception=e)
+        sys.exit()
+    finally:
+        store.close(delete=True)
+
+def run_geodesic_condensed(input_fc, unit_factor, output_matrix, \
+        precision='float64', tile_size=None, order_by=None):
+    """ Compute only the upper triangle of the matrix, written as binary
+        values to a .npy file with a sidecar index of OIDs. Load the result
+        with matrix_store.load_condensed."""
+    if tile_size is None:
+        tile_size = int(settings.distance_tile_size)
+
+    (oids, lats, lons, a, f) = input_points(input_fc, order_by)
+    output_dir = os.path.dirname(os.path.abspath(output_matrix))
+    (location_lats, location_lons, inverse) = distinct_locations(lats, lons)
+
+    try:
+        output = CondensedStore(output_matrix, oids, precision)
+    except Exception as e:
+        msg = "Unable to create the output matrix."
+        utils.msg(msg, mtype='error', exception=e)
+        sys.exit()
+
+    if len(location_lats) == len(lats):
+        # every point is a distinct location; write tiles straight out.
+        fill_store(output, lats, lons, a, f, unit_factor, tile_size)
+        output.close()
+        return
+
+    # distances between locations are kept condensed too, and only
+    # expanded out to the points which share a location.
+    store = temporary_store(CondensedStore, output_dir, len(location_lats))
+    fill_store(store, location_lats, location_lons, a, f, unit_factor, \
+            tile_size)
+    try:
+        utils.msg("Writing results to disk...")
+        output.expand(store, inverse)
+    except Exception as e:
+        utils.msg("Error creating distance matrix.", mtype='error', exception=e)
+        sys.exit()
+    finally:
+        output.close()
+        store.close(delete=True)
+
+def run_geodesic_sparse(input_fc, unit_factor, output_matrix, max_distance, \
+        as_text=False, order_by=None):
+    """ Compute only the pairs within max_distance (in output units) of
+        each other, and write them as COO triplets to a .npz file, or as
+        text with one pair per line."""
+    (oids, lats, lons, a, f) = input_points(input_fc, order_by)
+
+    try:
+        utils.msg("Computing distances...")
+        index = SphericalIndex(lats, lons, a, f)
+        # the index works in meters.
+        (rows, cols, dists) = index.pairs_within(max_distance / unit_factor)
+        dists = dists * unit_factor
+        utils.msg("Found {0} pairs within {1}.".format(len(rows), \
+                max_distance))
+
+        utils.msg("Writing results to disk...")
+        if as_text:
+            with matrix_writer.open_output(output_matrix) as csv:
+                csv.write("Source_ID,Dest_ID,Distance\n")
+                for (i, j, dist) in zip(oids[rows].tolist(), \
+                        oids[cols].tolist(), dists.tolist()):
+                    csv.write("{0},{1},{2}\n".format(i, j, utils.xstr(dist)))
+        else:
+            matrix_store.save_sparse(output_matrix, oids, rows, cols, dists)
+    except Exception as e:
+        utils.msg("Error creating distance matrix.", mtype='error', exception=e)
+        sys.exit()
+
+def run_cost_distance(input_fc, cost_raster, unit_factor, output_matrix, \
+        row_count, is_spagedi, condensed=False, precision='float64'):
+    """ Least-cost distances over a cost raster, see cost_distance.py. One
+        search runs from each distinct raster cell holding input points,
+        finding its distance to all the others at once."""
+    try:
+        utils.msg("Reading cost raster...")
+        surface = cost_distance.CostSurface.from_raster(cost_raster)
+    except Exception as e:
+        utils.msg("Unable to read the cost raster.", mtype='error', exception=e)
+        sys.exit()
+
+    utils.msg("Finding all input points...")
+    points = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            ['OID@', 'SHAPE@X', 'SHAPE@Y'], \
+            spatial_reference=surface.spatial_reference)
+    oids = points['OID@']
+    (nodes, moved) = surface.locate(points['SHAPE@X'], points['SHAPE@Y'])
+    if moved.any():
+        utils.msg("{0} points fall on impassable cells, and were moved to " \
+                "the nearest passable cell.".format(moved.sum()), \
+                mtype='warning')
+    (cells, inverse) = numpy.unique(nodes, return_inverse=True)
+    utils.msg("Found {0} distinct cells among {1} points.".format(
+            len(cells), len(nodes)))
+
+    output_dir = os.path.dirname(os.path.abspath(output_matrix))
+    try:
+        store = MatrixStore.temporary(output_dir, len(cells))
+    except Exception as e:
+        msg = "Unable to create the distance matrix backing store."
+        utils.msg(msg, mtype='error', exception=e)
+        sys.exit()
+
+    progress = Progress()
+    try:
+        utils.msg("Computing distances...")
+        unreachable = 0
+        for (i, row, paths) in cost_distance.search_rows(surface, cells, \
+                cells, workers=utils.worker_count(), \
+                progress=progress.update):
+            store.matrix[i] = row * unit_factor
+            unreachable += numpy.isinf(row).sum()
+        store.flush()
+        if unreachable:
+            utils.msg("{0} pairs of cells aren't connected over the cost " \
+                    "raster; their distances are infinite.".format( \
+                    unreachable), mtype='warning')
+        utils.msg("Distance matrix calculations complete.")
+
+        utils.msg("Writing results to disk...")
+        if condensed:
+            output = CondensedStore(output_matrix, oids, precision)
+            try:
+                output.expand(store, inverse)
+            finally:
+                output.close()
+        else:
+            write_square(store, oids, output_matrix, is_spagedi, inverse)
+    except Exception as e:
+        utils.msg("Error creating distance matrix.", mtype='error', exception=e)
+        sys.exit()
+    finally:
+        store.close(delete=True)
+
+class Progress(object):
+    """ Report percentage progress, once per whole percent."""
+    def __init__(self):
+        self.indicator = 0
+
+    def update(self, done, total):
+        pct_progress = int(done / float(total) * 100)
+        if pct_progress > self.indicator:
+            self.indicator = pct_progress
+            utils.msg("{0}%".format(self.indicator))
+
+def write_square(store, oids, output_matrix, is_spagedi, inverse=None):
+    """ Stream a square matrix out of the store, one row at a time. When
+        the store holds distinct locations, inverse maps each point to its
+        location, and rows are expanded back out to every point."""
+    with matrix_writer.MatrixWriter(output_matrix, oids, is_spagedi) as writer:
+        for (i, fid) in enumerate(oids):
+            if inverse is None:
+                row = store.matrix[i]
+            else:
+                row = store.matrix[inverse[i]][inverse]
+            writer.write_row(fid, row.tolist())
 
 def run_geodesic_gp(input_fc, unit_factor, output_matrix, row_count, is_spagedi):
     input_fc_mem = 'in_memory/input_fc'
@@ -159,25 +530,10 @@ def run_geodesic_gp(input_fc, unit_factor, output_matrix, row_count, is_spagedi)
     try:
         # copy the final result back to disk.
         utils.msg("Writing results to disk...")
-        # The SPAGeDi matrix format are described in section 3.7 of the manual.
-        if is_spagedi:
-            first_header_cell = "M%i" % row_count
-            sep = "\t"
-        else:
-            first_header_cell = ""
-            sep = ","
-
-        with open(output_matrix, 'w') as csv:
-            # initialize with our header row 
-            output_rows = [[first_header_cell] + \
-                    [str(s) for s in distance_matrix.keys()]]
+        with matrix_writer.MatrixWriter(output_matrix, \
+                distance_matrix.keys(), is_spagedi) as writer:
             for (fid, row) in distance_matrix.items():
-                res = [str(fid)] + [utils.xstr(s) for s in row.values()]
-                output_rows.append(res)
-            for row in output_rows:
-                csv.write("{0}\n".format(sep.join(row)))
-            if is_spagedi:
-                csv.write("END\n")
+                writer.write_row(fid, row.values())
 
     except Exception as e:
         utils.msg("Error creating distance matrix.", mtype='error', exception=e)
@@ -15,6 +15,7 @@ from datetime import datetime
 # local imports
 import utils
 import config
+import genotype
 settings = config.settings()
 
 def main(input_features=None, id_field=None, where_clause=None, output_coords=None, 
@@ -49,37 +50,19 @@ Coordinates are in {sr_name}, a {sr_type} coordinate system.""".format(
         loc_a = settings.x_coord
         loc_b = settings.y_coord
    
-    selected_columns = [id_field, loc_a, loc_b] + loci.columns
-    rows = arcpy.da.SearchCursor(input_features, selected_columns, where_clause)
+    genotypes = genotype.genotype_matrix(input_features, id_field, None, \
+            where_clause, [loc_a, loc_b], loci=loci)
+
+    # loci values should be separated by an '\'; missing and incomplete
+    # genotypes are written as 0.
+    loci_rows = genotypes.locus_strings(sep='\\', missing='0')
+    (loc_a_vals, loc_b_vals) = genotypes.coords
 
     coordinate_rows = []
     genetic_rows = []
-    for row in rows:
-        id_field = row[0]
-        loc_a_val = row[1]
-        loc_b_val = row[2]
-    
-        coordinate_row = [id_field, loc_a_val, loc_b_val]
-        genetic_row = [id_field]
-
-        for (key, cols) in loci.fields.items():
-            # loci values should be separated by an '\'.
-
-            loci_values = []
-            for col in cols:
-                col_pos = selected_columns.index(col)
-                allele_val = row[col_pos]
-                # handle missing and incomplete genotypes.
-                if allele_val is None:
-                    allele_val = "0"
-                else:
-                    allele_val = str(allele_val)
-                loci_values.append(allele_val)
-
-            genetic_row.append('\\'.join(loci_values))
-
-        coordinate_rows.append(coordinate_row)
-        genetic_rows.append(genetic_row)
+    for (i, individual) in enumerate(genotypes.ids):
+        coordinate_rows.append([individual, loc_a_vals[i], loc_b_vals[i]])
+        genetic_rows.append([individual] + loci_rows[i])
 
     try:
         # copy the final result back to disk.
@@ -48,6 +48,7 @@ from collections import OrderedDict
 # local imports
 import utils
 import config
+import genotype
 
 settings = config.settings()
 
@@ -152,39 +153,6 @@ def main(input_features=None, id_field=None, where_clause='', order_by=None,
     DATA starts at C4. See "GenAlEx Guide.pdf" page 15.
     """
 
-    # sql clause can be prefix or suffix; set up ORDER BY
-    sql_clause = (None, "ORDER BY {0} ASC".format(order_by))
-    # query the input_features in ascending order; filtering as needed
-    selected_columns = order_by
-    pops = OrderedDict()
-    rows = arcpy.da.SearchCursor(input_features, selected_columns,
-            where_clause, "", "", sql_clause)
-    row_count = 0
-    for row in rows:
-        row_count += 1
-        pop = row[0]
-        if pops.has_key(pop):
-            pops[pop] +=1
-        else:
-            pops[pop] = 1
-
-    pop_counts = [xstr(p) for p in pops.values()]
-   
-    # Creating the GenAlEx header information required for the text file.
-    output_rows += [[loci.count, row_count, len(pops.keys())] + pop_counts]
-
-    # optional title, then a list of each population
-    output_rows += [['', '', ''] + pops.keys()]
-
-    # first two rows almost exactly the same
-    haplotype_rows = copy.deepcopy(output_rows)
-    # 'number of loci' should be 1 for haplotype-only data
-    haplotype_rows[0][0] = 1
-
-    loci_labels = []
-    for (key, cols) in loci.fields.items():
-        loci_labels += [key] + [''] * (len(cols) - 1)
-
     # get the spatial reference of our input, determine the type
     desc = arcpy.Describe(input_features)
     sr = desc.spatialReference
@@ -203,6 +171,36 @@ def main(input_features=None, id_field=None, where_clause='', order_by=None,
         # add any field not currently mapped
         if field not in exclude:
             unselected_columns.append(field)
+    extra_fields = list(unselected_columns)
+    if haplotypes.defined and haplotypes.column not in extra_fields:
+        extra_fields.append(haplotypes.column)
+
+    # Note the WhereClause: Because the SPLASH data has both photo-id and genetic
+    # records, but GenAlEx only uses genetic data, the WhereClause is used to ensure
+    # only those records with genetic data are copied to the text file.
+    # All rows are read once, in ascending order of population.
+    genotypes = genotype.genotype_matrix(input_features, primary_id, order_by,
+            where_clause, [loc_a, loc_b], extra_fields, loci)
+    pops = genotypes.population_counts()
+    row_count = genotypes.count
+
+    pop_counts = [xstr(p) for p in pops.values()]
+   
+    # Creating the GenAlEx header information required for the text file.
+    output_rows += [[loci.count, row_count, len(pops.keys())] + pop_counts]
+
+    # optional title, then a list of each population
+    output_rows += [['', '', ''] + pops.keys()]
+
+    # first two rows almost exactly the same
+    haplotype_rows = copy.deepcopy(output_rows)
+    # 'number of loci' should be 1 for haplotype-only data
+    haplotype_rows[0][0] = 1
+
+    loci_labels = []
+    for (key, cols) in loci.fields.items():
+        loci_labels += [key] + [''] * (len(cols) - 1)
+
     # extra fields should start with an empty line, the location, then any
     # columns not otherwise mapped.
     extra_columns = ['', loc_a, loc_b] + unselected_columns
@@ -212,27 +210,18 @@ def main(input_features=None, id_field=None, where_clause='', order_by=None,
         haplotype_rows += [[primary_id, order_by, haplotypes.column]]
     utils.msg("Header info written to output")
 
-    # Note the WhereClause: Because the SPLASH data has both photo-id and genetic
-    # records, but GenAlEx only uses genetic data, the WhereClause is used to ensure
-    # only those records with genetic data are copied to the text file.
-    selected_columns = primary_columns + unselected_columns + loci.columns
-
-    for row in arcpy.da.SearchCursor(input_features, selected_columns,
-            where_clause, "", "", sql_clause):
-        id_field = row[0] # as set on import
-        pop = row[1] # second column is 'order_by', or key column
-        loc_a_val = row[2]
-        loc_b_val = row[3]
-        unselected_rows = list(row[4:len(unselected_columns)+4])
-        result_row = [id_field, pop]
-        for (key, cols) in loci.fields.items():
-            for col in cols:
-                col_pos = selected_columns.index(col)
-                result_row.append(row[col_pos])
-        result_row = result_row + ["", loc_a_val, loc_b_val] + unselected_rows
+    allele_rows = genotypes.allele_columns().tolist()
+    (loc_a_vals, loc_b_vals) = genotypes.coords
+    unselected_rows = zip(*[genotypes.extra[c] for c in unselected_columns]) \
+            if unselected_columns else [()] * row_count
+    for i in range(row_count):
+        id_field = genotypes.ids[i] # as set on import
+        pop = genotypes.populations[i] # 'order_by', or key column
+        result_row = [id_field, pop] + allele_rows[i] + \
+                ["", loc_a_vals[i], loc_b_vals[i]] + list(unselected_rows[i])
         output_rows += [[zstr(s) for s in result_row]]
         if haplotypes.defined:
-            row_val = row[selected_columns.index(haplotypes.column)]
+            row_val = genotypes.extra[haplotypes.column][i]
             if row_val:
                 haplotype_val = haplotypes.lookup[row_val]
             else:
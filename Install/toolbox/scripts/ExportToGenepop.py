@@ -38,14 +38,9 @@ from datetime import datetime
 # local imports
 import utils
 import config
+import genotype
 settings = config.settings()
 
-def normalize(allele):
-    val = str(allele)
-    if allele == '' or allele is None or int(allele) == 0:
-        val = "000"
-    return val
-
 def main(input_features=None, id_field=None, where_clause=None, order_by=None, 
         output_name=None, mode=settings.mode):
 
@@ -79,21 +74,19 @@ def main(input_features=None, id_field=None, where_clause=None, order_by=None,
             # if no haplotype is found, leave an empty value
             haplo_lookup[None] = '000'
 
-        # sql clause can be prefix or suffix; set up ORDER BY
-        sql_clause = (None, "ORDER BY {0} ASC".format(order_by))
-
         # query the input_features in ascending order; filtering as needed
-        selected_columns = [settings.id_field, order_by] + loci.columns
-        if haplotypes.defined:
-            selected_columns += [haplotypes.column]
+        extra_fields = [haplotypes.column] if haplotypes.defined else []
+        genotypes = genotype.genotype_matrix(input_features, settings.id_field,
+                order_by, where_clause, extra_fields=extra_fields, loci=loci)
 
-        rows = arcpy.da.SearchCursor(input_features, selected_columns, 
-                where_clause, "", "", sql_clause)
+        # GENEPOP only supports haploid and diploid data; missing alleles
+        # are written as 000.
+        loci_rows = genotypes.locus_strings(sep='', missing='000')
         current_group = ""
 
-        for (i, row) in enumerate(rows):
-            id_field = row[0] # as set on import
-            group = row[1] # second column is 'order_by', or key column
+        for i in range(genotypes.count):
+            id_field = genotypes.ids[i] # as set on import
+            group = genotypes.populations[i] # 'order_by', or key column
             label = "{0}-{1},".format(id_field, group).replace(" ", "_")
             
             if i == 0:
@@ -115,17 +108,9 @@ def main(input_features=None, id_field=None, where_clause=None, order_by=None,
                 output_file.write("Pop\n")
                 current_group = group
 
-            result_row = [label]
-
-            # GENEPOP only supports haploid and diploid data.
-            for (key, cols) in loci.fields.items():
-                loci_val = ""
-                for col in cols:
-                    col_pos = selected_columns.index(col)
-                    loci_val += normalize(row[col_pos])
-                result_row.append(loci_val)
+            result_row = [label] + loci_rows[i]
             if haplotypes.defined:
-                haplo = row[-1]
+                haplo = genotypes.extra[haplotypes.column][i]
                 result_row.append(haplo_lookup[haplo])
             output_file.write(" ".join(result_row) + "\n")
 
@@ -7,6 +7,7 @@
 # Export data to SPAGeDi format.
 
 import arcpy
+import numpy
 import os
 import re
 import sys
@@ -18,6 +19,7 @@ import platform
 # local imports
 import utils
 import config
+import genotype
 settings = config.settings()
 
 def main(input_features=None, where_clause=None, order_by=None, 
@@ -34,20 +36,6 @@ def main(input_features=None, where_clause=None, order_by=None,
     loci = utils.Loci(input_features)
     utils.msg("loci set: {0}".format(",".join(loci.names)))
 
-    # sql clause can be prefix or suffix; set up ORDER BY
-    sql_clause = (None, "ORDER BY {0} ASC".format(order_by))
-    pops = OrderedDict()
-    # query the input_features in ascending order; filtering as needed
-    rows = arcpy.da.SearchCursor(input_features, order_by, where_clause, "", "", sql_clause)
-    row_count = 0
-    for row in rows:
-        row_count += 1
-        pop = row[0]
-        if pops.has_key(pop):
-            pops[pop] +=1
-        else:
-            pops[pop] = 1
-
     # Start with any number of header lines describing what this 
     # file is, each line should be prefixed with //. 
     comments = """// Export to SPAGeDi from the input `{input_features}`. 
@@ -78,8 +66,6 @@ def main(input_features=None, where_clause=None, order_by=None,
     # FIXME: another spot where 'observation_id' differs from 'individual_id';
     # deduplicate in order to have one value PER individual PER population.
 
-    categories = len(pops.keys())
-
     # FIXME: presumes only two coords, SPAGeDi supports three. Extract depth?
     if sr.type == 'Geographic':
         # Assumes decimal degrees; based on the statement 'if the number of 
@@ -106,6 +92,15 @@ def main(input_features=None, where_clause=None, order_by=None,
     # get the maximum number of different values per loci
     max_ploidy = max(map(len, loci.fields.values()))
 
+    # query the input_features in ascending order; filtering as needed.
+    # where_clause is used to ensure only those records with genetic data
+    # are copied to the output.
+    genotypes = genotype.genotype_matrix(input_features, settings.id_field, \
+            order_by, where_clause, [loc_a, loc_b], loci=loci)
+    pops = genotypes.population_counts()
+    categories = len(pops.keys())
+    row_count = genotypes.count
+
     # 1st line: set of 6 numbers separated by a tabulation representing: 
     header_row = [
         row_count,   # number of invidivuals
@@ -133,43 +128,24 @@ def main(input_features=None, where_clause=None, order_by=None,
     base_cols = [settings.id_field, order_by, loc_a, loc_b] 
     labels_row = base_cols + loci.columns
 
-    # where_clause is used to ensure only those records with genetic data 
-    # are copied to the output.
-    selected_columns = base_cols + loci.columns
-    rows = arcpy.da.SearchCursor(input_features, selected_columns, \
-            where_clause, "", "", sql_clause)
+    # Loci data can be encoded in a number of formats, the values
+    # separated by any non-numeric values (SPAGeDi manual, 3.2.1).
+    # Here, we use spaces.
+    # FIXME: handle missing and incomplete genotypes.
+    loci_rows = genotypes.locus_strings(sep=' ', missing='0')
+    if genotypes.count > 0 and loci.count > 0:
+        widest = numpy.char.str_len(genotypes.allele_strings('0')).max()
+        loci_digits = max(loci_digits, int(widest))
 
+    (loc_a_vals, loc_b_vals) = genotypes.coords
     data_rows = []
-    for row in rows:
+    for i in range(genotypes.count):
         # our two string fields can't contain spaces, based on Autocio.c: 3857 
-        id_field = str(row[0]).replace(" ", "_")
-        pop_field = str(row[1]).replace(" ", "_") # 'order_by', or population 'group by'
-        loc_a_val = row[2]
-        loc_b_val = row[3]
-
-        data_row = [id_field, pop_field, loc_a_val, loc_b_val]
-
-        for (key, cols) in loci.fields.items():
-            # Loci data can be encoded in a number of formats, the values
-            # separated by any non-numeric values (SPAGeDi manual, 3.2.1). 
-            # Here, we use spaces.
-
-            loci_values = []
-            for col in cols:
-                col_pos = selected_columns.index(col)
-                allele_val = row[col_pos]
-                # FIXME: handle missing and incomplete genotypes.
-                if allele_val is None:
-                    allele_val = "0"
-                else:
-                    allele_val = str(allele_val)
-                loci_len = len(allele_val) 
-                if loci_len > loci_digits:
-                    loci_digits = loci_len
-                loci_values.append(allele_val)
-
-            data_row.append(" ".join(loci_values))
-        data_rows.append(data_row)
+        id_field = str(genotypes.ids[i]).replace(" ", "_")
+        # 'order_by', or population 'group by'
+        pop_field = str(genotypes.populations[i]).replace(" ", "_")
+        data_row = [id_field, pop_field, loc_a_vals[i], loc_b_vals[i]]
+        data_rows.append(data_row + loci_rows[i])
 
     # update header based on revised loci_digits
     header_row[4] = loci_digits
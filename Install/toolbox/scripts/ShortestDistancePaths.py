@@ -16,150 +16,308 @@ The same calculation in geographiclib producees: 353995.597 meters
 """
 
 import arcpy
+import numpy
 import os
 import sys
 
 # local imports
 import utils
 import config
-import time
+import cost_distance
+import geodesy
+from spatial_index import SphericalIndex
 settings = config.settings()
 
-def main(input_fc=None, output_fc=None, closest=False, mode=settings.mode):
+def main(input_fc=None, output_fc=None, closest=False, k_nearest=None, \
+        search_radius=None, cost_raster=None, mode=settings.mode):
     
     # convert 'closest' string value
     closest_count = ""
-    if closest == 'true':
+    if closest in ('true', True):
         closest_count = 1
+    if k_nearest not in (None, ''):
+        closest_count = int(k_nearest)
+
+    # search radius is given in kilometers
+    radius = None
+    if search_radius not in (None, ''):
+        radius = float(search_radius) * 1000
 
     # does the input fc exist?
     if not arcpy.Exists(input_fc):
         utils.msg("Input, %s, doesn't exist.", mtype='error')
         sys.exit()
 
-    input_fc_mem = 'in_memory/input_fc'
-    try:
-        utils.msg("Copying features into memory...")
-        arcpy.CopyFeatures_management(input_fc, input_fc_mem)
-    except Exception as e:
-        utils.msg("Unable to copy features into memory.", mtype='error', exception=e)
-        sys.exit()
-
-    # add POINT_X and POINT_Y columns
-    try:
-        arcpy.AddXY_management(input_fc_mem)
-    except Exception as e:
-        message = "Error creating point coordinate values for {0}".format(input_fc)
-        utils.msg(message, mtype='error', exception=e)
-        sys.exit()
-
     # get the spatial reference of our input, determine the type
-    desc = arcpy.Describe(input_fc_mem)
+    desc = arcpy.Describe(input_fc)
     sr = desc.spatialReference
     if sr.type not in ['Geographic', 'Projected']:
         utils.msg("This tools only works with geographic or projected data.", mtype='error')
         sys.exit()
 
-    # yes, all this mucking about is necessary to get a row count
-    row_count = int(arcpy.GetCount_management(input_fc_mem).getOutput(0))
-    
-    if row_count < 500 or closest:
-        near_table = 'in_memory/near_table'
-        output_fc_mem = 'in_memory/output_fc'
-    else:
-        utils.msg("Too many features (%i) to load pairwise into memory. Using disk, which decreases performance." % row_count)
-        near_table = os.path.join(arcpy.env.scratchGDB, 'near_table')
-        output_fc_mem = output_fc
-
-    # create a look-up table which maps individual observations to all others.
-    # FIXME: do we need to filter this in some way? by group, ...?
     try:
-        # generates an output table with IN_FID, NEAR_FID, NEAR_X, NEAR_Y [...]
-        utils.msg("Creating near table...")
-        arcpy.GenerateNearTable_analysis(input_fc_mem, input_fc_mem, near_table, \
-                "", "LOCATION", "NO_ANGLE", "ALL")
-
-        time.sleep(5)
+        utils.msg("Reading point locations...")
+        points = read_points(input_fc, sr)
     except Exception as e:
-        utils.msg("Error creating near table.", mtype='error', exception=e)
+        utils.msg("Unable to read input features.", mtype='error', exception=e)
         sys.exit()
 
-    try:
-        utils.msg("Joining attributes...")
-        in_fields = arcpy.ListFields(input_fc_mem)
-        # find the OID field.
-        oid_field = [f.name for f in in_fields if f.type == 'OID'][0]
-
-        # join back our 'true' x & y columns to the original data.
-        arcpy.JoinField_management(near_table, "IN_FID", input_fc_mem, oid_field, ['POINT_X','POINT_Y'])
-        # clean up
-        arcpy.Delete_management(input_fc_mem)
-
-        in_fields = arcpy.ListFields(near_table)
-        oid_field = [f.name for f in in_fields if f.type == 'OID'][0]
-
-        id_field = 'ID'
-        # add an 'ID' field other than the OID so we can copy it over using XYToLine
-        arcpy.AddField_management(near_table, id_field, "LONG")
-        expression = "!{0}!".format(oid_field)
-        arcpy.CalculateField_management(near_table, id_field, expression , "PYTHON_9.3")
+    # least-cost paths over a raster replace the geodesic lines.
+    if cost_raster not in (None, ''):
+        if not arcpy.Exists(cost_raster):
+            utils.msg("Cost raster, %s, doesn't exist." % cost_raster, \
+                    mtype='error')
+            sys.exit()
+        try:
+            utils.msg("Reading cost raster...")
+            surface = cost_distance.CostSurface.from_raster(cost_raster)
+        except Exception as e:
+            utils.msg("Unable to read the cost raster.", mtype='error', \
+                    exception=e)
+            sys.exit()
+        try:
+            utils.msg("Computing pairwise least-cost paths...")
+            output_fc = os.path.abspath(output_fc)
+            lines = cost_lines(input_fc, surface, points, closest_count, radius)
+            write_paths(output_fc, sr, lines)
+            utils.msg("Created least-cost paths successfully: {0}".format(output_fc))
+        except Exception as e:
+            utils.msg("Error creating least-cost paths.", mtype='error', \
+                    exception=e)
+            sys.exit()
+        return
 
+    # pair each observation with the others, as positions into points.
+    # FIXME: do we need to filter this in some way? by group, ...?
+    (a, f) = geodesy.ellipsoid(sr)
+    try:
+        utils.msg("Finding pairs of features...")
+        if closest_count or radius:
+            # only some pairs are wanted; find them with a spatial index
+            # rather than generating all of them.
+            pairs = indexed_pairs(points, a, f, closest_count, radius)
+            if len(pairs[0]) == 0:
+                utils.msg("No pairs of features found within the search " + \
+                        "radius.", mtype='error')
+                sys.exit()
+            pairs = [pairs]
+        else:
+            pairs = all_pairs(points, a, f)
     except Exception as e:
-        utils.msg("Error joining data.", mtype='error', exception=e)
+        utils.msg("Error finding pairs of features.", mtype='error', exception=e)
         sys.exit()
 
     # Now compute the lines between these locations.
     try:
         utils.msg("Computing pairwise geodesic lines...")
-        arcpy.XYToLine_management(near_table, output_fc_mem, \
-                "NEAR_X", "NEAR_Y", "POINT_X", "POINT_Y", "GEODESIC", id_field)
-
-        utils.msg("Remapping output columns...")
-        arcpy.JoinField_management(output_fc_mem, id_field, near_table, id_field, ['IN_FID', 'NEAR_FID'])
-
-        # column modifications necessary
-        remap_cols = [
-          ('IN_FID', 'Source_ID', '!IN_FID!'),
-          ('POINT_X', 'Source_X', '!POINT_X!'),
-          ('POINT_Y', 'Source_Y', '!POINT_Y!'),
-          ('NEAR_FID', 'Dest_ID', '!NEAR_FID!'), 
-          ('NEAR_X', 'Dest_X', '!NEAR_X!'), 
-          ('NEAR_Y', 'Dest_Y', '!NEAR_Y!'),
-          (None, 'Distance_in_km', "!Shape.length@kilometers!") # output distance in kilometers
-        ] 
-
-        fn = [f.name for f in arcpy.ListFields(output_fc_mem)]
-        for (in_name, out_name, expr) in remap_cols:
-            # create a new field for storing the coord
-            arcpy.AddField_management(output_fc_mem, out_name, "DOUBLE")
-            # copy the field over from the original
-            arcpy.CalculateField_management(output_fc_mem, out_name, expr, "PYTHON_9.3")
-            # delete the original field
-            if in_name in fn:
-                arcpy.DeleteField_management(output_fc_mem, in_name)
-
-        # can't delete length; part of the data model which is 
-        # unfortunate -- it's degrees, and has no linear distance.
-        # arcpy.DeleteField_management(output_fc_mem, "Shape_Length")
-
-        # copy the final result back to disk.
-        if output_fc_mem != output_fc:
-            utils.msg("Writing results to disk...")
-            output_fc = os.path.abspath(output_fc)
-            arcpy.CopyFeatures_management(output_fc_mem, output_fc)
-
+        output_fc = os.path.abspath(output_fc)
+        write_paths(output_fc, sr, geodesic_lines(points, pairs))
         utils.msg("Created shortest distance paths successfully: {0}".format(output_fc))
     except Exception as e:
         utils.msg("Error creating geodesic lines.", mtype='error', exception=e)
         sys.exit()
 
-    # clean up: remove intermediate steps. 
-    try:
-        for layer in [near_table, output_fc_mem]:
-            arcpy.Delete_management(layer)
-    except Exception as e:
-        utils.msg("Unable to delete temporary layer", mtype='error', exception=e)
-        sys.exit()
+def read_points(input_fc, sr):
+    """
+    OIDs and coordinates of the input points, both as stored and as
+    geographic (lat, lon) coordinates for measuring on the ellipsoid.
+    """
+    points = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            ['OID@', 'SHAPE@X', 'SHAPE@Y'])
+    gcs = sr
+    if sr.type == 'Projected':
+        gcs = sr.GCS
+    geographic = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            ['SHAPE@Y', 'SHAPE@X'], spatial_reference=gcs)
+    return {
+        'oid': points['OID@'],
+        'x': points['SHAPE@X'],
+        'y': points['SHAPE@Y'],
+        'lat': geographic['SHAPE@Y'],
+        'lon': geographic['SHAPE@X'],
+        'gcs': gcs
+    }
+
+def all_pairs(points, a, f, chunk_size=64):
+    """
+    Every ordered pair of distinct points, as chunks of (source, dest,
+    distance in meters) arrays. Like GenerateNearTable, destinations are
+    listed nearest first for each source.
+    """
+    (lats, lons) = (points['lat'], points['lon'])
+    count = len(lats)
+    for start in range(0, count, chunk_size):
+        stop = min(start + chunk_size, count)
+        block = geodesy.distance_block(lats, lons, start, stop, a, f)
+        order = numpy.argsort(block, axis=1, kind='mergesort')
+        sources = numpy.arange(start, stop)
+        # drop each point's pairing with itself.
+        others = order != sources[:, numpy.newaxis]
+        dests = order[others]
+        sources = numpy.repeat(sources, count - 1)
+        yield (sources, dests, block[sources - start, dests])
+
+def indexed_pairs(points, a, f, k=None, radius=None):
+    """
+    Pairs of each point with its k nearest neighbors and/or the neighbors
+    within radius meters, as (source, dest, distance in meters) arrays.
+    """
+    (lats, lons) = (points['lat'], points['lon'])
+    index = SphericalIndex(lats, lons, a, f)
+
+    (sources, dests, dists) = ([], [], [])
+    for i in range(len(lats)):
+        if k:
+            (positions, found) = index.nearest(lats[i], lons[i], k, exclude=i)
+            if radius is not None:
+                keep = found <= radius
+                (positions, found) = (positions[keep], found[keep])
+        else:
+            (positions, found) = index.within(lats[i], lons[i], radius, \
+                    exclude=i)
+        sources.append(numpy.repeat(i, len(positions)))
+        dests.append(positions)
+        dists.append(found)
+
+    if not sources:
+        return (numpy.zeros(0, dtype=numpy.intp), \
+                numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0))
+    return (numpy.concatenate(sources).astype(numpy.intp), \
+            numpy.concatenate(dests).astype(numpy.intp), \
+            numpy.concatenate(dists))
+
+def path_attributes(points, sources, dests, dists):
+    """ Source_ID, Source_X, Source_Y, Dest_ID, Dest_X, Dest_Y and
+        Distance_in_km values for pairs of points, distances in meters."""
+    (oids, xs, ys) = (points['oid'], points['x'], points['y'])
+    return zip(oids[sources].tolist(), xs[sources].tolist(), \
+            ys[sources].tolist(), oids[dests].tolist(), xs[dests].tolist(), \
+            ys[dests].tolist(), (dists / 1000.0).tolist())
+
+def geodesic_lines(points, pairs):
+    """ Densified great circle lines for chunks of (source, dest, distance)
+        pairs, as (line, attributes) tuples."""
+    (lats, lons) = (points['lat'], points['lon'])
+    # lines are built in geographic coordinates, and projected on insert.
+    gcs = points['gcs']
+    for (sources, dests, dists) in pairs:
+        (path_lats, path_lons, counts) = geodesy.great_circle_paths( \
+                lats[sources], lons[sources], lats[dests], lons[dests])
+        attributes = path_attributes(points, sources, dests, dists)
+        path_lats = path_lats.tolist()
+        path_lons = path_lons.tolist()
+        start = 0
+        for (count, values) in zip(counts.tolist(), attributes):
+            stop = start + count
+            array = arcpy.Array([arcpy.Point(x, y) for (x, y) in \
+                    zip(path_lons[start:stop], path_lats[start:stop])])
+            yield (arcpy.Polyline(array, gcs, False, False), values)
+            start = stop
+
+def cost_destinations(position, row, inverse, k=None, radius=None):
+    """ Destinations of the point at position, nearest first, given the
+        cost distances from its cell to every cell, and the cell of each
+        point. Unreachable points are left out."""
+    dists = row[inverse]
+    order = numpy.argsort(dists, kind='mergesort')
+    order = order[(order != position) & numpy.isfinite(dists[order])]
+    if radius is not None:
+        order = order[dists[order] <= radius]
+    if k:
+        order = order[:k]
+    return order
+
+def cost_lines(input_fc, surface, points, k=None, radius=None):
+    """
+    Least-cost paths over a cost surface between each point and the
+    others, or its k nearest and/or those within radius meters by cost
+    distance, as (line, attributes) tuples. Lines follow the centers of the
+    cells along each path, and are written one source cell at a time.
+    """
+    located = arcpy.da.FeatureClassToNumPyArray(input_fc, \
+            ['SHAPE@X', 'SHAPE@Y'], spatial_reference=surface.spatial_reference)
+    (xs, ys) = (located['SHAPE@X'], located['SHAPE@Y'])
+    (nodes, moved) = surface.locate(xs, ys)
+    if moved.any():
+        utils.msg("{0} points fall on impassable cells, and were moved to " \
+                "the nearest passable cell.".format(moved.sum()), \
+                mtype='warning')
+    (cells, inverse) = numpy.unique(nodes, return_inverse=True)
+    members = [numpy.flatnonzero(inverse == i) for i in range(len(cells))]
+    workers = utils.worker_count()
+
+    if k or radius is not None:
+        # find which pairs are wanted first, so that only their paths are
+        # traced afterwards.
+        matrix = numpy.empty((len(cells), len(cells)))
+        for (i, row, paths) in cost_distance.search_rows(surface, cells, \
+                cells, workers=workers):
+            matrix[i] = row
+        path_targets = []
+        for (i, positions) in enumerate(members):
+            dests = [cost_destinations(p, matrix[i], inverse, k, radius) \
+                    for p in positions.tolist()]
+            path_targets.append(cells[numpy.unique(inverse[ \
+                    numpy.concatenate(dests)])])
+    else:
+        path_targets = [cells] * len(cells)
+
+    for (i, row, paths) in cost_distance.search_rows(surface, cells, cells, \
+            path_targets, workers):
+        path_of = dict(zip(path_targets[i].tolist(), paths))
+        for source in members[i].tolist():
+            dests = cost_destinations(source, row, inverse, k, radius)
+            attributes = path_attributes(points, \
+                    numpy.repeat(source, len(dests)), dests, row[inverse[dests]])
+            for (dest, values) in zip(dests.tolist(), attributes):
+                (path_xs, path_ys) = surface.centers(path_of[nodes[dest]])
+                # start and end at the points themselves, not cell centers.
+                vertices = [(xs[source], ys[source])] + \
+                        zip(path_xs.tolist(), path_ys.tolist())[1:-1] + \
+                        [(xs[dest], ys[dest])]
+                array = arcpy.Array([arcpy.Point(x, y) for (x, y) in vertices])
+                line = arcpy.Polyline(array, surface.spatial_reference, \
+                        False, False)
+                yield (line, values)
+
+def add_field(layer, name, field_type):
+    """ Add a field to layer, returning the name the workspace gave it:
+        shapefiles truncate names to 10 characters, and already come with
+        an Id field."""
+    existing = [f.name for f in arcpy.ListFields(layer)]
+    for f_name in existing:
+        if f_name.lower() == name.lower():
+            return f_name
+    arcpy.AddField_management(layer, name, field_type)
+    added = [f.name for f in arcpy.ListFields(layer) if f.name not in existing]
+    return added[0]
+
+def write_paths(output_fc, sr, lines):
+    """
+    Create output_fc and fill it with (line, attributes) tuples through a
+    single insert cursor.
+    """
+    out_path = os.path.dirname(output_fc)
+    out_name = os.path.basename(output_fc)
+    layer = arcpy.CreateFeatureclass_management(out_path, out_name, \
+            'POLYLINE', "", 'DISABLED', 'DISABLED', sr)
+
+    # same columns the XYToLine based workflow produced.
+    f_list = [('ID', 'LONG'),
+              ('Source_ID', 'DOUBLE'),
+              ('Source_X', 'DOUBLE'),
+              ('Source_Y', 'DOUBLE'),
+              ('Dest_ID', 'DOUBLE'),
+              ('Dest_X', 'DOUBLE'),
+              ('Dest_Y', 'DOUBLE'),
+              ('Distance_in_km', 'DOUBLE')]
+    f_names = ["SHAPE@"]
+    for (f_name, f_type) in f_list:
+        f_names.append(add_field(layer, f_name, f_type))
+
+    with arcpy.da.InsertCursor(layer, f_names) as cursor:
+        for (line_id, (line, values)) in enumerate(lines):
+            cursor.insertRow([line, line_id + 1] + list(values))
 
 # when executing as a standalone script get parameters from sys
 if __name__=='__main__':
@@ -167,6 +325,10 @@ if __name__=='__main__':
     defaults_tuple = (
         ('input_fc', os.path.join(settings.example_gdb, "SRGD_example_Spatial")),
         ('output_fc', "example_shortest_distance_paths.shp"),
+        ('closest', False),
+        ('k_nearest', None),
+        ('search_radius', None),
+        ('cost_raster', None)
     ) 
     defaults = utils.parameters_from_args(defaults_tuple, sys.argv)
     main(mode='script', **defaults)
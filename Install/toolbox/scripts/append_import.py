@@ -0,0 +1,190 @@
+# append_import.py: add new and changed rows to an imported feature class
+# -*- coding: utf-8 -*-
+
+"""
+Appends a newer version of an SRGD file to the feature class it was
+imported to, keyed on Sample_ID. A hash of every input row is stored next
+to the feature class (see import_record), so only rows whose key is new or
+whose hash changed are written: new keys are inserted as features, and
+changed rows update their existing features in place. Features whose rows
+are unchanged, or missing from the newer file, are left alone.
+
+Stored haplotype counts are adjusted by the rows written instead of being
+recounted, and cached genotype matrices of the feature class are dropped.
+"""
+
+import hashlib
+
+import arcpy
+import numpy
+
+import dates
+import feature_import
+import genotype
+import haplotype_table
+import import_record
+import table_import
+import utils
+
+# column identifying the rows of an input file.
+KEY_FIELD = 'Sample_ID'
+# keys looked up per query when finding features to update.
+WHERE_CHUNK = 500
+# geodatabase field types, as the types input values are coerced to.
+FIELD_TYPES = {
+    'SmallInteger': 'LONG',
+    'Integer': 'LONG',
+    'Single': 'DOUBLE',
+    'Double': 'DOUBLE'
+}
+
+def key_text(value):
+    """ A key as text, however its field stores it."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return unicode(value)
+
+def row_hashes(header, columns):
+    """ SHA-1 of the values of each row. The header is included, so rows
+        of tables with different columns never match."""
+    base = hashlib.sha1('\x1f'.join(header))
+    hashes = []
+    for row in zip(*[c.tolist() for c in columns]):
+        digest = base.copy()
+        digest.update('\x1e'.join(row))
+        hashes.append(digest.hexdigest())
+    return hashes
+
+def column_hashes(header, columns, key_field=KEY_FIELD):
+    """ The hash of each row of columns already read, by key, or None if
+        there's no key column. Repeated keys keep their last row."""
+    if key_field not in header:
+        return None
+    keys = feature_import.decode(columns[header.index(key_field)]).tolist()
+    return dict(zip(keys, row_hashes(header, columns)))
+
+def hashed_chunks(chunks, hashes, key_field=KEY_FIELD):
+    """ Pass on chunks as read by feature_import.read_chunks, adding the
+        hash of each of their rows to hashes by key."""
+    for (header, columns) in chunks:
+        hashes.update(column_hashes(header, columns, key_field) or {})
+        yield (header, columns)
+
+def table_hashes(input_file, key_field=KEY_FIELD):
+    """ The hash of each row of a text table, by key, read a chunk at a
+        time; see column_hashes."""
+    if key_field not in feature_import.read_header(input_file):
+        return None
+    hashes = {}
+    for (header, columns) in feature_import.read_chunks(input_file):
+        hashes.update(column_hashes(header, columns, key_field))
+    return hashes
+
+def typed_rows(header, columns, fields, rows, x, y):
+    """ The rows at positions rows, with their values converted to the
+        types of the feature class fields and a leading point."""
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    labels = list(header)
+    values = []
+    for (label, column) in zip(header, columns):
+        selected = column[rows]
+        field_type = FIELD_TYPES.get(fields[label].type, 'TEXT')
+        if field_type == 'TEXT':
+            selected = feature_import.decode(selected)
+        values.append([table_import.coerce(v, field_type) \
+                for v in selected.tolist()])
+
+    date_field = feature_import.DATE_FIELD
+    date_column = feature_import.DATE_COLUMN
+    if date_field in fields and date_column in header:
+        (parsed, failed) = dates.parse_dates( \
+                columns[header.index(date_column)][rows])
+        labels.append(date_field)
+        values.append([None if f else d for (d, f) in \
+                zip(parsed.tolist(), failed.tolist())])
+
+    points = [None if xv is None or yv is None else (xv, yv) for (xv, yv) in \
+            zip(values[header.index(x)], values[header.index(y)])]
+    typed = [[point] + list(row) for (point, row) in \
+            zip(points, zip(*values))]
+    return (['SHAPE@XY'] + labels, typed)
+
+def key_clauses(output_fc, key_field, field_type, keys):
+    """ Where clauses selecting features by key, a chunk of keys at a
+        time."""
+    delimited = arcpy.AddFieldDelimiters(output_fc, key_field)
+    for chunk in table_import.chunks(sorted(keys), WHERE_CHUNK):
+        if field_type == 'TEXT':
+            values = ["'{0}'".format(k.replace("'", "''")) for k in chunk]
+        else:
+            values = [str(int(float(k))) for k in chunk]
+        yield u"{0} IN ({1})".format(delimited, u", ".join(values))
+
+def append_features(input_file, output_fc, x, y, key_field=KEY_FIELD):
+    """
+    Insert the rows of a text table whose key isn't yet in output_fc, and
+    update the features of rows which changed since they were imported.
+    Returns the number of features inserted and updated.
+    """
+    (header, columns) = feature_import.read_columns(input_file)
+    if key_field not in header:
+        raise ValueError("Appending requires a {0} column to match rows " \
+                "to features.".format(key_field))
+    fields = dict((f.name, f) for f in arcpy.ListFields(output_fc))
+    missing = [label for label in header if label not in fields]
+    if missing:
+        raise ValueError("Columns {0} aren't in {1}; import the file in full " \
+                "to add them.".format(", ".join(missing), output_fc))
+
+    keys = feature_import.decode(columns[header.index(key_field)]).tolist()
+    hashes = row_hashes(header, columns)
+    # a key repeated in the input keeps its last row.
+    latest = dict((key, i) for (i, key) in enumerate(keys) if key != '')
+    if len(latest) < len(keys):
+        utils.msg("{0} rows had an empty or repeated {1}; only the last row " \
+                "of each key was used.".format(len(keys) - len(latest), \
+                key_field), mtype='warning')
+
+    stored = import_record.read_row_hashes(output_fc)
+    with arcpy.da.SearchCursor(output_fc, [key_field]) as cursor:
+        existing = set(key_text(key) for (key,) in cursor if key is not None)
+    new = [i for (key, i) in latest.items() if key not in existing]
+    changed = dict((key, i) for (key, i) in latest.items() \
+            if key in existing and stored.get(key) != hashes[i])
+
+    haplotype_field = haplotype_table.stored_field(output_fc)
+    # the stored counts are only adjusted if they match the features now.
+    before = haplotype_table.fingerprint(output_fc)
+    (added, removed) = ([], [])
+    if new:
+        (names, rows) = typed_rows(header, columns, fields, sorted(new), x, y)
+        with arcpy.da.InsertCursor(output_fc, names) as cursor:
+            for row in rows:
+                cursor.insertRow(row)
+        added += [dict(zip(names, row)) for row in rows]
+
+    if changed:
+        (names, rows) = typed_rows(header, columns, fields, \
+                changed.values(), x, y)
+        updates = dict(zip(changed.keys(), rows))
+        position = names.index(key_field)
+        field_type = FIELD_TYPES.get(fields[key_field].type, 'TEXT')
+        for where_clause in key_clauses(output_fc, key_field, field_type, \
+                changed.keys()):
+            with arcpy.da.UpdateCursor(output_fc, names, where_clause) as cursor:
+                for row in cursor:
+                    update = updates[key_text(row[position])]
+                    removed.append(dict(zip(names, row)))
+                    added.append(dict(zip(names, update)))
+                    cursor.updateRow(update)
+
+    if new or changed:
+        if haplotype_field is not None:
+            haplotype_table.update_counts(output_fc, haplotype_field, \
+                    added, removed, before)
+        genotype.invalidate(output_fc)
+        # the features no longer match any one input file.
+        import_record.clear(output_fc)
+        import_record.update_row_hashes(output_fc, \
+                dict((keys[i], hashes[i]) for i in new + changed.values()))
+    return (len(new), len(changed))
@@ -0,0 +1,112 @@
+# column_groups.py: sort the columns of an input into the import groups
+# -*- coding: utf-8 -*-
+
+"""
+Sorts the columns of an SRGD file into the groups of the import dialog,
+Genetic, Identification, Location and Other, by matching their labels
+against config.group_expressions. Only the header is needed, and only the
+first few kilobytes of the file are read to get it.
+
+The dialog asks again every time a parameter changes, so classifications
+are kept in memory by path, size and modification time, and only worked
+out again once the file changes.
+
+Groups may give their columns a fixed type, or a preferred type to use
+when every value fits it, along with a fallback. Whether every value fits
+takes a scan of the whole file, which is left to the import itself; see
+import_types.
+"""
+
+import collections
+import os
+import re
+
+import config
+import table_schema
+import utils
+
+# groups, in the order the dialog shows them.
+GROUPS = ['Genetic', 'Identification', 'Location', 'Other']
+# number of classified files to keep in memory.
+CACHE_SIZE = 8
+_cache = collections.OrderedDict()
+
+class Classification(object):
+    """ The columns of an input file, sorted into groups."""
+
+    def __init__(self, original_header, header, \
+            expressions=config.group_expressions):
+        self.original_header = original_header
+        self.header = header
+        self.groups = collections.OrderedDict((g, []) for g in GROUPS)
+        # label to (1-based position, type), for columns of a fixed type.
+        self.types = collections.OrderedDict()
+        # label to (1-based position, (preferred type, fallback type)).
+        self.preferred = collections.OrderedDict()
+
+        unused = list(header)
+        for (group, expr, data_type) in expressions:
+            for (i, label) in enumerate(header):
+                if label not in unused or \
+                        not re.search(expr, label, re.IGNORECASE):
+                    continue
+                self.groups[group].append(label)
+                unused.remove(label)
+                if isinstance(data_type, basestring):
+                    self.types[label] = (i + 1, data_type)
+                elif data_type is not None:
+                    self.preferred[label] = (i + 1, tuple(data_type))
+        # anything left over is included under 'Other'.
+        self.groups['Other'] += unused
+
+    def modified_columns(self):
+        """ (original, validated) labels of the columns whose labels had to
+            be changed for the geodatabase."""
+        return [(original, label) for (original, label) in \
+                zip(self.original_header, self.header) if original != label]
+
+def file_key(input_file):
+    """ What identifies a version of a file: its path, size and
+        modification time."""
+    stat = os.stat(input_file)
+    return (os.path.abspath(input_file), stat.st_size, stat.st_mtime)
+
+def classify(input_file):
+    """ The Classification of an input file, from its header alone. Kept
+        in memory until the file changes."""
+    key = file_key(input_file)
+    if key in _cache:
+        # keep recently used files in the cache.
+        _cache[key] = _cache.pop(key)
+        return _cache[key]
+    (original_header, sample, dialect) = utils.table_header(input_file, 0)
+    classification = Classification(original_header, \
+            utils.validate_header(original_header))
+    _cache[key] = classification
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return classification
+
+def import_types(input_file, protected_map=None):
+    """
+    Types for every column of an input file, as label to (1-based
+    position, schema.ini type), scanning the whole file. Columns of a fixed
+    type always get it, as the import dialog does; columns with a preferred
+    type get it if every value fits, and their fallback otherwise. Types
+    already given in protected_map are kept.
+    """
+    protected = dict(protected_map or {})
+    classification = classify(input_file)
+    given = [idx for (idx, data_type) in protected.values()]
+    for (label, (idx, data_type)) in classification.types.items():
+        if idx not in given:
+            protected[label] = (idx, data_type)
+    schema = table_schema.schema_types(input_file)
+    for (label, (idx, (preferred, fallback))) in \
+            classification.preferred.items():
+        if idx in given:
+            continue
+        (position, inferred) = schema.get(label, (idx, None))
+        protected[label] = (idx, preferred if inferred == preferred \
+                else fallback)
+    return table_schema.protected_schema(input_file, protected)
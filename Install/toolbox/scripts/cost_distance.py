@@ -0,0 +1,280 @@
+# cost_distance.py: least-cost distances over a cost raster
+# -*- coding: utf-8 -*-
+
+"""
+Distances between points which have to travel around barriers, such as
+whales moving between oceans around a land mass. The cost raster is treated
+as a graph of cells, each linked to its eight neighbors; moving between two
+cells costs the ground distance between their centers, weighted by the mean
+of their cost values. Cells which are NoData, or have a cost of zero or
+less, can't be crossed.
+
+A single shortest path search from each source finds its distance to every
+destination at once. SciPy's compiled Dijkstra is used when it's installed,
+otherwise a heap-based search in pure Python; either way, sources can be
+spread across a pool of worker processes. Reading the raster only needs
+arcpy's RasterToNumPyArray, so no Spatial Analyst license is required.
+"""
+
+import heapq
+import multiprocessing
+
+import numpy
+
+import geodesy
+import spatial_index
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra
+except ImportError:
+    csr_matrix = None
+
+# (row, col) offsets to the neighbors each cell is linked to; the opposite
+# directions are added when the graph is built.
+OFFSETS = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+class CostSurface(object):
+    """ A cost raster as a graph of its crossable cells, or nodes."""
+
+    def __init__(self, cost, x_min, y_max, cell_width, cell_height, \
+            geographic=True, meters_per_unit=1.0, a=geodesy.WGS84_A, \
+            f=geodesy.WGS84_F, spatial_reference=None):
+        cost = numpy.asarray(cost, dtype=numpy.float64)
+        self.shape = cost.shape
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.geographic = geographic
+        self.meters_per_unit = meters_per_unit
+        self.a = a
+        self.f = f
+        self.spatial_reference = spatial_reference
+
+        with numpy.errstate(invalid='ignore'):
+            passable = numpy.isfinite(cost) & (cost > 0)
+        # the raster cell of each node, and the node of each cell.
+        self.cells = numpy.flatnonzero(passable)
+        self.count = len(self.cells)
+        self.node_of = -numpy.ones(cost.size, dtype=numpy.intp)
+        self.node_of[self.cells] = numpy.arange(self.count)
+        self._build_graph(cost.ravel(), passable.ravel())
+        self._graph = None
+        self._lists = None
+        self._tree = None
+
+    @classmethod
+    def from_raster(cls, raster_path):
+        """ Read a cost surface from a single band raster."""
+        import arcpy
+        raster = arcpy.Raster(raster_path)
+        cost = arcpy.RasterToNumPyArray(raster).astype(numpy.float64)
+        if raster.noDataValue is not None:
+            cost[cost == raster.noDataValue] = numpy.nan
+        sr = raster.spatialReference
+        geographic = sr.type == 'Geographic'
+        meters_per_unit = 1.0 if geographic else sr.metersPerUnit
+        (a, f) = geodesy.ellipsoid(sr)
+        return cls(cost, raster.extent.XMin, raster.extent.YMax, \
+                raster.meanCellWidth, raster.meanCellHeight, geographic, \
+                meters_per_unit, a, f, sr)
+
+    def _step_lengths(self, rows, d_row, d_col):
+        """ Ground distance in meters of a step of (d_row, d_col) cells,
+            starting from cells in each of rows."""
+        if self.geographic:
+            lat = self.y_max - (rows + 0.5) * self.cell_height
+            return geodesy.inverse(lat, 0, lat - d_row * self.cell_height, \
+                    d_col * self.cell_width, self.a, self.f)
+        length = numpy.hypot(d_row * self.cell_height, d_col * self.cell_width)
+        return numpy.ones(len(rows)) * length * self.meters_per_unit
+
+    def _build_graph(self, cost, passable):
+        """ Weighted edges between neighboring nodes, in CSR layout."""
+        (row_count, col_count) = self.shape
+        (sources, dests, weights) = ([], [], [])
+        for (d_row, d_col) in OFFSETS:
+            rows = numpy.arange(0, row_count - d_row)
+            cols = numpy.arange(max(0, -d_col), col_count - max(0, d_col))
+            from_cells = rows[:, numpy.newaxis] * col_count + cols
+            to_cells = from_cells + d_row * col_count + d_col
+            linked = passable[from_cells] & passable[to_cells]
+            steps = self._step_lengths(rows, d_row, d_col)[:, numpy.newaxis]
+            weight = steps * (cost[from_cells] + cost[to_cells]) / 2
+            sources.append(self.node_of[from_cells[linked]])
+            dests.append(self.node_of[to_cells[linked]])
+            weights.append(weight[linked])
+
+        # moves are symmetric; link every pair of nodes both ways.
+        (sources, dests) = (numpy.concatenate(sources + dests), \
+                numpy.concatenate(dests + sources))
+        weights = numpy.concatenate(weights * 2)
+        order = numpy.argsort(sources, kind='mergesort')
+        self.indices = dests[order]
+        self.weights = weights[order]
+        self.indptr = numpy.searchsorted(sources[order], \
+                numpy.arange(self.count + 1))
+
+    def graph(self):
+        """ The graph as a SciPy sparse matrix."""
+        if self._graph is None:
+            self._graph = csr_matrix((self.weights, self.indices, \
+                    self.indptr), shape=(self.count, self.count))
+        return self._graph
+
+    def search(self, source, targets=None):
+        """ Cost distance from node source to every node, and the previous
+            node on the path to each, or -1. The pure Python search stops
+            once all targets are reached, if given."""
+        if csr_matrix is not None:
+            (dist, pred) = dijkstra(self.graph(), indices=source, \
+                    return_predecessors=True)
+            pred[pred < 0] = -1
+            return (dist, pred)
+        if self._lists is None:
+            # plain lists are much faster to index from Python than arrays.
+            self._lists = (self.indptr.tolist(), self.indices.tolist(), \
+                    self.weights.tolist())
+        return _dijkstra(self._lists, self.count, source, targets)
+
+    def trace(self, pred, target):
+        """ Nodes on the path to a reachable target, from the source of
+            a search, given the search's predecessors."""
+        path = [target]
+        while pred[path[-1]] >= 0:
+            path.append(pred[path[-1]])
+        path.reverse()
+        return numpy.array(path, dtype=numpy.intp)
+
+    def centers(self, nodes):
+        """ Coordinates of the centers of the cells of nodes."""
+        cells = self.cells[nodes]
+        (rows, cols) = divmod(cells, self.shape[1])
+        return (self.x_min + (cols + 0.5) * self.cell_width, \
+                self.y_max - (rows + 0.5) * self.cell_height)
+
+    def locate(self, xs, ys):
+        """ Node of the cell holding each point, given in the raster's
+            coordinates. Points on uncrossable cells or outside the raster
+            are moved to the nearest crossable cell. Returns the nodes, and
+            which points were moved."""
+        rows = (self.y_max - numpy.asarray(ys, dtype=numpy.float64)) / \
+                self.cell_height
+        cols = (numpy.asarray(xs, dtype=numpy.float64) - self.x_min) / \
+                self.cell_width
+        (row_count, col_count) = self.shape
+        (row_cells, col_cells) = (numpy.floor(rows), numpy.floor(cols))
+        inside = (row_cells >= 0) & (row_cells < row_count) & \
+                (col_cells >= 0) & (col_cells < col_count)
+        nodes = -numpy.ones(len(rows), dtype=numpy.intp)
+        cells = (row_cells * col_count + col_cells)[inside].astype(numpy.intp)
+        nodes[inside] = self.node_of[cells]
+
+        moved = nodes < 0
+        if moved.any() and self.count > 0:
+            tree = self._cell_tree()
+            for i in numpy.flatnonzero(moved):
+                (dist, pos) = tree.query([rows[i] - 0.5, cols[i] - 0.5], 1)
+                nodes[i] = numpy.atleast_1d(pos)[0]
+        return (nodes, moved)
+
+    def _cell_tree(self):
+        """ A k-d tree over the (row, col) positions of the nodes."""
+        if self._tree is None:
+            (rows, cols) = divmod(self.cells, self.shape[1])
+            positions = numpy.column_stack((rows, cols)).astype(numpy.float64)
+            if spatial_index.cKDTree is not None:
+                self._tree = spatial_index.cKDTree(positions)
+            else:
+                self._tree = spatial_index.KDTree(positions)
+        return self._tree
+
+    def __getstate__(self):
+        # workers rebuild the caches they need.
+        state = self.__dict__.copy()
+        state.update(_graph=None, _lists=None, _tree=None)
+        return state
+
+def _dijkstra(lists, count, source, targets=None):
+    """ Heap-based Dijkstra search over the graph in CSR layout."""
+    (indptr, indices, weights) = lists
+    dist = [float('inf')] * count
+    pred = [-1] * count
+    done = [False] * count
+    remaining = set(targets) if targets is not None else None
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        (d, u) = heapq.heappop(heap)
+        if done[u]:
+            continue
+        done[u] = True
+        if remaining is not None:
+            remaining.discard(u)
+            if not remaining:
+                break
+        for e in range(indptr[u], indptr[u + 1]):
+            v = indices[e]
+            alt = d + weights[e]
+            if alt < dist[v]:
+                dist[v] = alt
+                pred[v] = u
+                heapq.heappush(heap, (alt, v))
+    return (numpy.array(dist), numpy.array(pred, dtype=numpy.intp))
+
+# per-process state for pool workers, set up once by _init_worker.
+_worker = {}
+
+def _init_worker(surface):
+    _worker['surface'] = surface
+
+def _search_worker(task):
+    return _search(_worker['surface'], *task)
+
+def _search(surface, position, source, targets, path_targets=None):
+    """ Distances from one source to all targets, and optionally the
+        paths to path_targets."""
+    wanted = targets
+    if path_targets is not None:
+        wanted = numpy.union1d(targets, path_targets)
+    (dist, pred) = surface.search(source, wanted.tolist())
+    paths = None
+    if path_targets is not None:
+        paths = [surface.trace(pred, t) if numpy.isfinite(dist[t]) else None \
+                for t in numpy.asarray(path_targets).tolist()]
+    return (position, dist[targets], paths)
+
+def search_rows(surface, sources, targets, path_targets=None, workers=1, \
+        progress=None):
+    """
+    Search once from each of the source nodes, yielding tuples of (source
+    position, distances to each of the target nodes, paths). With
+    path_targets, a sequence of target nodes per source, paths holds the
+    nodes along the path to each of them, otherwise None. Results arrive in
+    completion order when running across several workers.
+    """
+    sources = numpy.asarray(sources, dtype=numpy.intp)
+    targets = numpy.asarray(targets, dtype=numpy.intp)
+    total = len(sources)
+    tasks = ((i, source, targets, None if path_targets is None else \
+            numpy.asarray(path_targets[i], dtype=numpy.intp)) \
+            for (i, source) in enumerate(sources.tolist()))
+    if workers > 1 and total > 1:
+        pool = multiprocessing.Pool(min(workers, total), _init_worker, \
+                (surface,))
+        try:
+            results = pool.imap_unordered(_search_worker, tasks)
+            for (i, result) in enumerate(results):
+                if progress is not None:
+                    progress(i + 1, total)
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for (i, task) in enumerate(tasks):
+            result = _search(surface, *task)
+            if progress is not None:
+                progress(i + 1, total)
+            yield result
@@ -0,0 +1,160 @@
+# dates.py: fast parsing of date columns
+# -*- coding: utf-8 -*-
+
+"""
+Parses whole columns of date strings at once. Each distinct string is only
+parsed once. The layout of the column is inferred from a sample of its
+values, and every string matching that layout is split into its parts with
+a compiled regular expression and converted to datetime64 in a few array
+operations. Only strings which don't fit the layout are handed to
+dateutil, and those it can't parse either are reported back rather than
+stopping the import.
+"""
+
+import datetime
+import re
+
+import numpy
+
+try:
+    import dateutil.parser
+except ImportError:
+    dateutil = None
+
+# number of distinct values used to infer a column's layout.
+SAMPLE_SIZE = 100
+# date layouts we can parse directly, as a pattern and the date part held
+# by each of its groups.
+LAYOUTS = [
+    # 2006-3-18T16:48, 2006-03-18 16:48:05
+    ('iso', re.compile(r'^\s*(\d{4})-(\d{1,2})-(\d{1,2})' \
+            r'(?:[T ](\d{1,2}):(\d{2})(?::(\d{2})(?:\.\d*)?)?)?\s*$'), \
+            ('year', 'month', 'day', 'hour', 'minute', 'second')),
+    # 03/18/2006, 3/18/06 16:48:05; month first, as dateutil reads them
+    ('us', re.compile(r'^\s*(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})' \
+            r'(?:\s+(\d{1,2}):(\d{2})(?::(\d{2}))?)?\s*$'), \
+            ('month', 'day', 'year', 'hour', 'minute', 'second')),
+    # 2006/03/18 16:48
+    ('ymd', re.compile(r'^\s*(\d{4})/(\d{1,2})/(\d{1,2})' \
+            r'(?:\s+(\d{1,2}):(\d{2})(?::(\d{2}))?)?\s*$'), \
+            ('year', 'month', 'day', 'hour', 'minute', 'second')),
+]
+PARTS = ('year', 'month', 'day', 'hour', 'minute', 'second')
+
+def infer_layout(values, sample_size=SAMPLE_SIZE):
+    """ The layout which matches the most of a sample of values, or None
+        if none of them match."""
+    sample = [v for v in values[:sample_size] if v]
+    best = (0, None)
+    for layout in LAYOUTS:
+        matches = sum(1 for v in sample if layout[1].match(v))
+        if matches > best[0]:
+            best = (matches, layout)
+    return best[1]
+
+def split_parts(values, layout):
+    """ The date parts of each value matching layout, as an array with a
+        column per part, and a mask of the values which matched."""
+    (name, pattern, order) = layout
+    parts = numpy.zeros((len(values), len(PARTS)), dtype=numpy.int64)
+    matched = numpy.zeros(len(values), dtype=bool)
+    positions = [PARTS.index(part) for part in order]
+    year = PARTS.index('year')
+    for (i, value) in enumerate(values):
+        match = pattern.match(value)
+        if match is not None:
+            matched[i] = True
+            for (pos, group) in zip(positions, match.groups()):
+                if group is not None:
+                    parts[i, pos] = int(group)
+                    if pos == year and len(group) == 2:
+                        parts[i, pos] = full_year(parts[i, pos])
+    return (parts, matched)
+
+def full_year(year, today=None):
+    """ A two digit year in the century which puts it within 50 years of
+        today, as dateutil does."""
+    this_year = (today or datetime.date.today()).year
+    year += this_year // 100 * 100
+    if year >= this_year + 50:
+        year -= 100
+    elif year < this_year - 50:
+        year += 100
+    return year
+
+def parts_to_dates(parts):
+    """ Rows of (year, month, day, hour, minute, second) as datetime64
+        values, and a mask of the rows which aren't valid dates."""
+    (year, month, day, hour, minute, second) = parts.T
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (hour < 24) & \
+            (minute < 60) & (second < 60) & (year >= 1)
+    months = (year - 1970) * 12 + numpy.clip(month, 1, 12) - 1
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]')
+    next_month = (months + 1).astype('datetime64[M]').astype('datetime64[D]')
+    month_length = (next_month - month_start).astype(numpy.int64)
+    valid &= day <= month_length
+
+    seconds = hour * 3600 + minute * 60 + second
+    dates = month_start.astype('datetime64[s]') + \
+            ((day - 1) * 86400 + seconds).astype('timedelta64[s]')
+    return (dates, ~valid)
+
+def parse_fallback(value):
+    """ Parse a single value with dateutil, or None if it can't be."""
+    if dateutil is None:
+        return None
+    try:
+        date = dateutil.parser.parse(value)
+        return numpy.datetime64(date.replace(tzinfo=None, microsecond=0), 's')
+    except (ValueError, OverflowError, TypeError):
+        return None
+
+def parse_dates(values, sample_size=SAMPLE_SIZE):
+    """
+    Parse a column of date strings. Returns the dates as datetime64 values
+    to the second, and a mask of the values which couldn't be parsed; empty
+    values are always unparsed.
+    """
+    values = numpy.asarray(values)
+    if len(values) == 0:
+        return (numpy.zeros(0, dtype='datetime64[s]'), \
+                numpy.zeros(0, dtype=bool))
+    # parse each distinct value once.
+    (unique, inverse) = numpy.unique(values, return_inverse=True)
+    unique = unique.tolist()
+
+    dates = numpy.zeros(len(unique), dtype='datetime64[s]')
+    failed = numpy.ones(len(unique), dtype=bool)
+    # try the inferred layout first, then the others on what's left.
+    layout = infer_layout(unique, sample_size)
+    layouts = sorted(LAYOUTS, key=lambda l: l is not layout)
+    for layout in layouts:
+        remaining = numpy.flatnonzero(failed)
+        if len(remaining) == 0:
+            break
+        (parts, matched) = split_parts([unique[i] for i in remaining], layout)
+        (parsed, invalid) = parts_to_dates(parts[matched])
+        dates[remaining[matched]] = parsed
+        failed[remaining[matched]] = invalid
+
+    # anything the layout didn't fit goes to dateutil.
+    for i in numpy.flatnonzero(failed).tolist():
+        if unique[i]:
+            date = parse_fallback(unique[i])
+            if date is not None:
+                dates[i] = date
+                failed[i] = False
+    return (dates[inverse], failed[inverse])
+
+def describe_failures(values, failed, limit=10, first_row=1):
+    """ A message listing the rows, numbered from first_row, which couldn't
+        be parsed, or None if all of them were."""
+    rows = numpy.flatnonzero(failed)
+    if len(rows) == 0:
+        return None
+    shown = ", ".join("{0} (`{1}`)".format(i + first_row, values[i]) \
+            for i in rows[:limit].tolist())
+    more = " and {0} more".format(len(rows) - limit) \
+            if len(rows) > limit else ""
+    return "{0} dates couldn't be parsed and were left empty, in " \
+            "rows {1}{2}.".format(len(rows), shown, more)
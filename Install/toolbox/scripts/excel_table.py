@@ -0,0 +1,212 @@
+# excel_table.py: read the rows of Excel workbooks as text
+# -*- coding: utf-8 -*-
+
+"""
+Reads the first sheet of an Excel workbook as rows of text values, the way
+the csv module reads a text table, so workbooks go through the same
+validation and import steps as CSV files.
+
+.xlsx workbooks are zipped XML, and their sheet is parsed incrementally
+with iterparse, one row at a time, so memory use doesn't grow with the
+size of the sheet. Legacy .xls workbooks need the xlrd library, included
+with ArcGIS 10.2+.
+
+Values are written as they'd appear in a CSV export: whole numbers without
+a decimal point, dates and times as ISO 8601 (2006-03-18T16:48:00), and
+text encoded as UTF-8.
+"""
+
+import datetime
+import posixpath
+import re
+import zipfile
+import xml.etree.cElementTree as et
+
+# XML namespaces of the parts of an .xlsx workbook.
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+# built in number formats which hold dates and times.
+DATE_FORMAT_IDS = set(range(14, 23) + range(45, 48))
+# day 0 of Excel's date serials, allowing for its 1900 leap year bug.
+EPOCH = datetime.datetime(1899, 12, 30)
+
+def tag(name, ns=MAIN_NS):
+    return '{%s}%s' % (ns, name)
+
+def text_value(value):
+    """ A cell value as it would be written to a text table."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def serial_date(serial):
+    """ An Excel date serial as a datetime, to the nearest second."""
+    date = EPOCH + datetime.timedelta(days=float(serial))
+    # drop the fractions of a second left by floating point serials.
+    return (date + datetime.timedelta(microseconds=500000)).replace( \
+            microsecond=0)
+
+def date_text(date):
+    """ A datetime, without fractions of a second, as ISO 8601 text."""
+    return date.isoformat()
+
+def column_index(reference):
+    """ The 0-based column of a cell reference, e.g. 2 for C7."""
+    index = 0
+    for c in re.match('[A-Z]+', reference.upper()).group(0):
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index - 1
+
+def is_date_format(code):
+    """ Whether a custom number format displays a date or time."""
+    # ignore quoted text, escaped characters and colors, e.g. [Red].
+    code = re.sub(r'"[^"]*"|\\.|\[[^\]]*\]', '', code)
+    return re.search('[dmyhs]', code, re.IGNORECASE) is not None
+
+def first_sheet(workbook):
+    """ The path within an .xlsx file of its first sheet."""
+    with workbook.open('xl/workbook.xml') as f:
+        sheets = et.parse(f).getroot().find(tag('sheets'))
+    rel_id = sheets[0].get(tag('id', REL_NS))
+    with workbook.open('xl/_rels/workbook.xml.rels') as f:
+        for rel in et.parse(f).getroot().findall(tag('Relationship', \
+                PACKAGE_NS)):
+            if rel.get('Id') == rel_id:
+                target = rel.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/')
+                return posixpath.normpath(posixpath.join('xl', target))
+    return 'xl/worksheets/sheet1.xml'
+
+def string_text(elem):
+    """ The text of a shared or inline string, as UTF-8."""
+    # rich text is split into runs; join their text, leaving out phonetic
+    # readings (rPh), which have text of their own.
+    text = [child if child.tag == tag('t') else child.find(tag('t')) \
+            for child in elem if child.tag in (tag('t'), tag('r'))]
+    return u''.join(t.text or u'' for t in text if t is not None) \
+            .encode('utf-8')
+
+def shared_strings(workbook):
+    """ The workbook's table of shared strings, as UTF-8."""
+    if 'xl/sharedStrings.xml' not in workbook.namelist():
+        return []
+    strings = []
+    with workbook.open('xl/sharedStrings.xml') as f:
+        for (event, elem) in et.iterparse(f):
+            if elem.tag == tag('si'):
+                strings.append(string_text(elem))
+                elem.clear()
+    return strings
+
+def date_styles(workbook):
+    """ Indexes of the cell styles which format numbers as dates."""
+    if 'xl/styles.xml' not in workbook.namelist():
+        return set()
+    with workbook.open('xl/styles.xml') as f:
+        root = et.parse(f).getroot()
+    date_formats = set(DATE_FORMAT_IDS)
+    formats = root.find(tag('numFmts'))
+    for fmt in (formats if formats is not None else []):
+        if is_date_format(fmt.get('formatCode', '')):
+            date_formats.add(int(fmt.get('numFmtId')))
+    styles = root.find(tag('cellXfs'))
+    return set(i for (i, xf) in enumerate(styles if styles is not None else []) \
+            if int(xf.get('numFmtId', 0)) in date_formats)
+
+def cell_text(cell, strings, dates):
+    """ The text of a cell of an .xlsx sheet."""
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        inline = cell.find(tag('is'))
+        return string_text(inline) if inline is not None else ''
+    value = cell.find(tag('v'))
+    if value is None or value.text is None:
+        return ''
+    value = value.text
+    if cell_type == 's':
+        return strings[int(value)]
+    if cell_type == 'b':
+        return 'TRUE' if value == '1' else 'FALSE'
+    if cell_type == 'n':
+        if int(cell.get('s', 0)) in dates:
+            return date_text(serial_date(value))
+        return text_value(float(value))
+    # formula results and errors are kept as they are.
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def xlsx_rows(input_file):
+    """ Rows of text values from the first sheet of an .xlsx workbook,
+        parsed as they're read."""
+    with zipfile.ZipFile(input_file) as workbook:
+        strings = shared_strings(workbook)
+        dates = date_styles(workbook)
+        with workbook.open(first_sheet(workbook)) as sheet:
+            position = 0
+            sheet_data = None
+            for (event, elem) in et.iterparse(sheet, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == tag('sheetData'):
+                        sheet_data = elem
+                    continue
+                if elem.tag != tag('row'):
+                    continue
+                # empty rows are left out of the sheet; keep their place.
+                number = int(elem.get('r', position + 1))
+                for i in range(position + 1, number):
+                    yield []
+                position = number
+                row = []
+                for cell in elem.findall(tag('c')):
+                    reference = cell.get('r')
+                    if reference is not None:
+                        # empty cells are left out too.
+                        row += [''] * (column_index(reference) - len(row))
+                    row.append(cell_text(cell, strings, dates))
+                # drop the row from the parsed tree, not just its cells.
+                elem.clear()
+                if sheet_data is not None:
+                    sheet_data.remove(elem)
+                yield row
+
+def xls_rows(input_file):
+    """ Rows of text values from the first sheet of an .xls workbook."""
+    try:
+        import xlrd
+    except ImportError:
+        raise ImportError("Reading .xls files requires the xlrd library, " \
+                "which is included in ArcGIS 10.2+.")
+    book = xlrd.open_workbook(input_file, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(i):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    date = xlrd.xldate_as_tuple(cell.value, book.datemode)
+                    row.append(date_text(datetime.datetime(*date)))
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(text_value(bool(cell.value)))
+                elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, \
+                        xlrd.XL_CELL_ERROR):
+                    row.append('')
+                else:
+                    row.append(text_value(cell.value))
+            yield row
+    finally:
+        book.release_resources()
+
+def sheet_rows(input_file):
+    """ Rows of text values from the first sheet of a workbook."""
+    if input_file.lower().endswith('.xlsx'):
+        return xlsx_rows(input_file)
+    return xls_rows(input_file)
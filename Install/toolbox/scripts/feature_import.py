@@ -0,0 +1,264 @@
+# feature_import.py: import SRGD files as point features in one step
+# -*- coding: utf-8 -*-
+
+"""
+Parses an SRGD file, compressed or not, straight into a typed NumPy
+structured array and writes it out with a single NumPyArrayToFeatureClass
+call, appended to a point feature class. This replaces the chain of TableToTable,
+AddField and CalculateField for the formatted date, MakeXYEventLayer and
+CopyFeatures, each of which rewrote the whole table.
+
+The output matches those steps: columns use the types TableToTable would
+pick, with protected columns forced to their configured type; the parsed
+Date_Time column is added as Date_formatted; and points are placed at the
+location columns. NumPy arrays can't hold nulls, so empty values are
+written as placeholders and nulled in a single update pass over just the
+affected columns. Text fields are created at a fixed length, as for
+table_import, so rows appended by append_import are never truncated.
+
+Features are written CHUNK_SIZE rows at a time, so only one chunk is ever
+held as typed values. Small uncompressed files are read whole, with column
+types from their values; anything else is streamed from the file a chunk
+at a time, with column types from a scan of the whole file (see
+table_schema), so memory use is bounded by the chunk size.
+"""
+
+import os
+
+import arcpy
+import numpy
+
+import dates
+import table_import
+import table_schema
+import utils
+
+# the input date column, and the date field added from it.
+DATE_COLUMN = 'Date_Time'
+DATE_FIELD = 'Date_formatted'
+# features are written here before they're appended to the output.
+CHUNK_FC = 'in_memory/feature_import_chunk'
+# uncompressed text files up to this many bytes are read into memory whole.
+ARRAY_LIMIT = 2 ** 26
+
+def fits_in_memory(input_file):
+    """ Whether an input is small enough to be read whole: uncompressed
+        text of at most ARRAY_LIMIT bytes. Workbooks are compressed."""
+    try:
+        is_text = utils.file_type(input_file) == 'Text'
+    except utils.UnknownType:
+        is_text = True
+    return is_text and utils.compression(input_file) is None and \
+            os.path.getsize(input_file) <= ARRAY_LIMIT
+
+def read_chunks(input_file, chunk_size=table_import.CHUNK_SIZE):
+    """ The validated header of a text table or workbook, and its values in
+        chunks of chunk_size rows, each as one array of byte strings per
+        column. Read as the chunks are needed."""
+    with utils.read_table(input_file) as (header, table, dialect):
+        header = utils.validate_header(header)
+        width = len(header)
+        for chunk in table_import.chunks(table, chunk_size):
+            # pad short rows, as TableToTable does.
+            chunk = [row[:width] + [''] * (width - len(row)) for row in chunk]
+            yield (header, [numpy.array(values, dtype=str) \
+                    for values in zip(*chunk)])
+
+def read_header(input_file):
+    """ The validated header of a text table or workbook."""
+    (header, sample, dialect) = utils.table_header(input_file, 0)
+    return utils.validate_header(header)
+
+def read_columns(input_file, chunk_size=table_import.CHUNK_SIZE):
+    """ The validated header of a text table or workbook, and its values as
+        one array of byte strings per column, built up chunk by chunk."""
+    header = read_header(input_file)
+    parts = [[] for col in header]
+    for (header, columns) in read_chunks(input_file, chunk_size):
+        for (part, values) in zip(parts, columns):
+            part.append(values)
+    columns = [numpy.concatenate(p) if p else numpy.zeros(0, dtype=str) \
+            for p in parts]
+    return (header, columns)
+
+def column_chunks(header, columns, chunk_size=table_import.CHUNK_SIZE):
+    """ Columns held in memory, in chunks of chunk_size rows as read by
+        read_chunks."""
+    count = len(columns[0]) if columns else 0
+    for start in range(0, count, chunk_size):
+        yield (header, [values[start:start + chunk_size] \
+                for values in columns])
+
+def column_type(values):
+    """ The field type TableToTable would pick for a column of values."""
+    present = values[values != '']
+    if len(present) == 0:
+        return 'TEXT'
+    try:
+        numbers = present.astype(numpy.int64)
+        (low, high) = table_import.LONG_RANGE
+        if numbers.min() >= low and numbers.max() <= high:
+            return 'LONG'
+        return 'DOUBLE'
+    except (ValueError, OverflowError):
+        pass
+    try:
+        present.astype(numpy.float64)
+        return 'DOUBLE'
+    except ValueError:
+        return 'TEXT'
+
+def schema_field_types(types, schema):
+    """ Field types with those of the columns in schema, of label to
+        (1-based position, schema.ini type), replaced by its types."""
+    types = list(types)
+    for (idx, data_type) in (schema or {}).values():
+        if 0 < idx <= len(types):
+            types[idx - 1] = table_import.FIELD_TYPES.get( \
+                    data_type.lower(), 'TEXT')
+    return types
+
+def column_types(header, columns, protected_map=None):
+    """ Field types of each column; protected columns, given as label to
+        (1-based position, schema.ini type), keep their configured type."""
+    return schema_field_types([column_type(values) for values in columns], \
+            protected_map)
+
+def decode(values):
+    """ Byte strings as unicode, reading them as UTF-8 where possible."""
+    if len(values) == 0:
+        # numpy.char gives empty arrays of floats.
+        return values.astype(unicode)
+    try:
+        return numpy.char.decode(values, 'utf-8')
+    except UnicodeDecodeError:
+        return numpy.char.decode(values, 'latin-1')
+
+def typed_columns(header, columns, types, first_row=1):
+    """ Columns converted to their field types, and a mask of the empty
+        values in each. first_row numbers the first row in messages."""
+    (typed, missing) = ([], [])
+    for (values, field_type) in zip(columns, types):
+        empty = values == ''
+        if field_type == 'LONG':
+            filled = numpy.where(empty, '0', values)
+            typed.append(filled.astype(numpy.int32))
+        elif field_type == 'DOUBLE':
+            filled = numpy.where(empty, 'nan', values)
+            typed.append(filled.astype(numpy.float64))
+        else:
+            typed.append(decode(values))
+        missing.append(empty)
+
+    if DATE_COLUMN in header and DATE_FIELD not in header:
+        values = columns[header.index(DATE_COLUMN)]
+        (parsed, failed) = dates.parse_dates(values)
+        # report dates we couldn't read, but import them anyway.
+        failures = dates.describe_failures(values, failed & (values != ''), \
+                first_row=first_row)
+        if failures is not None:
+            utils.msg(failures, mtype='warning')
+        header = header + [DATE_FIELD]
+        typed.append(parsed)
+        missing.append(failed)
+    return (header, typed, missing)
+
+def structured_array(header, typed):
+    """ A structured array with a field per column."""
+    count = len(typed[0]) if typed else 0
+    array = numpy.empty(count, dtype=[(str(label), values.dtype) \
+            for (label, values) in zip(header, typed)])
+    for (label, values) in zip(header, typed):
+        array[str(label)] = values
+    return array
+
+def field_type(values):
+    """ The geodatabase field type NumPyArrayToFeatureClass gives an array."""
+    if values.dtype.kind in 'iu':
+        return 'LONG'
+    if values.dtype.kind == 'f':
+        return 'DOUBLE'
+    if values.dtype.kind == 'M':
+        return 'DATE'
+    return 'TEXT'
+
+def create_features(output_fc, header, typed, sr=None):
+    """ An empty point feature class with a field per typed column. Text
+        fields are as long as table_import makes them, rather than the
+        longest value at hand, so that rows appended later still fit."""
+    (workspace, name) = os.path.split(output_fc)
+    arcpy.CreateFeatureclass_management(workspace, name, 'POINT', \
+            spatial_reference=sr)
+    for (label, values) in zip(header, typed):
+        f_type = field_type(values)
+        length = table_import.TEXT_LENGTH if f_type == 'TEXT' else None
+        arcpy.AddField_management(output_fc, label, f_type, \
+                field_length=length)
+
+def set_nulls(output_fc, header, missing):
+    """ Replace the placeholders written for empty values with nulls, in
+        one pass over the columns which have any."""
+    fields = [label for (label, empty) in zip(header, missing) if empty.any()]
+    if not fields:
+        return
+    masks = [missing[header.index(label)] for label in fields]
+    with arcpy.da.UpdateCursor(output_fc, fields) as cursor:
+        # features are written in array order.
+        for (i, row) in enumerate(cursor):
+            if any(mask[i] for mask in masks):
+                cursor.updateRow([None if mask[i] else value for \
+                        (mask, value) in zip(masks, row)])
+
+def import_features(input_file, output_fc, x, y, sr=None, \
+        protected_map=None, chunks=None):
+    """
+    Import a text table as a point feature class, placing features at the
+    x and y columns, streaming it a chunk at a time. Column types come from
+    a scan of the whole file, keeping those in protected_map. chunks, if
+    given, are the file's chunks as read by read_chunks, e.g. passed
+    through something which looks at them on the way. Returns the number of
+    features written.
+    """
+    header = read_header(input_file)
+    types = schema_field_types(['TEXT'] * len(header), \
+            table_schema.protected_schema(input_file, protected_map))
+    if chunks is None:
+        chunks = read_chunks(input_file)
+    return write_chunks(header, chunks, types, output_fc, x, y, sr)
+
+def import_columns(header, columns, output_fc, x, y, sr=None, \
+        protected_map=None, chunk_size=table_import.CHUNK_SIZE):
+    """ Write columns of text values, as returned by read_columns, out as a
+        point feature class a chunk at a time; see import_features."""
+    types = column_types(header, columns, protected_map)
+    return write_chunks(header, column_chunks(header, columns, chunk_size), \
+            types, output_fc, x, y, sr)
+
+def write_chunks(header, chunks, types, output_fc, x, y, sr=None):
+    """ Write chunks of columns, as given by read_chunks, out as a point
+        feature class with fields of the given types. Returns the number of
+        features written."""
+    if isinstance(sr, basestring):
+        # spatial references arrive from the toolbox as strings.
+        spatial_reference = arcpy.SpatialReference()
+        spatial_reference.loadFromString(sr)
+        sr = spatial_reference
+    # fields are typed from an empty chunk, so that an input without any
+    # rows still gets them.
+    empty = [numpy.zeros(0, dtype=str) for label in header]
+    (fields, typed, missing) = typed_columns(header, empty, types)
+    create_features(output_fc, fields, typed, sr)
+    count = 0
+    for (header, columns) in chunks:
+        (fields, typed, missing) = typed_columns(header, columns, types, \
+                count + 1)
+        array = structured_array(fields, typed)
+        arcpy.da.NumPyArrayToFeatureClass(array, CHUNK_FC, \
+                (str(x), str(y)), sr)
+        try:
+            set_nulls(CHUNK_FC, fields, missing)
+            arcpy.Append_management(CHUNK_FC, output_fc, 'NO_TEST')
+        finally:
+            arcpy.Delete_management(CHUNK_FC)
+        count += len(array)
+    return count
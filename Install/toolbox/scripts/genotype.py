@@ -0,0 +1,188 @@
+# genotype.py: genotypes as arrays, shared by the exporters
+# -*- coding: utf-8 -*-
+
+"""
+Reads the loci of every selected individual in a single cursor pass into an
+int32 array of shape (individuals, loci, ploidy), along with their ID,
+population and coordinate columns. Exporters format whole columns of the
+array at once, rather than looking up fields allele by allele.
+
+Missing alleles are stored as 0, which is how every export format writes
+them. Calls which aren't allele codes, such as typos like 18O, are treated
+as missing too, and reported by field and individual rather than stopping
+the export. Loci with fewer columns than the highest ploidy are padded
+with 0, and `ploidy` records how many columns each locus really has.
+
+Matrices are cached per feature class and query, and rebuilt when the
+source data changes; see utils.dataset_signature.
+"""
+
+import collections
+
+import arcpy
+import numpy
+
+import utils
+
+# number of genotype matrices to keep in memory.
+CACHE_SIZE = 4
+# largest allele code the matrix holds.
+MAX_ALLELE = numpy.iinfo(numpy.int32).max
+# invalid calls listed in the warning; the rest are only counted.
+INVALID_SHOWN = 10
+_cache = collections.OrderedDict()
+
+class GenotypeMatrix(object):
+    """ Genotypes and descriptive columns for a set of individuals."""
+
+    def __init__(self, loci, ids, alleles, populations=None, coords=None, \
+            extra=None):
+        self.loci = loci
+        self.names = loci.names
+        self.ploidy = [len(cols) for cols in loci.fields.values()]
+        self.ids = ids
+        self.alleles = alleles
+        self.populations = populations
+        self.coords = coords
+        self.extra = extra if extra is not None else \
+                collections.OrderedDict()
+        self.count = len(ids)
+
+    def population_counts(self):
+        """ Number of individuals per population, in order of appearance."""
+        counts = collections.OrderedDict()
+        for pop in self.populations:
+            counts[pop] = counts.get(pop, 0) + 1
+        return counts
+
+    def allele_columns(self):
+        """ Alleles as a 2D array, one column per loci field."""
+        columns = [self.alleles[:, i, :p] for (i, p) in enumerate(self.ploidy)]
+        if not columns:
+            return numpy.zeros((self.count, 0), dtype=self.alleles.dtype)
+        return numpy.concatenate(columns, axis=1)
+
+    def allele_strings(self, missing='0'):
+        """ Alleles as strings, with missing alleles written as `missing`."""
+        strings = self.alleles.astype(str)
+        return numpy.where(self.alleles == 0, missing, strings)
+
+    def locus_strings(self, sep=' ', missing='0'):
+        """ Rows of genotype strings, one per locus, each joining the
+            locus' alleles with sep."""
+        strings = self.allele_strings(missing)
+        columns = []
+        for (i, ploidy) in enumerate(self.ploidy):
+            column = strings[:, i, 0]
+            for k in range(1, ploidy):
+                column = numpy.char.add(numpy.char.add(column, sep), \
+                        strings[:, i, k])
+            columns.append(column)
+        if not columns:
+            return [[] for i in range(self.count)]
+        return numpy.column_stack(columns).tolist()
+
+def allele_codes(values):
+    """ Allele codes of a column of field values, with missing and invalid
+        calls as 0, and the positions of the invalid calls."""
+    codes = []
+    invalid = []
+    for (i, v) in enumerate(values):
+        if v is None or v == '':
+            codes.append(0)
+            continue
+        try:
+            code = float(v)
+            if code != int(code) or code < 0 or code > MAX_ALLELE:
+                raise ValueError(v)
+            codes.append(int(code))
+        except (ValueError, OverflowError):
+            codes.append(0)
+            invalid.append(i)
+    return (numpy.array(codes, dtype=numpy.int32), invalid)
+
+def read_genotypes(input_features, loci, id_field, order_by=None, \
+        where_clause=None, coord_fields=None, extra_fields=None):
+    """ Build a GenotypeMatrix with a single SearchCursor over the input."""
+    coord_fields = list(coord_fields or [])
+    extra_fields = list(extra_fields or [])
+    fields = [id_field]
+    if order_by:
+        fields.append(order_by)
+        # sql clause can be prefix or suffix; set up ORDER BY
+        sql_clause = (None, "ORDER BY {0} ASC".format(order_by))
+    else:
+        sql_clause = (None, None)
+    fields += coord_fields + extra_fields + loci.columns
+
+    with arcpy.da.SearchCursor(input_features, fields, where_clause, \
+            "", "", sql_clause) as cursor:
+        rows = [row for row in cursor]
+    columns = zip(*rows) if rows else [()] * len(fields)
+    count = len(rows)
+
+    ids = list(columns[0])
+    position = 1
+    populations = None
+    if order_by:
+        populations = list(columns[position])
+        position += 1
+    coords = None
+    if coord_fields:
+        coords = [list(c) for c in columns[position:position + len(coord_fields)]]
+        position += len(coord_fields)
+    extra = collections.OrderedDict()
+    for field in extra_fields:
+        extra[field] = list(columns[position])
+        position += 1
+
+    max_ploidy = max([len(cols) for cols in loci.fields.values()] or [0])
+    alleles = numpy.zeros((count, loci.count, max_ploidy), dtype=numpy.int32)
+    invalid = []
+    for (i, cols) in enumerate(loci.fields.values()):
+        for k in range(len(cols)):
+            (codes, bad) = allele_codes(columns[position])
+            invalid += [(cols[k], ids[j], columns[position][j]) for j in bad]
+            position += 1
+            alleles[:, i, k] = codes
+    if invalid:
+        shown = ", ".join(u"{0} of {1}: {2!r}".format(field, row_id, value) \
+                for (field, row_id, value) in invalid[:INVALID_SHOWN])
+        more = " and {0} more".format(len(invalid) - INVALID_SHOWN) \
+                if len(invalid) > INVALID_SHOWN else ""
+        utils.msg(u"{0} allele calls aren't allele codes, and were written " \
+                "as missing: {1}{2}.".format(len(invalid), shown, more), \
+                mtype='warning')
+    return GenotypeMatrix(loci, ids, alleles, populations, coords, extra)
+
+def genotype_matrix(input_features, id_field, order_by=None, \
+        where_clause=None, coord_fields=None, extra_fields=None, loci=None):
+    """
+    Genotypes of the rows of input_features matching where_clause, sorted
+    by the population field order_by when given. Reuses a cached matrix
+    when the same query was run against unchanged data.
+    """
+    if loci is None:
+        loci = utils.Loci(input_features)
+    key = (input_features, id_field, order_by, where_clause, \
+            tuple(coord_fields or []), tuple(extra_fields or []), \
+            tuple(loci.columns))
+    signature = utils.dataset_signature(input_features)
+    cached = _cache.get(key)
+    if signature is not None and cached is not None and \
+            cached[0] == signature:
+        return cached[1]
+
+    matrix = read_genotypes(input_features, loci, id_field, order_by, \
+            where_clause, coord_fields, extra_fields)
+    if signature is not None:
+        _cache.pop(key, None)
+        _cache[key] = (signature, matrix)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return matrix
+
+def invalidate(input_features):
+    """ Drop the cached matrices of input_features."""
+    for key in [k for k in _cache.keys() if k[0] == input_features]:
+        del _cache[key]
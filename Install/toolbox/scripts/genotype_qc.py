@@ -0,0 +1,318 @@
+# genotype_qc.py: check the allele columns of an input before it's imported
+# -*- coding: utf-8 -*-
+
+"""
+Checks the loci columns of an SRGD table, named as L_<locus>_<n>, for calls
+which SPAGeDi, Genepop and the other exporters would reject or misread:
+
+ - non-numeric alleles, which can't be written as allele codes;
+ - alleles whose number of digits is rare for their locus, usually a
+   dropped or repeated digit;
+ - partial genotypes, where only some of a locus' alleles were called;
+ - rare alleles, seen only a few times at a locus, often typing errors;
+ - the rate of missing data per sample and per locus.
+
+Each check runs over whole columns of a chunk at once, on the text columns
+read by feature_import.read_chunks, so it adds little to an import. Files
+are read twice, a chunk at a time: once to count the alleles of each locus
+and once to check each value against the counts, so memory use is bounded
+by the chunk size rather than the file size. The results are written as a
+JSON report next to the geodatabase, listing a summary of each locus, the
+samples with mostly missing data, and each problem found.
+"""
+
+import collections
+import json
+import os
+import re
+
+import numpy
+
+import feature_import
+import utils
+
+# bump when the layout of the report changes.
+REPORT_VERSION = 1
+# loci columns, as read by utils.Loci.
+LOCI_EXPR = '^l_(.*)_[0-9]+'
+# codes of missing alleles.
+MISSING_ALLELES = ('', '0')
+# allele lengths making up less than this share of a locus are suspect.
+LENGTH_SHARE = 0.05
+# alleles seen at most this many times, and making up less than
+# RARE_SHARE of their locus, are reported as rare.
+RARE_COUNT = 1
+RARE_SHARE = 0.01
+# samples missing more than this share of alleles are listed.
+MISSING_SHARE = 0.5
+# problems listed individually in the report; the rest are only counted.
+PROBLEM_LIMIT = 10000
+REPORT_SUFFIX = '_QC.json'
+
+def loci_columns(header):
+    """ Positions of the columns of each locus, by locus name."""
+    loci = collections.OrderedDict()
+    for (i, label) in enumerate(header):
+        match = re.match(LOCI_EXPR, label, re.IGNORECASE)
+        if match:
+            loci.setdefault(match.groups()[0], []).append(i)
+    return loci
+
+def report_path(output_fc):
+    """ Location of the report for output_fc, beside its geodatabase."""
+    folder = os.path.dirname(output_fc)
+    # reports can't be stored within a geodatabase; use its folder.
+    path = folder
+    while os.path.dirname(path) != path:
+        if path.lower().endswith('.gdb'):
+            folder = os.path.dirname(path)
+            break
+        path = os.path.dirname(path)
+    name = os.path.splitext(os.path.basename(output_fc))[0]
+    return os.path.join(folder, name + REPORT_SUFFIX)
+
+def value_counts(values):
+    """ The distinct values of an array, and how often each occurs."""
+    (distinct, inverse) = numpy.unique(values, return_inverse=True)
+    return (distinct, numpy.bincount(inverse, minlength=len(distinct)))
+
+def digit_counts(codes):
+    """ Number of digits of each allele code."""
+    return numpy.floor(numpy.log10(numpy.maximum(codes, 1))).astype( \
+            numpy.int64) + 1
+
+class Problems(object):
+    """ Problems found, counted by kind; only the first PROBLEM_LIMIT are
+        kept. Samples are named by those of the chunk being checked."""
+
+    def __init__(self, samples=()):
+        self.samples = samples
+        self.counts = collections.Counter()
+        self.found = []
+
+    def add(self, mask, column, values, problem):
+        """ Record a problem with each value selected by mask."""
+        rows = numpy.nonzero(mask)[0]
+        if len(rows):
+            self.counts[problem] += len(rows)
+        for i in rows[:max(PROBLEM_LIMIT - len(self.found), 0)].tolist():
+            self.found.append(collections.OrderedDict([
+                ('sample', self.samples[i]),
+                ('column', column),
+                ('value', values[i].decode('utf-8', 'replace')),
+                ('problem', problem)
+            ]))
+
+class Locus(object):
+    """ One locus, tallied a chunk of its columns at a time: a first pass
+        counts its alleles, and a second records the problems with them."""
+
+    def __init__(self, name, labels, positions):
+        self.name = name
+        self.labels = labels
+        self.positions = positions
+        self.alleles = collections.Counter()
+        self.lengths = collections.Counter()
+        self.count = 0
+        self.missing = 0
+        self.found = collections.Counter()
+
+    def calls(self, columns):
+        """ The locus' values in a chunk, with masks of which are missing,
+            numeric and bad, and their allele codes."""
+        values = [columns[i] for i in self.positions]
+        missing = [numpy.logical_or.reduce([v == code for code in \
+                MISSING_ALLELES]) for v in values]
+        numeric = [numpy.char.isdigit(v) & ~m for (v, m) in \
+                zip(values, missing)]
+        bad = [~n & ~m for (n, m) in zip(numeric, missing)]
+        codes = [numpy.where(n, v, '0').astype(numpy.int64) \
+                for (v, n) in zip(values, numeric)]
+        return (values, missing, numeric, bad, codes)
+
+    def tally(self, columns):
+        """ Count the alleles of a chunk. Returns which of its values are
+            missing; bad calls are as good as missing."""
+        (values, missing, numeric, bad, codes) = self.calls(columns)
+        alleles = numpy.concatenate([c[n] for (c, n) in zip(codes, numeric)])
+        for (counter, found) in ((self.alleles, alleles), \
+                (self.lengths, digit_counts(alleles))):
+            (distinct, counts) = value_counts(found)
+            counter.update(dict(zip(distinct.tolist(), counts.tolist())))
+        self.count += len(values[0])
+        self.missing += int((numpy.logical_or.reduce(missing) | \
+                numpy.logical_or.reduce(bad)).sum())
+        return [m | b for (m, b) in zip(missing, bad)]
+
+    def suspects(self):
+        """ Allele lengths and alleles too uncommon at this locus to trust,
+            once every chunk is tallied."""
+        total = sum(self.alleles.values())
+        self.odd_lengths = numpy.array([length for (length, n) in \
+                self.lengths.items() if n < LENGTH_SHARE * total], \
+                dtype=numpy.int64)
+        self.rare_alleles = numpy.array(sorted(allele for (allele, n) in \
+                self.alleles.items() if n <= RARE_COUNT and \
+                n < RARE_SHARE * total), dtype=numpy.int64)
+
+    def check(self, columns, problems):
+        """ Record the problems in a chunk of the locus' columns."""
+        (values, missing, numeric, bad, codes) = self.calls(columns)
+        before = problems.counts.copy()
+        for (label, v, c, n, b) in zip(self.labels, values, codes, numeric, \
+                bad):
+            problems.add(b, label, v, 'non-numeric')
+            problems.add(n & numpy.in1d(digit_counts(c), self.odd_lengths), \
+                    label, v, 'length')
+            problems.add(n & numpy.in1d(c, self.rare_alleles), label, v, \
+                    'rare')
+
+        any_bad = numpy.logical_or.reduce(bad)
+        any_missing = numpy.logical_or.reduce(missing)
+        # some, but not all, of the locus' alleles were called.
+        partial = any_missing & ~numpy.logical_and.reduce(missing) & ~any_bad
+        problems.add(partial, self.name, numpy.zeros(len(partial), \
+                dtype=str), 'partial')
+        self.found += problems.counts - before
+
+    def summary(self):
+        """ A summary of the locus, once every chunk is checked."""
+        alleles = sorted(self.alleles.keys())
+        lengths = sorted(self.lengths.items(), \
+                key=lambda (length, n): (-n, length))
+        return collections.OrderedDict([
+            ('locus', self.name),
+            ('columns', self.labels),
+            ('min', int(alleles[0]) if alleles else None),
+            ('max', int(alleles[-1]) if alleles else None),
+            ('alleles', len(alleles)),
+            ('digits', int(lengths[0][0]) if lengths else None),
+            ('missing_rate', self.missing / float(self.count) \
+                    if self.count else 0.0),
+            ('non_numeric', self.found['non-numeric']),
+            ('wrong_length', self.found['length']),
+            ('partial', self.found['partial']),
+            ('rare', self.found['rare']),
+            ('rare_alleles', self.rare_alleles.tolist())
+        ])
+
+def chunk_samples(header, columns, id_field, first_row):
+    """ The names of the samples in a chunk: their identifiers, or without
+        those, their row numbers counting from 1."""
+    if id_field in header:
+        return feature_import.decode(columns[header.index(id_field)]).tolist()
+    count = len(columns[0]) if columns else 0
+    return numpy.arange(first_row, first_row + count).astype(str).tolist()
+
+def check_chunks(header, chunks, id_field=None):
+    """
+    Check the loci columns of a table, given as its header and a function
+    returning its chunks as read by feature_import.read_chunks. The chunks
+    are read twice, first to count alleles, then to check each value
+    against the counts. Returns the report as a dictionary.
+    """
+    loci = [Locus(name, [header[i] for i in positions], positions) \
+            for (name, positions) in loci_columns(header).items()]
+    allele_columns = max(sum(len(locus.positions) for locus in loci), 1)
+
+    (count, missing_total, sparse) = (0, 0.0, [])
+    for (chunk_header, columns) in chunks():
+        rows = len(columns[0]) if columns else 0
+        missing = numpy.zeros(rows, dtype=numpy.int64)
+        for locus in loci:
+            for m in locus.tally(columns):
+                missing += m
+        rates = missing / float(allele_columns)
+        samples = chunk_samples(header, columns, id_field, count + 1)
+        sparse += [{'sample': samples[i], 'missing_rate': float(rates[i])} \
+                for i in numpy.nonzero(rates > MISSING_SHARE)[0].tolist()]
+        missing_total += rates.sum()
+        count += rows
+
+    for locus in loci:
+        locus.suspects()
+    problems = Problems()
+    checked = 0
+    if loci:
+        for (chunk_header, columns) in chunks():
+            problems.samples = chunk_samples(header, columns, id_field, \
+                    checked + 1)
+            for locus in loci:
+                locus.check(columns, problems)
+            checked += len(columns[0]) if columns else 0
+
+    return collections.OrderedDict([
+        ('version', REPORT_VERSION),
+        ('samples', count),
+        ('loci', len(loci)),
+        ('missing_rate', float(missing_total / count) if count else 0.0),
+        ('problem_counts', collections.OrderedDict( \
+                sorted(problems.counts.items()))),
+        ('loci_summary', [locus.summary() for locus in loci]),
+        ('samples_missing', sparse),
+        ('problems', problems.found)
+    ])
+
+def check_columns(header, columns, id_field=None):
+    """
+    Check the loci columns of a table, given as its header and one array
+    of text values per column. Returns the report as a dictionary.
+    """
+    return check_chunks(header, lambda: [(header, columns)], id_field)
+
+def describe(report, path=None):
+    """ A message summing up the problems in a report, or None."""
+    counts = report['problem_counts']
+    sparse = len(report['samples_missing'])
+    if not counts and not sparse:
+        return None
+    found = ["{0} {1}".format(n, problem) for (problem, n) in counts.items()]
+    if sparse:
+        found.append("{0} samples missing over {1:.0%} of alleles".format( \
+                sparse, MISSING_SHARE))
+    message = "Genotype checks found {0}.".format(", ".join(found))
+    if path is not None:
+        message += " See {0} for details.".format(path)
+    return message
+
+def write_report(report, path):
+    """ Write a report out as JSON."""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+def check_genotypes(header, columns, output_fc, id_field=None):
+    """ Check a table's genotypes and report on them next to the feature
+        class it's imported to. Returns the report, or None if the checks
+        couldn't be completed; they never stop an import."""
+    return report_chunks(header, lambda: [(header, columns)], output_fc, \
+            id_field)
+
+def report_chunks(header, chunks, output_fc, id_field=None):
+    """ Check a table's genotypes, given as chunks, and report on them; see
+        check_genotypes and check_chunks."""
+    try:
+        report = check_chunks(header, chunks, id_field)
+        if report['loci'] == 0:
+            return report
+        path = report_path(output_fc)
+        write_report(report, path)
+    except Exception as e:
+        utils.msg("Unable to check genotypes: {0}".format(e), \
+                mtype='warning')
+        return None
+    message = describe(report, path)
+    if message is not None:
+        utils.msg(message, mtype='warning')
+    return report
+
+def check_file(input_file, output_fc, id_field=None):
+    """ Check the genotypes of a text table or workbook, reading it a chunk
+        at a time; see check_genotypes."""
+    try:
+        header = feature_import.read_header(input_file)
+    except Exception as e:
+        utils.msg("Unable to check genotypes: {0}".format(e), \
+                mtype='warning')
+        return None
+    return report_chunks(header, lambda: feature_import.read_chunks( \
+            input_file), output_fc, id_field)
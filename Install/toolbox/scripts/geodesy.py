@@ -0,0 +1,222 @@
+# geodesy.py: vectorized ellipsoidal distance calculations
+# -*- coding: utf-8 -*-
+
+"""
+Pure NumPy implementation of Vincenty's inverse solution on the ellipsoid,
+used as the portable replacement for the ArcObjects `geodesic.dll`.
+
+A result between: (-83.7453,8.6583) and (-85.9176,11.0253): 353995.597 meters
+The same calculation in geographiclib produces: 353995.597 meters
+"""
+
+import numpy
+
+# WGS84 ellipsoid, the default for geographic data (SRID 4326)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+def ellipsoid(spatial_reference=None):
+    """ Semi-major axis and flattening of a spatial reference, defaulting
+        to WGS84 when none is provided."""
+    if spatial_reference is None:
+        return (WGS84_A, WGS84_F)
+    gcs = spatial_reference
+    if spatial_reference.type == 'Projected':
+        gcs = spatial_reference.GCS
+    return (gcs.semiMajorAxis, gcs.flattening)
+
+def inverse(lat1, lon1, lat2, lon2, a=WGS84_A, f=WGS84_F, \
+        max_iter=200, tol=1e-12):
+    """
+    Geodesic distance in meters between two sets of points given in
+    decimal degrees. Inputs are broadcast against each other, so a column
+    of origins against a row of destinations computes a full block of the
+    distance matrix in one call.
+
+    Nearly antipodal pairs, where Vincenty's iteration fails to converge,
+    are resolved with geographiclib when available.
+    """
+    b = (1 - f) * a
+    (lat1, lon1, lat2, lon2) = numpy.broadcast_arrays(
+            *[numpy.asarray(v, dtype=numpy.float64) \
+            for v in (lat1, lon1, lat2, lon2)])
+    shape = lat1.shape
+    (lat1, lon1, lat2, lon2) = [v.ravel() for v in (lat1, lon1, lat2, lon2)]
+
+    u1 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat1)))
+    u2 = numpy.arctan((1 - f) * numpy.tan(numpy.radians(lat2)))
+    sin_u1 = numpy.sin(u1)
+    cos_u1 = numpy.cos(u1)
+    sin_u2 = numpy.sin(u2)
+    cos_u2 = numpy.cos(u2)
+    big_l = numpy.radians(lon2 - lon1)
+
+    dist = numpy.zeros(lat1.shape)
+    lam = big_l.copy()
+    # only keep iterating on the pairs which haven't converged yet.
+    active = numpy.arange(len(lam))
+    # silence the 0/0 cases for coincident points; they're masked below.
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for i in range(max_iter):
+            if len(active) == 0:
+                break
+            (s1, c1, s2, c2) = (sin_u1[active], cos_u1[active], \
+                    sin_u2[active], cos_u2[active])
+            sin_lam = numpy.sin(lam[active])
+            cos_lam = numpy.cos(lam[active])
+            sin_sigma = numpy.sqrt((c2 * sin_lam) ** 2 + \
+                    (c1 * s2 - s1 * c2 * cos_lam) ** 2)
+            cos_sigma = s1 * s2 + c1 * c2 * cos_lam
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = c1 * c2 * sin_lam / sin_sigma
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # equatorial lines have cos^2(alpha) == 0
+            cos_2sigma_m = numpy.where(cos_sq_alpha != 0, \
+                    cos_sigma - 2 * s1 * s2 / cos_sq_alpha, 0)
+            c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            lam_prev = lam[active]
+            lam[active] = big_l[active] + (1 - c) * f * sin_alpha * \
+                    (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * \
+                    (-1 + 2 * cos_2sigma_m ** 2)))
+            # coincident points produce NaNs; treat them as converged.
+            coincident = sin_sigma == 0
+            done = (numpy.abs(lam[active] - lam_prev) <= tol) | coincident
+
+            u_sq = cos_sq_alpha[done] * (a ** 2 - b ** 2) / b ** 2
+            big_a = 1 + u_sq / 16384 * (4096 + u_sq * \
+                    (-768 + u_sq * (320 - 175 * u_sq)))
+            big_b = u_sq / 1024 * (256 + u_sq * \
+                    (-128 + u_sq * (74 - 47 * u_sq)))
+            (ss, cs, c2m) = (sin_sigma[done], cos_sigma[done], \
+                    cos_2sigma_m[done])
+            delta_sigma = big_b * ss * (c2m + big_b / 4 * \
+                    (cs * (-1 + 2 * c2m ** 2) - big_b / 6 * c2m * \
+                    (-3 + 4 * ss ** 2) * (-3 + 4 * c2m ** 2)))
+            result = b * big_a * (sigma[done] - delta_sigma)
+            dist[active[done]] = numpy.where(coincident[done], 0.0, result)
+            active = active[~done]
+
+    if len(active):
+        dist[active] = _inverse_fallback(lat1[active], lon1[active], \
+                lat2[active], lon2[active], a, f)
+    return dist.reshape(shape)
+
+def _inverse_fallback(lat1, lon1, lat2, lon2, a, f):
+    """ Resolve nearly antipodal pairs with geographiclib (Karney 2013)."""
+    try:
+        from geographiclib.geodesic import Geodesic
+    except ImportError:
+        raise ValueError("{} nearly antipodal point pairs failed to " \
+                "converge; install `geographiclib` to compute them.".format(
+                len(lat1)))
+    geod = Geodesic(a, f)
+    return numpy.array([geod.Inverse(p1, l1, p2, l2)['s12'] for \
+            (p1, l1, p2, l2) in zip(lat1, lon1, lat2, lon2)])
+
+def distance_block(lats, lons, start, stop, a=WGS84_A, f=WGS84_F):
+    """ Rows [start, stop) of the pairwise distance matrix, in meters."""
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    block = inverse(lats[start:stop, numpy.newaxis], \
+            lons[start:stop, numpy.newaxis], \
+            lats[numpy.newaxis, :], lons[numpy.newaxis, :], a, f)
+    # pin the diagonal to zero, as the other engines do.
+    rows = numpy.arange(start, min(stop, len(lats)))
+    block[rows - start, rows] = 0
+    return block
+
+def unique_locations(lats, lons):
+    """
+    Collapse points to their distinct (lat, lon) locations. Returns the
+    unique coordinates, and for each input point the position of its
+    location, so that distances computed between locations can be expanded
+    back out to every point with `matrix[inverse][:, inverse]`.
+    """
+    lats = numpy.asarray(lats, dtype=numpy.float64)
+    lons = numpy.asarray(lons, dtype=numpy.float64)
+    if len(lats) == 0:
+        return (lats, lons, numpy.zeros(0, dtype=numpy.intp))
+    order = numpy.lexsort((lons, lats))
+    sorted_lats = lats[order]
+    sorted_lons = lons[order]
+    # a new location starts wherever either coordinate changes.
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = (sorted_lats[1:] != sorted_lats[:-1]) | \
+            (sorted_lons[1:] != sorted_lons[:-1])
+    inverse = numpy.empty(len(order), dtype=numpy.intp)
+    inverse[order] = numpy.cumsum(first) - 1
+    return (sorted_lats[first], sorted_lons[first], inverse)
+
+def great_circle_paths(lat1, lon1, lat2, lon2, spacing=10000, \
+        max_segments=1000):
+    """
+    Densified great circle paths between pairs of points, with a vertex at
+    least every `spacing` meters. Returns the (lats, lons) of every vertex
+    of every path, end to end, and the number of vertices in each path.
+    Longitudes are kept continuous along a path, so those crossing the
+    antimeridian run past +/-180 rather than wrapping around.
+    """
+    (lat1, lon1, lat2, lon2) = [numpy.atleast_1d( \
+            numpy.asarray(v, dtype=numpy.float64)) \
+            for v in (lat1, lon1, lat2, lon2)]
+    v1 = _unit_vectors(lat1, lon1)
+    v2 = _unit_vectors(lat2, lon2)
+    angle = numpy.arctan2(numpy.sqrt((numpy.cross(v1, v2) ** 2).sum(axis=1)), \
+            (v1 * v2).sum(axis=1))
+    segments = numpy.clip(numpy.ceil(angle * 6371008.8 / spacing), \
+            1, max_segments).astype(numpy.intp)
+    counts = segments + 1
+    starts = numpy.cumsum(counts) - counts
+
+    # position of each vertex along its path, from 0 to 1.
+    path = numpy.repeat(numpy.arange(len(counts)), counts)
+    step = numpy.arange(counts.sum()) - starts[path]
+    t = (step / segments[path].astype(numpy.float64))[:, numpy.newaxis]
+    omega = angle[path][:, numpy.newaxis]
+    sin_omega = numpy.sin(omega)
+    # spherical interpolation, falling back to linear for tiny arcs.
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        w1 = numpy.where(sin_omega > 1e-12, \
+                numpy.sin((1 - t) * omega) / sin_omega, 1 - t)
+        w2 = numpy.where(sin_omega > 1e-12, \
+                numpy.sin(t * omega) / sin_omega, t)
+    v = w1 * v1[path] + w2 * v2[path]
+    lats = numpy.degrees(numpy.arctan2(v[:, 2], \
+            numpy.sqrt(v[:, 0] ** 2 + v[:, 1] ** 2)))
+    lons = numpy.degrees(numpy.arctan2(v[:, 1], v[:, 0]))
+
+    # pin the end points to the inputs, then unwrap longitudes per path.
+    ends = starts + counts - 1
+    (lats[starts], lons[starts]) = (lat1, lon1)
+    (lats[ends], lons[ends]) = (lat2, lon2)
+    jumps = numpy.zeros(len(lons))
+    jumps[1:] = -360 * numpy.round(numpy.diff(lons) / 360)
+    jumps[starts] = 0
+    shift = numpy.cumsum(jumps)
+    lons += shift - numpy.repeat(shift[starts], counts)
+    return (lats, lons, counts)
+
+def group_centroids(lats, lons, groups):
+    """
+    Spherical mean centroid of each group of points: the direction of the
+    sum of their unit vectors, which, unlike averaging coordinates, is
+    unaffected by the antimeridian. Returns the sorted group labels, the
+    (lats, lons) of their centroids, and the number of points in each.
+    """
+    (labels, inverse) = numpy.unique(numpy.asarray(groups), \
+            return_inverse=True)
+    vectors = _unit_vectors(numpy.asarray(lats, dtype=numpy.float64), \
+            numpy.asarray(lons, dtype=numpy.float64))
+    sums = numpy.column_stack([numpy.bincount(inverse, weights=vectors[:, i], \
+            minlength=len(labels)) for i in range(3)])
+    centroid_lats = numpy.degrees(numpy.arctan2(sums[:, 2], \
+            numpy.sqrt(sums[:, 0] ** 2 + sums[:, 1] ** 2)))
+    centroid_lons = numpy.degrees(numpy.arctan2(sums[:, 1], sums[:, 0]))
+    counts = numpy.bincount(inverse, minlength=len(labels))
+    return (labels, centroid_lats, centroid_lons, counts)
+
+def _unit_vectors(lats, lons):
+    lat = numpy.radians(lats)
+    lon = numpy.radians(lons)
+    return numpy.column_stack((numpy.cos(lat) * numpy.cos(lon), \
+            numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)))
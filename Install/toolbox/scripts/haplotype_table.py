@@ -0,0 +1,319 @@
+# haplotype_table.py: stored haplotype counts, kept alongside the data
+# -*- coding: utf-8 -*-
+
+"""
+Haplotype counts are kept in a table next to the feature class, named
+`<feature class>_Haplotypes`, so tools read them rather than scanning every
+feature. The table holds one row per haplotype with its overall count and,
+once counts for a population field have been asked for, one row per
+haplotype per population of that field.
+
+The table also records a fingerprint of the feature class, which changes
+with any edit to it (see utils.dataset_signature). Tools which add, remove
+or edit features pass the changed rows to update_counts(), which adjusts
+the stored counts without touching the features. A table whose fingerprint
+no longer matches, e.g. after edits made in ArcMap, is rebuilt the next
+time it's used.
+
+Storing counts is only ever an optimization: where the table can't be
+written, such as in a read-only or locked geodatabase, counts are read
+from the features instead. Writing the table doesn't count as an edit of
+the feature class, so it leaves caches of its other summaries in place.
+"""
+
+import collections
+import hashlib
+import os
+
+import arcpy
+
+import utils
+
+TABLE_SUFFIX = '_Haplotypes'
+# population_field of the overall counts, and of rows recording totals.
+ALL = ''
+TOTAL = '*'
+FIELDS = [('code', 'LONG', None), ('haplotype', 'TEXT', 64), \
+        ('population_field', 'TEXT', 64), ('population', 'TEXT', 255), \
+        ('count', 'LONG', None), ('signature', 'TEXT', 40)]
+
+class Counts(object):
+    """ The contents of a haplotype table: counts keyed by population field,
+        then population, then haplotype."""
+
+    def __init__(self, haplotype_field, total=0, signature=None):
+        self.haplotype_field = haplotype_field
+        self.total = total
+        # fingerprint of the features counted.
+        self.signature = signature
+        # {population field: {population: Counter of haplotypes}}
+        self.groups = collections.OrderedDict()
+
+    def add_field(self, population_field):
+        self.groups[population_field] = collections.OrderedDict()
+
+    def add(self, population_field, population, haplotype, count=1):
+        pops = self.groups[population_field]
+        if population not in pops:
+            pops[population] = collections.Counter()
+        pops[population][haplotype] += count
+
+    def apply(self, rows, sign=1):
+        """ Count, or with sign=-1 uncount, rows given as mappings of field
+            names to values."""
+        for row in rows:
+            haplotype = row.get(self.haplotype_field)
+            for population_field in self.groups.keys():
+                if population_field == ALL:
+                    population = ALL
+                else:
+                    population = row.get(population_field)
+                    if population is not None:
+                        # stored as text; keep scanned counts the same.
+                        population = unicode(population)
+                if haplotype and population is not None:
+                    self.add(population_field, population, haplotype, sign)
+            self.total += sign
+
+    def overall(self):
+        """ Counts of each haplotype across all features."""
+        return self.groups.get(ALL, {}).get(ALL, collections.Counter())
+
+    def by_population(self, population_field):
+        """ Counts of each haplotype within each population."""
+        return self.groups[population_field]
+
+def table_path(input_features):
+    """ Location of the haplotype table for input_features, or None when
+        counts can't be stored: data outside of a file geodatabase, or a
+        layer with a selection or definition query."""
+    desc = arcpy.Describe(input_features)
+    if getattr(desc, 'dataType', None) in ('FeatureLayer', 'Layer') and \
+            (getattr(desc, 'FIDSet', '') or getattr(desc, 'whereClause', '')):
+        return None
+    path = desc.catalogPath
+    # tables can't live in feature datasets; use the geodatabase itself.
+    gdb = os.path.dirname(path)
+    while gdb and not gdb.lower().endswith('.gdb'):
+        parent = os.path.dirname(gdb)
+        if parent == gdb:
+            return None
+        gdb = parent
+    if not gdb:
+        return None
+    name = arcpy.ValidateTableName(os.path.basename(path) + TABLE_SUFFIX, gdb)
+    return os.path.join(gdb, name)
+
+def feature_count(input_features):
+    return int(arcpy.GetCount_management(input_features).getOutput(0))
+
+def fingerprint(input_features):
+    """ A hash which changes whenever input_features is edited, or None
+        when edits can't be detected."""
+    signature = utils.dataset_signature(arcpy.Describe( \
+            input_features).catalogPath)
+    if signature is None:
+        return None
+    return hashlib.sha1(repr(signature)).hexdigest()
+
+def scan(input_features, haplotype_field, population_fields=(ALL,)):
+    """ Count haplotypes by reading every feature."""
+    counts = Counts(haplotype_field)
+    for population_field in population_fields:
+        counts.add_field(population_field)
+    fields = [haplotype_field] + [f for f in population_fields if f != ALL]
+    with arcpy.da.SearchCursor(input_features, fields) as cursor:
+        counts.apply(dict(zip(fields, row)) for row in cursor)
+    return counts
+
+def read_table(path):
+    """ Counts stored in a haplotype table, or None if it doesn't exist or
+        can't be read."""
+    if not arcpy.Exists(path):
+        return None
+    fields = [name for (name, field_type, length) in FIELDS]
+    if fields[-1] not in [f.name for f in arcpy.ListFields(path)]:
+        # written before fingerprints were kept; rebuild it.
+        return None
+    counts = None
+    rows = []
+    with arcpy.da.SearchCursor(path, fields) as cursor:
+        for (code, haplotype, population_field, population, count, \
+                signature) in cursor:
+            if population_field == TOTAL:
+                if counts is None:
+                    counts = Counts(haplotype, count, signature)
+                counts.add_field(population or ALL)
+            else:
+                rows.append((population_field or ALL, population or ALL, \
+                        haplotype, count))
+    if counts is None:
+        return None
+    for row in rows:
+        if row[0] in counts.groups:
+            counts.add(*row)
+    return counts
+
+def write_table(path, counts):
+    """ Replace the contents of a haplotype table with counts; see
+        store() for writing counts safely."""
+    if arcpy.Exists(path):
+        arcpy.DeleteRows_management(path)
+    else:
+        (workspace, name) = os.path.split(path)
+        arcpy.CreateTable_management(workspace, name)
+        for (name, field_type, length) in FIELDS:
+            arcpy.AddField_management(path, name, field_type, \
+                    field_length=length)
+
+    # map sorted haplotypes to integers; equivalent to Shepherd's approach
+    names = sorted(counts.overall().keys())
+    codes = dict((name, code) for (code, name) in enumerate(names, start=1))
+    fields = [name for (name, field_type, length) in FIELDS]
+    with arcpy.da.InsertCursor(path, fields) as cursor:
+        for (population_field, pops) in counts.groups.items():
+            cursor.insertRow((0, counts.haplotype_field, TOTAL, \
+                    population_field, counts.total, counts.signature))
+            for (population, haplotypes) in pops.items():
+                for haplotype in sorted(haplotypes.keys()):
+                    count = haplotypes[haplotype]
+                    if count > 0:
+                        cursor.insertRow((codes.get(haplotype, 0), \
+                                haplotype, population_field, population, \
+                                count, None))
+
+def sign_table(path, signature):
+    """ Record the fingerprint of the features a table's counts are of."""
+    fields = ['population_field', 'signature']
+    with arcpy.da.UpdateCursor(path, fields) as cursor:
+        for (population_field, old) in cursor:
+            if population_field == TOTAL:
+                cursor.updateRow((population_field, signature))
+
+def store(input_features, counts):
+    """ Write counts to the haplotype table of input_features, as counts of
+        its current features. Returns False if they couldn't be stored."""
+    path = table_path(input_features)
+    if path is None:
+        return False
+    # a table left part written is unsigned, and so rebuilt.
+    counts.signature = None
+    try:
+        write_table(path, counts)
+        # the signature covers only the files of input_features, so writing
+        # the table beside them doesn't change it.
+        counts.signature = fingerprint(input_features)
+        sign_table(path, counts.signature)
+    except Exception as e:
+        utils.msg("Unable to store haplotype counts: {0}".format(e), \
+                mtype='warning')
+        return False
+    return True
+
+def discard(input_features):
+    """ Delete the haplotype table of input_features, if it has one."""
+    path = table_path(input_features)
+    if path is None or not arcpy.Exists(path):
+        return
+    try:
+        arcpy.Delete_management(path)
+    except Exception as e:
+        utils.msg("Unable to delete haplotype counts: {0}".format(e), \
+                mtype='warning')
+
+def read_counts(input_features):
+    """ The stored counts of input_features, or None if there are none or
+        they can't be read."""
+    path = table_path(input_features)
+    if path is None:
+        return None
+    try:
+        return read_table(path)
+    except Exception:
+        return None
+
+def rebuild(input_features, haplotype_field, population_fields=()):
+    """ Count haplotypes from scratch, and store the counts when possible."""
+    counts = scan(input_features, haplotype_field, \
+            [ALL] + list(population_fields))
+    store(input_features, counts)
+    return counts
+
+def stored_counts(input_features, haplotype_field, population_field=None):
+    """ Counts from the haplotype table, rebuilt or extended as needed so
+        that they are current and include population_field."""
+    if table_path(input_features) is None:
+        fields = [ALL] + ([population_field] if population_field else [])
+        return scan(input_features, haplotype_field, fields)
+
+    counts = read_counts(input_features)
+    signature = fingerprint(input_features)
+    if counts is None or counts.haplotype_field != haplotype_field or \
+            signature is None or counts.signature != signature:
+        fields = [f for f in counts.groups.keys() if f != ALL] \
+                if counts is not None else []
+        if population_field and population_field not in fields:
+            fields.append(population_field)
+        return rebuild(input_features, haplotype_field, fields)
+
+    if population_field and population_field not in counts.groups:
+        # count the new field, keeping the counts we already have.
+        extra = scan(input_features, haplotype_field, [population_field])
+        counts.groups[population_field] = extra.groups[population_field]
+        store(input_features, counts)
+    return counts
+
+def haplotype_counts(input_features, haplotype_field):
+    """ Counts of each haplotype."""
+    return stored_counts(input_features, haplotype_field).overall()
+
+def population_counts(input_features, haplotype_field, population_field):
+    """ Counts of each haplotype within each population of
+        population_field."""
+    counts = stored_counts(input_features, haplotype_field, population_field)
+    return counts.by_population(population_field)
+
+def stored_field(input_features):
+    """ The haplotype field of the stored counts, or None if there are
+        none."""
+    counts = read_counts(input_features)
+    return counts.haplotype_field if counts is not None else None
+
+def update_counts(input_features, haplotype_field, added=(), removed=(), \
+        signature=None):
+    """
+    Adjust the stored counts after features have been changed, without
+    reading the features. added and removed hold the changed rows as
+    mappings of field names to values; an edit removes the row's old values
+    and adds its new ones. signature is the fingerprint of the features
+    before they were changed. Population fields missing from the rows are
+    recounted when next needed.
+    """
+    counts = read_counts(input_features)
+    if counts is None or counts.haplotype_field != haplotype_field:
+        return
+    (added, removed) = (list(added), list(removed))
+    if signature is None or counts.signature != signature:
+        # the table was already out of date; rebuild it when next used.
+        discard(input_features)
+        return
+    for population_field in list(counts.groups.keys()):
+        if population_field != ALL and not all(population_field in row \
+                for row in added + removed):
+            del counts.groups[population_field]
+    counts.apply(removed, -1)
+    counts.apply(added)
+    if not store(input_features, counts):
+        discard(input_features)
+
+def invalidate(input_features, population_field=None):
+    """ Forget the stored counts of population_field, or all stored counts,
+        after features were edited without update_counts()."""
+    counts = read_counts(input_features) if population_field else None
+    if counts is None:
+        discard(input_features)
+    elif population_field in counts.groups:
+        del counts.groups[population_field]
+        # the counts left are still those of the features as counted.
+        if not store(input_features, counts):
+            discard(input_features)
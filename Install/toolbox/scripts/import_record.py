@@ -0,0 +1,154 @@
+# import_record.py: remember what an imported feature class was made from
+# -*- coding: utf-8 -*-
+
+"""
+Each import records a signature of its inputs in a table next to the
+output feature class, named `<feature class>_Import`. The signature covers
+the contents of the input file, the columns chosen for each group, their
+types and the spatial reference, so importing the same file the same way
+again can be skipped.
+
+The record also holds the number of features written. A feature class
+whose count no longer matches, e.g. after rows were deleted, is imported
+again rather than reused.
+
+A second table, `<feature class>_RowHashes`, holds a hash of each input row
+by its key, so appending a newer version of the file only writes the rows
+which changed; see append_import.
+"""
+
+import hashlib
+import os
+
+import arcpy
+
+import haplotype_table
+import table_schema
+
+RECORD_SUFFIX = '_Import'
+FIELDS = [('signature', 'TEXT', 40), ('feature_count', 'LONG', None)]
+HASHES_SUFFIX = '_RowHashes'
+HASH_FIELDS = [('row_key', 'TEXT', 255), ('row_hash', 'TEXT', 40)]
+
+def record_path(output_fc, suffix=RECORD_SUFFIX):
+    """ Location of the import record for output_fc, or of another table
+        stored with it, or None when it isn't in a file geodatabase."""
+    gdb = os.path.dirname(output_fc)
+    # tables can't live in feature datasets; use the geodatabase itself.
+    while gdb and not gdb.lower().endswith('.gdb'):
+        parent = os.path.dirname(gdb)
+        if parent == gdb:
+            return None
+        gdb = parent
+    if not gdb:
+        return None
+    name = arcpy.ValidateTableName(os.path.basename(output_fc) + suffix, gdb)
+    return os.path.join(gdb, name)
+
+def signature(input_table, sr, protected_map, columns):
+    """
+    A hash of everything an import depends on: the contents of the input
+    file, or list of files, the spatial reference, the column types in
+    protected_map, and columns, the semicolon separated columns of each
+    group, given as a mapping of group to columns.
+    """
+    if hasattr(sr, 'exportToString'):
+        sr = sr.exportToString()
+    if isinstance(input_table, basestring):
+        input_table = [input_table]
+    digest = hashlib.sha1()
+    for path in input_table:
+        digest.update(table_schema.file_hash(path))
+    digest.update(repr(sr or ''))
+    digest.update(repr(sorted((protected_map or {}).items())))
+    # ArcGIS doesn't preserve the order of multiple values.
+    for group in sorted(columns.keys()):
+        values = sorted((columns[group] or '').split(';'))
+        digest.update(repr((group, values)))
+    return digest.hexdigest()
+
+def read_record(output_fc):
+    """ The recorded (signature, feature count) of output_fc, or None."""
+    path = record_path(output_fc)
+    if path is None or not arcpy.Exists(path):
+        return None
+    fields = [name for (name, field_type, length) in FIELDS]
+    with arcpy.da.SearchCursor(path, fields) as cursor:
+        for row in cursor:
+            return tuple(row)
+    return None
+
+def is_current(output_fc, import_signature):
+    """ True if output_fc was imported with import_signature and still
+        holds the features written then."""
+    if not arcpy.Exists(output_fc):
+        return False
+    record = read_record(output_fc)
+    if record is None or record[0] != import_signature:
+        return False
+    return record[1] == haplotype_table.feature_count(output_fc)
+
+def write_record(output_fc, import_signature):
+    """ Record the signature of a completed import."""
+    path = record_path(output_fc)
+    if path is None:
+        return
+    empty_table(path, FIELDS)
+    fields = [name for (name, field_type, length) in FIELDS]
+    with arcpy.da.InsertCursor(path, fields) as cursor:
+        cursor.insertRow((import_signature, \
+                haplotype_table.feature_count(output_fc)))
+
+def empty_table(path, fields):
+    """ Create a table with fields, or empty it if it exists."""
+    if arcpy.Exists(path):
+        arcpy.DeleteRows_management(path)
+    else:
+        (workspace, name) = os.path.split(path)
+        arcpy.CreateTable_management(workspace, name)
+        for (name, field_type, length) in fields:
+            arcpy.AddField_management(path, name, field_type, \
+                    field_length=length)
+
+def clear(output_fc):
+    """ Forget the import record of output_fc, before it's replaced."""
+    path = record_path(output_fc)
+    if path is not None and arcpy.Exists(path):
+        arcpy.Delete_management(path)
+
+def read_row_hashes(output_fc):
+    """ The stored hash of each input row, by key."""
+    path = record_path(output_fc, HASHES_SUFFIX)
+    if path is None or not arcpy.Exists(path):
+        return {}
+    fields = [name for (name, field_type, length) in HASH_FIELDS]
+    with arcpy.da.SearchCursor(path, fields) as cursor:
+        return dict((key, row_hash) for (key, row_hash) in cursor)
+
+def write_row_hashes(output_fc, hashes):
+    """ Replace the stored row hashes with hashes, of key to hash."""
+    path = record_path(output_fc, HASHES_SUFFIX)
+    if path is None:
+        return
+    empty_table(path, HASH_FIELDS)
+    fields = [name for (name, field_type, length) in HASH_FIELDS]
+    with arcpy.da.InsertCursor(path, fields) as cursor:
+        for row in hashes.items():
+            cursor.insertRow(row)
+
+def update_row_hashes(output_fc, hashes):
+    """ Store the hashes of changed rows, keeping the rest."""
+    path = record_path(output_fc, HASHES_SUFFIX)
+    if path is None:
+        return
+    if not arcpy.Exists(path):
+        return write_row_hashes(output_fc, hashes)
+    remaining = dict(hashes)
+    fields = [name for (name, field_type, length) in HASH_FIELDS]
+    with arcpy.da.UpdateCursor(path, fields) as cursor:
+        for (key, row_hash) in cursor:
+            if key in remaining:
+                cursor.updateRow((key, remaining.pop(key)))
+    with arcpy.da.InsertCursor(path, fields) as cursor:
+        for row in remaining.items():
+            cursor.insertRow(row)
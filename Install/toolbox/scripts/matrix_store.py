@@ -0,0 +1,300 @@
+# matrix_store.py: disk-backed storage for pairwise distance matrices
+# -*- coding: utf-8 -*-
+
+"""
+Distance matrices grow with the square of the input, so rather than holding
+them in memory they are computed in square tiles directly into a
+memory-mapped file. Only one tile is ever held in RAM, and matrix size is
+limited by free disk space rather than address space.
+
+Tiles are independent, so they can also be farmed out to a pool of worker
+processes, each of which maps the same file and writes its tiles in place.
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+import numpy
+
+import geodesy
+
+def tiles(count, tile_size):
+    """ Upper triangle tiles of a symmetric count x count matrix, as
+        ((row_start, row_stop), (col_start, col_stop)) pairs."""
+    bounds = [(start, min(start + tile_size, count)) for \
+            start in range(0, count, tile_size)]
+    for (i, rows) in enumerate(bounds):
+        for cols in bounds[i:]:
+            yield (rows, cols)
+
+def tile_count(count, tile_size):
+    """ Number of tiles generated by tiles()."""
+    blocks = (count + tile_size - 1) // tile_size
+    return blocks * (blocks + 1) // 2
+
+# per-process state for pool workers, set up once by _init_worker.
+_worker = {}
+
+def _init_worker(store_args, lats, lons, a, f, unit_factor):
+    (store_class, args) = store_args
+    _worker['store'] = store_class(*args)
+    _worker['params'] = (lats, lons, a, f, unit_factor)
+
+def _fill_worker_tile(tile):
+    (rows, cols) = tile
+    _worker['store'].fill_tile(rows, cols, *_worker['params'])
+    return tile
+
+class TiledStore(object):
+    """ Tile scheduling shared by the disk-backed stores. Subclasses provide
+        fill_tile(), flush() and reopen_args(), the latter used by worker
+        processes to map the same backing file."""
+
+    def fill(self, lats, lons, a=geodesy.WGS84_A, f=geodesy.WGS84_F, \
+            unit_factor=1, tile_size=512, progress=None, workers=1):
+        """ Compute the full matrix, tile by tile, using up to `workers`
+            processes. Calls progress(done, total) after each tile when
+            provided."""
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        total = tile_count(self.count, tile_size)
+        if workers > 1 and total > 1:
+            # make sure the file is complete before workers map it.
+            self.flush()
+            init_args = (self.reopen_args(), lats, lons, a, f, unit_factor)
+            pool = multiprocessing.Pool(min(workers, total), \
+                    _init_worker, init_args)
+            try:
+                results = pool.imap_unordered(_fill_worker_tile, \
+                        tiles(self.count, tile_size))
+                for (i, tile) in enumerate(results):
+                    if progress is not None:
+                        progress(i + 1, total)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for (i, (rows, cols)) in enumerate(tiles(self.count, tile_size)):
+                self.fill_tile(rows, cols, lats, lons, a, f, unit_factor)
+                if progress is not None:
+                    progress(i + 1, total)
+        self.flush()
+
+class MatrixStore(TiledStore):
+    """ A square distance matrix backed by a memory-mapped file."""
+
+    def __init__(self, path, count, dtype=numpy.float64, mode='w+'):
+        self.path = path
+        self.count = count
+        self.dtype = numpy.dtype(dtype)
+        if count == 0:
+            # an empty file can't be mapped; there's nothing to store.
+            if mode == 'w+':
+                open(path, 'wb').close()
+            self.matrix = numpy.zeros((0, 0), dtype=self.dtype)
+        else:
+            self.matrix = numpy.memmap(path, dtype=self.dtype, mode=mode, \
+                    shape=(count, count))
+
+    @classmethod
+    def temporary(cls, directory, count, dtype=numpy.float64):
+        """ A store in a new temporary file within directory."""
+        (handle, path) = tempfile.mkstemp(suffix='.dat', dir=directory)
+        os.close(handle)
+        return cls(path, count, dtype)
+
+    def fill_tile(self, rows, cols, lats, lons, a, f, unit_factor=1):
+        """ Compute one tile and its mirror image below the diagonal."""
+        (row_start, row_stop) = rows
+        (col_start, col_stop) = cols
+        block = geodesy.inverse( \
+                lats[row_start:row_stop, numpy.newaxis], \
+                lons[row_start:row_stop, numpy.newaxis], \
+                lats[numpy.newaxis, col_start:col_stop], \
+                lons[numpy.newaxis, col_start:col_stop], a, f) * unit_factor
+        if row_start == col_start:
+            # tiles on the diagonal are symmetric themselves.
+            numpy.fill_diagonal(block, 0)
+        self.matrix[row_start:row_stop, col_start:col_stop] = block
+        self.matrix[col_start:col_stop, row_start:row_stop] = block.T
+
+    def reopen_args(self):
+        return (MatrixStore, (self.path, self.count, self.dtype, 'r+'))
+
+    def flush(self):
+        if isinstance(self.matrix, numpy.memmap):
+            self.matrix.flush()
+
+    def row(self, i):
+        """ A full row of the matrix, by row position."""
+        return self.matrix[i]
+
+    def rows(self):
+        """ Iterate over the matrix one row at a time."""
+        for i in range(self.count):
+            yield self.matrix[i]
+
+    def close(self, delete=False):
+        """ Release the memory map, optionally deleting its backing file."""
+        if self.matrix is not None:
+            self.flush()
+            # dropping the last reference unmaps the file; required before
+            # it can be removed on Windows.
+            self.matrix = None
+        if delete and os.path.exists(self.path):
+            os.remove(self.path)
+
+def condensed_index(count, i, j):
+    """ Position of (i, j), i < j, in a condensed upper triangle of a
+        count x count matrix; the same layout as scipy's pdist."""
+    return count * i - i * (i + 1) // 2 + (j - i - 1)
+
+def oid_index_path(path):
+    """ Location of the OID index stored alongside a condensed matrix."""
+    return "{}.oids.npy".format(os.path.splitext(path)[0])
+
+def condensed_row(data, count, i):
+    """ Row i of the square matrix held by condensed values data."""
+    row = numpy.zeros(count, dtype=data.dtype)
+    # values left of the diagonal are stored in earlier rows' segments.
+    before = numpy.arange(i)
+    row[:i] = data[condensed_index(count, before, i)]
+    start = condensed_index(count, i, i + 1)
+    row[i + 1:] = data[start:start + count - i - 1]
+    return row
+
+class CondensedStore(TiledStore):
+    """ The upper triangle of a symmetric distance matrix, excluding the
+        diagonal, written straight into a memory-mapped .npy file. Stores
+        half the values of a square matrix, and computes half the pairs."""
+
+    def __init__(self, path, oids, dtype=numpy.float64, mode='w+'):
+        self.path = path
+        self.oids = numpy.asarray(oids)
+        self.count = len(self.oids)
+        self.dtype = numpy.dtype(dtype)
+        if mode == 'w+':
+            size = self.count * (self.count - 1) // 2
+            self.data = numpy.lib.format.open_memmap(path, mode=mode, \
+                    dtype=self.dtype, shape=(size,))
+            numpy.save(oid_index_path(path), self.oids)
+        else:
+            self.data = numpy.lib.format.open_memmap(path, mode=mode)
+
+    @classmethod
+    def temporary(cls, directory, count, dtype=numpy.float64):
+        """ A store of count rows in a new temporary file within
+            directory."""
+        (handle, path) = tempfile.mkstemp(suffix='.npy', dir=directory)
+        os.close(handle)
+        return cls(path, numpy.arange(count), dtype)
+
+    def fill_tile(self, rows, cols, lats, lons, a, f, unit_factor=1):
+        """ Compute the part of one tile above the diagonal."""
+        (row_start, row_stop) = rows
+        (col_start, col_stop) = cols
+        block = geodesy.inverse( \
+                lats[row_start:row_stop, numpy.newaxis], \
+                lons[row_start:row_stop, numpy.newaxis], \
+                lats[numpy.newaxis, col_start:col_stop], \
+                lons[numpy.newaxis, col_start:col_stop], a, f) * unit_factor
+        for i in range(row_start, row_stop):
+            # each row's values above the diagonal are contiguous.
+            first_col = max(col_start, i + 1)
+            if first_col >= col_stop:
+                continue
+            start = condensed_index(self.count, i, first_col)
+            self.data[start:start + col_stop - first_col] = \
+                    block[i - row_start, first_col - col_start:]
+
+    def expand(self, store, inverse, progress=None):
+        """ Fill in from a store of distances between unique locations,
+            square or condensed, where inverse maps each point to its
+            location."""
+        (location, row) = (None, None)
+        for i in range(self.count - 1):
+            if inverse[i] != location:
+                # points sharing a location share its row.
+                location = inverse[i]
+                row = store.row(location)
+            locations = inverse[i + 1:]
+            start = condensed_index(self.count, i, i + 1)
+            self.data[start:start + len(locations)] = row[locations]
+            if progress is not None:
+                progress(i + 1, self.count - 1)
+        self.flush()
+
+    def row(self, i):
+        """ A full row of the square matrix, by row position."""
+        return condensed_row(self.data, self.count, i)
+
+    def reopen_args(self):
+        return (CondensedStore, (self.path, self.oids, self.dtype, 'r+'))
+
+    def flush(self):
+        self.data.flush()
+
+    def close(self, delete=False):
+        """ Release the memory map, optionally deleting its files."""
+        if self.data is not None:
+            self.data.flush()
+            self.data = None
+        if delete:
+            for path in (self.path, oid_index_path(self.path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+class CondensedMatrix(object):
+    """ Read access to a condensed matrix written by CondensedStore. The
+        values are memory-mapped by default, so only the pages touched
+        are ever read from disk."""
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.data = numpy.load(path, mmap_mode=mmap_mode)
+        self.oids = numpy.load(oid_index_path(path))
+        self.count = len(self.oids)
+        self.positions = dict((oid, i) for (i, oid) in \
+                enumerate(self.oids.tolist()))
+
+    def distance(self, from_oid, to_oid):
+        """ Distance between two features, by OID."""
+        i = self.positions[from_oid]
+        j = self.positions[to_oid]
+        if i == j:
+            return 0.0
+        if i > j:
+            (i, j) = (j, i)
+        return float(self.data[condensed_index(self.count, i, j)])
+
+    def row(self, i):
+        """ A full row of the square matrix, by row position."""
+        return condensed_row(self.data, self.count, i)
+
+    def rows(self):
+        """ Iterate over the square matrix one row at a time."""
+        for i in range(self.count):
+            yield self.row(i)
+
+def load_condensed(path, mmap_mode='r'):
+    """ Open a condensed distance matrix and its OID index."""
+    return CondensedMatrix(path, mmap_mode)
+
+def save_sparse(path, oids, rows, cols, data):
+    """
+    Save the pairs of a thresholded matrix as COO triplets in a .npz file,
+    using the same layout as scipy.sparse.save_npz so it can be loaded with
+    scipy.sparse.load_npz. Only the upper triangle is stored; the OIDs of
+    the matrix rows are kept alongside.
+    """
+    count = len(oids)
+    numpy.savez(path, format='coo', shape=numpy.array([count, count]), \
+            row=numpy.asarray(rows), col=numpy.asarray(cols), \
+            data=numpy.asarray(data), oids=numpy.asarray(oids))
+
+def load_sparse(path):
+    """ Load a thresholded matrix saved by save_sparse, as a tuple of
+        (oids, rows, cols, data) arrays."""
+    loaded = numpy.load(path)
+    return (loaded['oids'], loaded['row'], loaded['col'], loaded['data'])
@@ -0,0 +1,67 @@
+# matrix_writer.py: streaming text output for distance matrices
+# -*- coding: utf-8 -*-
+
+"""
+Distance matrices are written out one row at a time, so only the row being
+formatted is ever held as text, whatever the size of the matrix. Output is
+written through a large buffer, and compressed with gzip when the output
+name ends in `.gz`.
+"""
+
+import gzip
+
+import utils
+
+# bytes to buffer before writing to disk.
+BUFFER_SIZE = 1 << 20
+
+def is_compressed(path):
+    """ Whether output to path is gzip compressed."""
+    return path.lower().endswith('.gz')
+
+def open_output(path, buffer_size=BUFFER_SIZE):
+    """ Open a text output file for writing, gzip compressed if its name
+        ends in .gz."""
+    if is_compressed(path):
+        return gzip.open(path, 'wb')
+    return open(path, 'w', buffer_size)
+
+class MatrixWriter(object):
+    """ Write a square matrix with labelled rows and columns as delimited
+        text, in the plain or SPAGeDi layout."""
+
+    def __init__(self, path, labels, is_spagedi=False, \
+            buffer_size=BUFFER_SIZE):
+        self.path = path
+        self.is_spagedi = is_spagedi
+        # The SPAGeDi matrix format are described in section 3.7 of the manual.
+        if is_spagedi:
+            first_header_cell = "M%i" % len(labels)
+            self.sep = "\t"
+        else:
+            first_header_cell = ""
+            self.sep = ","
+        self.handle = open_output(path, buffer_size)
+        self._write([first_header_cell] + [str(s) for s in labels])
+
+    def _write(self, cells):
+        self.handle.write("{0}\n".format(self.sep.join(cells)))
+
+    def write_row(self, label, values):
+        """ Write one row, of values in column order."""
+        self._write([str(label)] + [utils.xstr(s) for s in values])
+
+    def close(self, complete=True):
+        """ Finish the file. Incomplete matrices are left without SPAGeDi's
+            END marker."""
+        if self.handle is not None:
+            if complete and self.is_spagedi:
+                self.handle.write("END\n")
+            self.handle.close()
+            self.handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
@@ -0,0 +1,199 @@
+# merge_import.py: import several SRGD files as one feature class
+# -*- coding: utf-8 -*-
+
+"""
+Imports SRGD files from several sources, e.g. one per collaborating lab,
+into a single feature class. The columns of each file are typed by a scan
+in parallel worker processes (see table_schema), then the files are
+streamed a chunk at a time into the merged feature class, so memory use is
+bounded by the chunk size rather than the size of the files:
+
+ - the merged columns are the union of every file's columns, in the order
+   they're first seen;
+ - loci columns missing from a file are filled with 0, the code every
+   export uses for missing alleles; other missing columns are left empty;
+ - a Source_File column records the file each row came from.
+
+Identifiers found in more than one file are reported, and written to a
+`<feature class>_IdConflicts` table next to the merged features.
+"""
+
+import collections
+import glob
+import multiprocessing
+import os
+import re
+
+import arcpy
+import numpy
+
+import feature_import
+import genotype_qc
+import import_record
+import table_import
+import table_schema
+import utils
+
+# column recording the file each row came from.
+SOURCE_FIELD = 'Source_File'
+# loci columns, as matched by the Genetic group expression.
+LOCI_COLUMN = '^l_'
+MISSING_ALLELE = '0'
+CONFLICTS_SUFFIX = '_IdConflicts'
+CONFLICT_FIELDS = [('id_field', 'TEXT', 64), ('id_value', 'TEXT', 255), \
+        ('source_files', 'TEXT', 2000)]
+
+def input_files(input_table):
+    """ The files named by input_table: a list of paths, or a string of
+        semicolon separated paths, any of which may be a glob pattern."""
+    if isinstance(input_table, basestring):
+        input_table = input_table.split(';')
+    files = []
+    for pattern in input_table:
+        pattern = pattern.strip().strip("'")
+        if not pattern:
+            continue
+        if glob.has_magic(pattern):
+            files += sorted(glob.glob(pattern))
+        else:
+            files.append(pattern)
+    return files
+
+def read_file(input_file):
+    """ The validated header and column kinds of one file; run in
+        workers."""
+    kinds = table_schema.column_kinds(input_file)
+    return (input_file, kinds.keys(), kinds)
+
+def read_files(files, workers=1):
+    """ Read each file, in parallel when there are several workers."""
+    if workers > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(min(workers, len(files)))
+        try:
+            return pool.map(read_file, files)
+        finally:
+            pool.close()
+            pool.join()
+    return [read_file(f) for f in files]
+
+def merged_header(tables):
+    """ The union of the headers of (file, header, kinds) tables, in the
+        order columns are first seen, and a column naming each row's source
+        file."""
+    header = []
+    for (input_file, table_header, kinds) in tables:
+        header += [label for label in table_header if label not in header]
+    return header + [utils.validate_column_label(SOURCE_FIELD)]
+
+def merged_types(tables, header, protected_map=None):
+    """ Field types of the merged columns, wide enough for every file, with
+        protected columns keeping their configured type."""
+    order = ['LONG', 'DOUBLE', 'TEXT']
+    types = {}
+    for (input_file, table_header, kinds) in tables:
+        for (label, kind) in kinds.items():
+            # columns empty in a file, or missing from it, fit any type.
+            if kind == 'empty':
+                continue
+            found = table_import.FIELD_TYPES[ \
+                    table_schema.SCHEMA_TYPES[kind].lower()]
+            if label not in types or \
+                    order.index(found) > order.index(types[label]):
+                types[label] = found
+    types = [types.get(label, 'TEXT') for label in header]
+    return feature_import.schema_field_types(types, \
+            protected_by_label(header, protected_map))
+
+def merged_chunks(tables, header, found=None):
+    """ Chunks of the merged columns, file by file, as read by
+        feature_import.read_chunks. Identifiers seen in each file are added
+        to found, by field and value, if given."""
+    for (input_file, table_header, kinds) in tables:
+        source = os.path.basename(input_file)
+        for (chunk_header, columns) in feature_import.read_chunks(input_file):
+            count = len(columns[0]) if columns else 0
+            present = dict(zip(chunk_header, columns))
+            merged = []
+            for label in header[:-1]:
+                if label in present:
+                    merged.append(present[label])
+                else:
+                    missing = MISSING_ALLELE if re.search(LOCI_COLUMN, label, \
+                            re.IGNORECASE) else ''
+                    merged.append(numpy.array([missing] * count, dtype=str))
+            merged.append(numpy.array([source] * count, dtype=str))
+            for (id_field, values) in (found or {}).items():
+                if id_field in present:
+                    ids = numpy.unique(present[id_field])
+                    for value in ids[ids != ''].tolist():
+                        if source not in values[value]:
+                            values[value].append(source)
+            yield (header, merged)
+
+def id_conflicts(found):
+    """ Identifiers found in more than one file, as a list of (field,
+        value, files), from the files each value was found in by field."""
+    conflicts = []
+    for (id_field, values) in found.items():
+        for value in sorted(values.keys()):
+            if len(values[value]) > 1:
+                conflicts.append((id_field, value, values[value]))
+    return conflicts
+
+def write_conflicts(output_fc, conflicts):
+    """ Store the identifier conflicts found by a merge next to its
+        features."""
+    path = import_record.record_path(output_fc, CONFLICTS_SUFFIX)
+    if path is None:
+        return None
+    if not conflicts:
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+        return None
+    import_record.empty_table(path, CONFLICT_FIELDS)
+    fields = [name for (name, field_type, length) in CONFLICT_FIELDS]
+    with arcpy.da.InsertCursor(path, fields) as cursor:
+        for (id_field, value, files) in conflicts:
+            cursor.insertRow((id_field, value.decode('utf-8', 'replace'), \
+                    ";".join(files)))
+    return path
+
+def protected_by_label(header, protected_map):
+    """ Protected columns positioned by their label in the merged header,
+        as positions in the first file needn't hold for the others."""
+    protected = {}
+    for (label, (idx, data_type)) in (protected_map or {}).items():
+        if label in header:
+            protected[label] = (header.index(label) + 1, data_type)
+    return protected
+
+def import_merged(files, output_fc, x, y, sr=None, protected_map=None, \
+        id_fields=()):
+    """
+    Merge several text tables into one point feature class, checking
+    their genotypes on the way. Returns the number of features written and
+    the identifier conflicts found between files.
+    """
+    tables = read_files(files, utils.worker_count())
+    header = merged_header(tables)
+    genotype_qc.report_chunks(header, lambda: merged_chunks(tables, header), \
+            output_fc, id_fields[0] if id_fields else None)
+    found = collections.OrderedDict((id_field, \
+            collections.defaultdict(list)) for id_field in id_fields)
+    count = feature_import.write_chunks(header, \
+            merged_chunks(tables, header, found), \
+            merged_types(tables, header, protected_map), output_fc, x, y, sr)
+
+    conflicts = id_conflicts(found)
+    path = write_conflicts(output_fc, conflicts)
+    if conflicts:
+        shown = ", ".join("{0} {1} ({2})".format(field, value, \
+                ", ".join(sources)) for (field, value, sources) in conflicts[:10])
+        more = " and {0} more".format(len(conflicts) - 10) \
+                if len(conflicts) > 10 else ""
+        listed = " All of them are listed in {0}.".format(path) \
+                if path is not None else ""
+        utils.msg("{0} identifiers appear in more than one file: {1}{2}." \
+                "{3}".format(len(conflicts), shown, more, listed), \
+                mtype='warning')
+    return (count, conflicts)
@@ -0,0 +1,257 @@
+# spatial_index.py: nearest neighbor and radius queries on the sphere
+# -*- coding: utf-8 -*-
+
+"""
+Points are embedded as 3D unit vectors, where straight-line (chord)
+distance increases monotonically with great-circle distance, and indexed
+with a k-d tree. The tree narrows each query to a handful of candidates,
+which are then measured exactly on the ellipsoid with geodesy.inverse.
+
+SciPy's cKDTree is used when it's installed; otherwise a pure NumPy tree
+with the same interface is built. Finding every close pair at once uses a
+vectorized grid over the same unit vectors instead, see pairs_within().
+"""
+
+import heapq
+import itertools
+import math
+
+import numpy
+
+import geodesy
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# mean earth radius, used to convert between distances and chord lengths.
+EARTH_RADIUS = 6371008.8
+# ellipsoidal distances differ from spherical ones by well under 1%; pad
+# search bounds by this factor so no candidates are missed.
+SLACK = 1.01
+# smallest grid cell used by pairs_within; keeps cell keys within int64.
+MIN_CELL = 1e-6
+
+def unit_vectors(lats, lons):
+    """ 3D unit vectors for points given in decimal degrees."""
+    lat = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+    lon = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+    cos_lat = numpy.cos(lat)
+    return numpy.column_stack((cos_lat * numpy.cos(lon), \
+            cos_lat * numpy.sin(lon), numpy.sin(lat)))
+
+def chord_length(distance):
+    """ Chord length on the unit sphere spanning a distance in meters."""
+    angle = min(distance / EARTH_RADIUS, math.pi)
+    return 2 * math.sin(angle / 2)
+
+def chord_distance(chord):
+    """ Distance in meters spanned by a chord on the unit sphere."""
+    return 2 * math.asin(min(chord / 2, 1.0)) * EARTH_RADIUS
+
+class KDTree(object):
+    """ A k-d tree with the subset of the cKDTree interface used here. Nodes
+        are kept in a flat list; each covers a contiguous range of `index`,
+        which holds point positions ordered by the tree."""
+
+    def __init__(self, data, leafsize=16):
+        self.data = numpy.asarray(data, dtype=numpy.float64)
+        self.n = len(self.data)
+        self.leafsize = leafsize
+        self.index = numpy.arange(self.n)
+        # [start, stop, lower bounds, upper bounds, left child, right child]
+        self.nodes = []
+        if self.n > 0:
+            self._build(0, self.n)
+
+    def _build(self, start, stop):
+        idx = self.index[start:stop]
+        points = self.data[idx]
+        lower = points.min(axis=0)
+        upper = points.max(axis=0)
+        node = len(self.nodes)
+        self.nodes.append([start, stop, lower, upper, None, None])
+        if stop - start > self.leafsize:
+            # split at the median of the widest dimension.
+            dim = numpy.argmax(upper - lower)
+            order = numpy.argsort(points[:, dim], kind='mergesort')
+            self.index[start:stop] = idx[order]
+            mid = (start + stop) // 2
+            self.nodes[node][4] = self._build(start, mid)
+            self.nodes[node][5] = self._build(mid, stop)
+        return node
+
+    def _box_distance(self, node, x):
+        """ Distance from x to the bounding box of a node."""
+        (lower, upper) = (node[2], node[3])
+        gap = numpy.maximum(lower - x, 0) + numpy.maximum(x - upper, 0)
+        return math.sqrt(numpy.dot(gap, gap))
+
+    def _leaf_distances(self, node, x):
+        idx = self.index[node[0]:node[1]]
+        diff = self.data[idx] - x
+        return (idx, numpy.sqrt((diff ** 2).sum(axis=1)))
+
+    def query(self, x, k=1):
+        """ Distances and positions of the k nearest points to x."""
+        x = numpy.asarray(x, dtype=numpy.float64)
+        # max-heap of the best results so far, as (-distance, position)
+        best = []
+        if self.n > 0:
+            candidates = [(self._box_distance(self.nodes[0], x), 0)]
+        else:
+            candidates = []
+        while candidates:
+            (box_dist, node_id) = heapq.heappop(candidates)
+            if len(best) == k and box_dist > -best[0][0]:
+                break
+            node = self.nodes[node_id]
+            if node[4] is None:
+                (idx, dists) = self._leaf_distances(node, x)
+                for (pos, dist) in zip(idx.tolist(), dists.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-dist, pos))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, pos))
+            else:
+                for child in (node[4], node[5]):
+                    heapq.heappush(candidates, \
+                            (self._box_distance(self.nodes[child], x), child))
+        best = sorted((-d, pos) for (d, pos) in best)
+        return (numpy.array([d for (d, pos) in best]), \
+                numpy.array([pos for (d, pos) in best], dtype=numpy.intp))
+
+    def query_ball_point(self, x, r):
+        """ Positions of all points within distance r of x."""
+        x = numpy.asarray(x, dtype=numpy.float64)
+        found = []
+        stack = [0] if self.n > 0 else []
+        while stack:
+            node = self.nodes[stack.pop()]
+            if self._box_distance(node, x) > r:
+                continue
+            if node[4] is None:
+                (idx, dists) = self._leaf_distances(node, x)
+                found.extend(idx[dists <= r].tolist())
+            else:
+                stack.extend((node[4], node[5]))
+        return found
+
+class SphericalIndex(object):
+    """ Nearest neighbor and radius queries over a set of points, with
+        results measured in meters on the ellipsoid."""
+
+    def __init__(self, lats, lons, a=geodesy.WGS84_A, f=geodesy.WGS84_F):
+        self.lats = numpy.asarray(lats, dtype=numpy.float64)
+        self.lons = numpy.asarray(lons, dtype=numpy.float64)
+        self.a = a
+        self.f = f
+        self.count = len(self.lats)
+        vectors = unit_vectors(self.lats, self.lons)
+        if cKDTree is not None:
+            self.tree = cKDTree(vectors)
+        else:
+            self.tree = KDTree(vectors)
+        self.vectors = vectors
+
+    def _measure(self, lat, lon, positions):
+        """ Exact distances to the points at positions, nearest first."""
+        positions = numpy.asarray(positions, dtype=numpy.intp)
+        dists = geodesy.inverse(lat, lon, self.lats[positions], \
+                self.lons[positions], self.a, self.f)
+        order = numpy.argsort(dists, kind='mergesort')
+        return (positions[order], dists[order])
+
+    def within(self, lat, lon, radius, exclude=None):
+        """ Positions of, and distances to, every point within radius
+            meters of (lat, lon), nearest first. Optionally exclude one
+            position, e.g. the query point itself."""
+        x = unit_vectors([lat], [lon])[0]
+        candidates = self.tree.query_ball_point(x, \
+                chord_length(radius * SLACK))
+        if exclude is not None:
+            candidates = [c for c in candidates if c != exclude]
+        (positions, dists) = self._measure(lat, lon, candidates)
+        keep = dists <= radius
+        return (positions[keep], dists[keep])
+
+    def nearest(self, lat, lon, k=1, exclude=None):
+        """ Positions of, and distances to, the k nearest points to
+            (lat, lon), nearest first."""
+        available = self.count - (1 if exclude is not None else 0)
+        k = min(k, available)
+        if k <= 0:
+            return (numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0))
+        x = unit_vectors([lat], [lon])[0]
+        query_k = k + 1 if exclude is not None else k
+        (chords, positions) = self.tree.query(x, query_k)
+        chords = numpy.atleast_1d(chords)
+        # the chord ordering is spherical; gather anything that could be
+        # among the k nearest on the ellipsoid, then rank exactly.
+        radius = chord_distance(chords.max()) * SLACK
+        (positions, dists) = self.within(lat, lon, radius * SLACK, exclude)
+        return (positions[:k], dists[:k])
+
+    def pairs_within(self, radius, chunk_size=4096):
+        """
+        Every pair of points (i, j), i < j, within radius meters of each
+        other, as arrays of (i, j, distance). Points are bucketed into a 3D
+        grid of cells as wide as the search radius, so only points in
+        neighboring cells are ever compared, and cost scales with the
+        number of close pairs rather than the square of the input.
+        """
+        chord = chord_length(radius * SLACK)
+        cell_size = max(chord, MIN_CELL)
+        cells = numpy.floor(self.vectors / cell_size).astype(numpy.int64)
+        # shift cells to be positive, with room for the neighbor offsets.
+        cells -= cells.min(axis=0) - 1
+        span = int(cells.max()) + 2
+
+        def cell_keys(c):
+            return (c[:, 0] * span + c[:, 1]) * span + c[:, 2]
+
+        keys = cell_keys(cells)
+        order = numpy.argsort(keys, kind='mergesort')
+        (cell_ids, starts) = numpy.unique(keys[order], return_index=True)
+        counts = numpy.diff(numpy.append(starts, len(keys)))
+
+        (pairs_i, pairs_j) = ([], [])
+        offsets = numpy.array(list(itertools.product((-1, 0, 1), repeat=3)))
+        for start in range(0, self.count, chunk_size):
+            chunk = numpy.arange(start, min(start + chunk_size, self.count))
+            for offset in offsets:
+                neighbors = cell_keys(cells[chunk] + offset)
+                pos = numpy.searchsorted(cell_ids, neighbors)
+                pos[pos == len(cell_ids)] = 0
+                found = cell_ids[pos] == neighbors
+                if not found.any():
+                    continue
+                origins = chunk[found]
+                cell_starts = starts[pos[found]]
+                cell_counts = counts[pos[found]]
+                # pair each origin with every point in its neighbor cell.
+                total = cell_counts.sum()
+                first = numpy.cumsum(cell_counts) - cell_counts
+                within = numpy.arange(total) - numpy.repeat(first, cell_counts)
+                i = numpy.repeat(origins, cell_counts)
+                j = order[numpy.repeat(cell_starts, cell_counts) + within]
+                keep = i < j
+                (i, j) = (i[keep], j[keep])
+                diff = self.vectors[i] - self.vectors[j]
+                close = (diff ** 2).sum(axis=1) <= chord ** 2
+                pairs_i.append(i[close])
+                pairs_j.append(j[close])
+
+        if pairs_i:
+            i = numpy.concatenate(pairs_i)
+            j = numpy.concatenate(pairs_j)
+        else:
+            i = j = numpy.zeros(0, dtype=numpy.intp)
+        dists = geodesy.inverse(self.lats[i], self.lons[i], \
+                self.lats[j], self.lons[j], self.a, self.f)
+        keep = dists <= radius
+        # order pairs by row, then column.
+        (i, j, dists) = (i[keep], j[keep], dists[keep])
+        order = numpy.lexsort((j, i))
+        return (i[order], j[order], dists[order])
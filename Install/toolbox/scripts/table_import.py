@@ -0,0 +1,144 @@
+# table_import.py: stream text tables into a geodatabase
+# -*- coding: utf-8 -*-
+
+"""
+Imports a text table, compressed or not, into a geodatabase table without
+first writing out an uncompressed, validated copy for TableToTable. Rows are
+read, coerced to their column types and inserted in chunks of CHUNK_SIZE,
+so memory use is bounded by the chunk size rather than the file size.
+
+Column types follow the same rules as the schema.ini written for
+TableToTable: protected columns keep their configured type, and the rest
+are inferred from the first chunk of rows. Should a later row hold a value
+which doesn't fit, the import fails and the partly written table is
+removed; pass types for every column, as from table_schema, to avoid this.
+"""
+
+import itertools
+import os
+
+import arcpy
+
+import utils
+
+# rows read, coerced and inserted at a time.
+CHUNK_SIZE = 10000
+# field length of text columns, matching TableToTable's text fields.
+TEXT_LENGTH = 8000
+# range of values which fit a LONG field.
+LONG_RANGE = (-2 ** 31, 2 ** 31 - 1)
+# schema.ini column types, as geodatabase field types.
+FIELD_TYPES = {'text': 'TEXT', 'long': 'LONG', 'double': 'DOUBLE'}
+
+def chunks(rows, size=CHUNK_SIZE):
+    """ Lists of at most size rows, read as they're needed."""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def value_type(value):
+    """ The narrowest field type which can hold a text value."""
+    try:
+        number = int(value)
+        if LONG_RANGE[0] <= number <= LONG_RANGE[1]:
+            return 'LONG'
+        return 'DOUBLE'
+    except ValueError:
+        pass
+    try:
+        float(value)
+        return 'DOUBLE'
+    except ValueError:
+        return 'TEXT'
+
+def infer_types(header, rows, protected_map=None):
+    """ Field types for each column, from a sample of rows. Columns in
+        protected_map, of label to (1-based position, schema.ini type),
+        use the type given there."""
+    order = ['LONG', 'DOUBLE', 'TEXT']
+    types = ['LONG'] * len(header)
+    seen = [False] * len(header)
+    for row in rows:
+        for (i, value) in enumerate(row[:len(header)]):
+            if value == '' or types[i] == 'TEXT':
+                continue
+            seen[i] = True
+            found = value_type(value)
+            if order.index(found) > order.index(types[i]):
+                types[i] = found
+    # columns without any values can hold anything.
+    types = [t if s else 'TEXT' for (t, s) in zip(types, seen)]
+    for (idx, data_type) in (protected_map or {}).values():
+        if 0 < idx <= len(types):
+            types[idx - 1] = FIELD_TYPES.get(data_type.lower(), 'TEXT')
+    return types
+
+def coerce(value, field_type):
+    """ A text value as field_type; empty values become nulls."""
+    if value == '':
+        return None
+    if field_type == 'LONG':
+        return int(value)
+    if field_type == 'DOUBLE':
+        return float(value)
+    return value
+
+def coerce_rows(rows, header, types, first_row=1):
+    """ Coerce a chunk of rows to the column types, reporting the first
+        value which doesn't fit."""
+    coerced = []
+    for (n, row) in enumerate(rows, start=first_row):
+        # pad short rows, as TableToTable does.
+        row = row + [''] * (len(header) - len(row))
+        try:
+            coerced.append([coerce(v, t) for (v, t) in zip(row, types)])
+        except ValueError:
+            for (i, (v, t)) in enumerate(zip(row, types)):
+                try:
+                    coerce(v, t)
+                except ValueError:
+                    raise ValueError("Row {0}: `{1}` isn't a valid {2} value " \
+                            "for column {3}, whose type was inferred from " \
+                            "the first {4} rows.".format(n, v, t.lower(), \
+                            header[i], CHUNK_SIZE))
+    return coerced
+
+def import_table(input_file, output_table, protected_map=None, \
+        chunk_size=CHUNK_SIZE):
+    """
+    Import a text table, which may be compressed with gzip, bz2 or xz,
+    into a new geodatabase table. Column labels are validated as for
+    TableToTable. Returns the number of rows imported.
+    """
+    count = 0
+    with utils.read_table(input_file) as (header, table, dialect):
+        header = utils.validate_header(header)
+        rows = chunks(table, chunk_size)
+        first = next(rows, [])
+        types = infer_types(header, first, protected_map)
+        create_table(output_table, header, types)
+
+        try:
+            with arcpy.da.InsertCursor(output_table, header) as cursor:
+                for chunk in itertools.chain([first], rows):
+                    for row in coerce_rows(chunk, header, types, count + 1):
+                        cursor.insertRow(row)
+                    count += len(chunk)
+        except Exception:
+            # a later value which doesn't fit its column's type stops the
+            # import; don't leave the rows before it behind.
+            arcpy.Delete_management(output_table)
+            raise
+    return count
+
+def create_table(output_table, header, types):
+    """ An empty table with a field per column."""
+    (workspace, name) = os.path.split(output_table)
+    arcpy.CreateTable_management(workspace, name)
+    for (label, field_type) in zip(header, types):
+        length = TEXT_LENGTH if field_type == 'TEXT' else None
+        arcpy.AddField_management(output_table, label, field_type, \
+                field_length=length)
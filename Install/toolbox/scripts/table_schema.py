@@ -0,0 +1,197 @@
+# table_schema.py: column types from a scan of a whole text table
+# -*- coding: utf-8 -*-
+
+"""
+Works out the type of every column of a text table by scanning all of its
+rows, rather than guessing from the first row. Rows are read in chunks of
+table_import.CHUNK_SIZE and each column of a chunk is checked at once with
+NumPy conversions, so memory use is bounded by the chunk size.
+
+Each column is given a kind: integer, float, date, category (text with
+few distinct values), text, or allele for integer loci columns; columns
+without any values are empty. Kinds map to the schema.ini types used for
+protected columns, Long, Double or Text.
+
+Scanning is the slow part, so results are cached in the configuration
+directory, keyed by a hash of the file's contents.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+
+import numpy
+
+import config
+import dates
+import table_import
+import utils
+
+# bump when the rules change, so older cached results are ignored.
+SCHEMA_VERSION = 1
+# bytes read at a time when hashing an input file.
+HASH_BLOCK = 2 ** 20
+# text columns with at most this many distinct values are categories.
+CATEGORY_LIMIT = 32
+# columns holding allele codes; matches the Genetic group expression.
+ALLELE_COLUMN = '^l_'
+# schema.ini types of each kind of column.
+SCHEMA_TYPES = {
+    'empty': 'Text',
+    'allele': 'Long',
+    'integer': 'Long',
+    'float': 'Double',
+    'date': 'Text',
+    'category': 'Text',
+    'text': 'Text'
+}
+
+cache_dir = os.path.join(config.config_dir, 'schemas')
+# file hashes, keyed by path, size and modification time.
+_hashes = {}
+
+class ColumnProfile(object):
+    """ What's been seen of one column, updated a chunk at a time."""
+
+    def __init__(self, label):
+        self.label = label
+        self.count = 0
+        self.integer = True
+        self.number = True
+        self.date = True
+        self.low = None
+        self.high = None
+        # distinct values, until there are too many to be a category.
+        self.categories = set()
+
+    def update(self, values):
+        """ Check an array of text values against the kinds still open."""
+        present = values[values != '']
+        if len(present) == 0:
+            return
+        self.count += len(present)
+        if self.integer:
+            try:
+                numbers = present.astype(numpy.int64)
+                low = int(numbers.min())
+                high = int(numbers.max())
+                self.low = low if self.low is None else min(self.low, low)
+                self.high = high if self.high is None else max(self.high, high)
+            except (ValueError, OverflowError):
+                self.integer = False
+        if self.number and not self.integer:
+            try:
+                present.astype(numpy.float64)
+            except ValueError:
+                self.number = False
+        unique = None
+        if self.date:
+            unique = numpy.unique(present)
+            # columns whose values don't look like dates are ruled out
+            # without parsing them.
+            if dates.infer_layout(unique.tolist()) is None:
+                self.date = False
+            else:
+                (parsed, failed) = dates.parse_dates(unique)
+                self.date = not failed.any()
+        if self.categories is not None:
+            if unique is None:
+                unique = numpy.unique(present)
+            self.categories.update(unique.tolist())
+            if len(self.categories) > CATEGORY_LIMIT:
+                self.categories = None
+
+    def kind(self):
+        """ The narrowest kind holding every value seen."""
+        if self.count == 0:
+            return 'empty'
+        if self.integer:
+            (low, high) = table_import.LONG_RANGE
+            if self.low < low or self.high > high:
+                return 'float'
+            if re.search(ALLELE_COLUMN, self.label, re.IGNORECASE):
+                return 'allele'
+            return 'integer'
+        if self.number:
+            return 'float'
+        if self.date:
+            return 'date'
+        if self.categories is not None:
+            return 'category'
+        return 'text'
+
+def file_hash(input_file):
+    """ SHA-1 of a file's contents, remembered while it's unchanged."""
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_size, stat.st_mtime)
+    if key not in _hashes:
+        digest = hashlib.sha1()
+        with open(input_file, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), ''):
+                digest.update(block)
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+def scan_table(input_file, chunk_size=table_import.CHUNK_SIZE):
+    """ The kind of each column of a text table or workbook, keyed by
+        validated column label in column order."""
+    with utils.read_table(input_file) as (header, table, dialect):
+        header = utils.validate_header(header)
+        profiles = [ColumnProfile(label) for label in header]
+        width = len(header)
+        for chunk in table_import.chunks(table, chunk_size):
+            # pad short rows, as TableToTable does.
+            chunk = [row[:width] + [''] * (width - len(row)) for row in chunk]
+            for (profile, values) in zip(profiles, zip(*chunk)):
+                profile.update(numpy.array(values, dtype=str))
+    return collections.OrderedDict((p.label, p.kind()) for p in profiles)
+
+def cache_path(input_file):
+    return os.path.join(cache_dir, "{0}.json".format(file_hash(input_file)))
+
+def column_kinds(input_file):
+    """ The kind of each column of a text table, scanning it only when it
+        hasn't been seen before."""
+    path = cache_path(input_file)
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            if cached.get('version') == SCHEMA_VERSION:
+                return collections.OrderedDict( \
+                        (str(label), str(kind)) for (label, kind) in cached['columns'])
+        except (IOError, ValueError, KeyError):
+            # unreadable results are replaced below.
+            pass
+
+    kinds = scan_table(input_file)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(path, 'w') as f:
+            json.dump({'version': SCHEMA_VERSION, \
+                    'columns': kinds.items()}, f)
+    except (IOError, OSError) as e:
+        utils.msg("Unable to cache column types: {0}".format(e), \
+                mtype='warning')
+    return kinds
+
+def schema_types(input_file):
+    """ Every column as label to (1-based position, schema.ini type), the
+        form used for protected columns."""
+    kinds = column_kinds(input_file)
+    return collections.OrderedDict((label, (i, SCHEMA_TYPES[kind])) \
+            for (i, (label, kind)) in enumerate(kinds.items(), start=1))
+
+def protected_schema(input_file, protected_map=None):
+    """ Types for every column, keeping those already given in
+        protected_map."""
+    schema = schema_types(input_file)
+    protected = [idx for (idx, data_type) in (protected_map or {}).values()]
+    for (label, (idx, data_type)) in schema.items():
+        if idx in protected:
+            del schema[label]
+    schema.update(protected_map or {})
+    return schema
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import csv
 import collections
+import copy
 import sys
 import re
 import os
 import binascii
+import bz2
+import contextlib
+import gzip
 import itertools
+import multiprocessing
+import struct
 import traceback
 
 # enable local imports; redirect config calls to general config
@@ -24,6 +30,14 @@ except:
     """
     pass
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
 class Loci(object):
     """ A basic class to store the Loci attributes we commonly use."""
     def __init__(self, input_features):
@@ -34,6 +48,10 @@ class Loci(object):
 
     def loci_fields(self, input_features):
         """ Actual loci field names, e.g. L_Ev23_1."""
+        return cached_summary(input_features, 'loci_fields', \
+                lambda: self._loci_fields(input_features))
+
+    def _loci_fields(self, input_features):
         # map loci fields to values
         loci = collections.OrderedDict()
         # optional: use this to also filter if the genetic columns are up to date
@@ -75,6 +93,7 @@ class Haplotype(object):
         of the data contained within."""
 
     def __init__(self, input_features):
+        self.input_features = input_features
         self.column = self.haplotype_column(input_features)
         self.defined = self.defined()
         self.counter = self.haplotype_data(input_features)
@@ -84,6 +103,10 @@ class Haplotype(object):
 
     def haplotype_column(self, input_features):
         """ The column name containin the haplotype data."""
+        return cached_summary(input_features, 'haplotype_column', \
+                lambda: self._haplotype_column(input_features))
+
+    def _haplotype_column(self, input_features):
         haplo_col = None
         haplo_expr = '^haplotype|dlphap$'
         for field in [f.name for f in arcpy.ListFields(input_features)]:
@@ -101,15 +124,29 @@ class Haplotype(object):
 
     def haplotype_data(self, input_features):
         """ Counts of each haplotype type."""
-        # TODO: this currently just looks up all the data,
-        # better yet we should generate a table on import and keep it updated
-        # when edits are made to the input table.
+        # the counts are only read from the data the first time they're
+        # needed after an edit; see cached_summary.
+        return cached_summary(input_features, 'haplotype_data', \
+                lambda: self._haplotype_data(input_features))
+
+    def _haplotype_data(self, input_features):
+        # counts are kept in a table alongside the data, see haplotype_table.
+        import haplotype_table
         haplo_data = {}
         if self.defined:
-            res = [r[0] for r in arcpy.da.SearchCursor(input_features, [self.column])]
-            haplo_data = collections.Counter(filter(None, res))
+            haplo_data = haplotype_table.haplotype_counts(input_features, \
+                    self.column)
         return haplo_data
 
+    def population_counts(self, population_field):
+        """ Counts of each haplotype within each population."""
+        import haplotype_table
+        counts = collections.OrderedDict()
+        if self.defined:
+            counts = haplotype_table.population_counts(self.input_features, \
+                    self.column, population_field)
+        return counts
+
     def haplotype_names(self):
         """ Distinct haplotype names found."""
         return self.counter.keys()
@@ -136,6 +173,11 @@ class MissingCSVHeader(Exception):
         self.csv = csv
         Exception.__init__(self, "CSV file is missing a header: {}".format(csv))
 
+class UnknownType(Exception):
+    def __init__(self, filename):
+        self.filename = filename
+        Exception.__init__(self, "Unknown input file type: {}".format(filename))
+
 def parameters_from_args(defaults_tuple=None, sys_args=None):
     """Provided a set of tuples for default values, return a list of mapped
        variables."""
@@ -181,6 +223,41 @@ def msg(output_msg, mtype='message', exception=None):
         elif mtype == 'warning':
             arcpy.AddWarning(output_msg)
 
+# compressed file extensions, and the modules which can read them.
+compression_types = collections.OrderedDict([
+    ('.gz', 'gzip'),
+    ('.bz2', 'bz2'),
+    ('.xz', 'xz')
+])
+
+def compression(filename):
+    """ The compression of a file, from its extension: gzip, bz2, xz or
+        None for uncompressed files."""
+    ext = os.path.splitext(filename)[1].lower()
+    return compression_types.get(ext)
+
+def uncompressed_name(filename):
+    """ The file name without any compression extension, e.g. data.csv
+        for data.csv.gz."""
+    if compression(filename) is not None:
+        return os.path.splitext(filename)[0]
+    return filename
+
+def open_text_table(filename):
+    """ Open a text table for reading, decompressing it as it's read when
+        it has a compression extension."""
+    method = compression(filename)
+    if method == 'gzip':
+        return gzip.open(filename, 'rb')
+    elif method == 'bz2':
+        return bz2.BZ2File(filename, 'rb')
+    elif method == 'xz':
+        if lzma is None:
+            raise ImportError("Reading .xz files requires the lzma module, " \
+                    "available for Python 2.7 as backports.lzma.")
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
 def file_type(filename):
     """ Map of 'known' extensions to filetypes."""
     expected_type = None
@@ -192,89 +269,133 @@ def file_type(filename):
         '.xls' : 'Excel',
         '.xlsx': 'Excel',
     }
-    ext = os.path.splitext(filename)[1].lower()
+    # compressed files are typed by the extension they were compressed from.
+    ext = os.path.splitext(uncompressed_name(filename))[1].lower()
     if known_types.has_key(ext):
         expected_type = known_types[ext]
-    else:
-        raise UnknownType
+    if expected_type is None or (compression(filename) is not None and \
+            expected_type != 'Text'):
+        raise UnknownType(filename)
     return expected_type
 
+# bytes sampled from the start of a text table to determine its dialect.
+SNIFF_SIZE = 4096
+
+def table_reader(input_table, input_file=None):
+    """ Sniff the dialect of an open text table from its first few
+        kilobytes. Returns its header, a csv reader positioned at the first
+        data row, and the dialect."""
+    sample = input_table.read(SNIFF_SIZE)
+    sniffer = csv.Sniffer()
+    if not sniffer.has_header(sample):
+        # require the input to have a valid header
+        raise MissingCSVHeader(input_file)
+    dialect = sniffer.sniff(sample)
+    # reset reading
+    input_table.seek(0)
+    # for reading, rely on dialect parsing to correctly dermine
+    # the input file's traits (e.g. proper quoting).
+    table = csv.reader(input_table, dialect=dialect)
+    # pull off the first line of the CSV
+    header = table.next()
+    return (header, table, dialect)
+
+@contextlib.contextmanager
+def read_table(input_file):
+    """
+    Read a text table or an Excel workbook, as a context manager giving its
+    header, an iterator over the rows which follow and its dialect. Rows
+    are lists of strings either way; see excel_table for how workbook
+    cells are written as text.
+    """
+    try:
+        excel = file_type(input_file) == 'Excel'
+    except UnknownType:
+        # read anything else as text, leaving the csv module to judge it.
+        excel = False
+    if excel:
+        import excel_table
+        rows = excel_table.sheet_rows(input_file)
+        try:
+            header = next(rows, None)
+            if not header:
+                raise MissingCSVHeader(input_file)
+            yield (header, rows, csv.excel)
+        finally:
+            rows.close()
+    else:
+        with open_text_table(input_file) as input_table:
+            yield table_reader(input_table, input_file)
+
 def parse_table(input_file):
     """ Parse a text table (usually CSV) determine its type,
         and validate."""
     # TODO: handle UTF-8 encodings robustly
-    header = None
-    data = None
-    dialect = None
-    try:
-        with open(input_file, 'rb') as input_table:
-            # sample the first 4k of the file
-            sample = input_table.read(4096)
-            sniffer = csv.Sniffer()
-
-            if not sniffer.has_header(sample):
-                # require the input to have a valid header
-                raise MissingCSVHeader
-            else:
-                dialect = sniffer.sniff(sample)
-                # reset reading
-                input_table.seek(0)
-                # for reading, rely on dialect parsing to correctly dermine
-                # the input file's traits (e.g. proper quoting).
-                table = csv.reader(input_table, dialect=dialect)
-
-                # pull off the first line of the CSV
-                header = table.next()
-                data = []
-                for row in table:
-                    data.append(row)
-    except Exception as e:
-        raise e
+    with read_table(input_file) as (header, table, dialect):
+        data = [row for row in table]
     return (header, data, dialect)
 
+def table_header(input_file, sample_rows=1):
+    """ The header of a text table, its first sample_rows rows of data and
+        its dialect, reading only the start of the file."""
+    with read_table(input_file) as (header, table, dialect):
+        sample = list(itertools.islice(table, sample_rows))
+    return (header, sample, dialect)
+
 # TODO: ADD TEST CASES FOR:
 #  - quoted strings inside CSV fields
 #  - our various validations in validate_column_label.
 
-def validate_table(input_file):
-    (header, data, dialect) = parse_table(input_file)
-
+def validate_header(header):
+    """ Column labels valid for ArcGIS, with repeated labels numbered."""
     # Handle multiple columns with the same name
     validated_header = []
     # Generate a list of columns which have duplicate names.
-    duplicate_cols = set([i for i in header if header.count(i) > 1])
-    duplicate_positions = collections.Counter(duplicate_cols)
+    counts = collections.Counter(header)
+    # number repeated labels from 1, e.g. L_Ev1_1, L_Ev1_2.
+    duplicate_positions = collections.Counter(dict.fromkeys(counts, 1))
     for col in header:
         label = validate_column_label(col)
         # handle the duplicate columns, labeling each item uniquely
-        if col in duplicate_cols:
+        if counts[col] > 1:
             # get current dupe position
             label = label + "_" + str(duplicate_positions[col])
             duplicate_positions[col] += 1
         validated_header.append(label)
+    return validated_header
 
+def validate_table(input_file):
+    """ Write a copy of a text table with a validated header, alongside the
+        original. Rows are copied as they're read, in a single pass."""
     # set up output file name
     temp_dir = os.path.dirname(input_file)
-    (label, ext) = os.path.splitext(os.path.basename(input_file))
+    (label, ext) = os.path.splitext(os.path.basename(uncompressed_name(input_file)))
+    if ext.lower() in ('.xls', '.xlsx'):
+        # workbooks are copied out as CSV.
+        ext = '.csv'
 
     # generate a random name, but include the original file suffix for Arc
     temp_name = binascii.b2a_hex(os.urandom(15))
     tmp_fn = "".join([temp_name, ext])
     temp_csv = os.path.join(temp_dir, tmp_fn)
 
-    with open(temp_csv, 'wb') as output_file:
-        writer = csv.writer(output_file, dialect=dialect, quotechar='"', quoting=csv.QUOTE_ALL)
-        writer.writerow(validated_header)
-        for row in data:
-            writer.writerow(row)
+    with read_table(input_file) as (header, table, dialect):
+        with open(temp_csv, 'wb') as output_file:
+            writer = csv.writer(output_file, dialect=dialect, quotechar='"', quoting=csv.QUOTE_ALL)
+            writer.writerow(validate_header(header))
+            writer.writerows(table)
     return temp_csv
 
 def validated_table_results(input_file):
-    validated_table = validate_table(input_file)
-    table_parts = parse_table(validated_table)
-    # delete the temporary table generated; only want the components in this case.
-    os.unlink(validated_table)
-    return table_parts
+    """ The validated header, data and dialect of a text table."""
+    (header, data, dialect) = parse_table(input_file)
+    return (validate_header(header), data, dialect)
+
+def validated_table_header(input_file, sample_rows=1):
+    """ The validated header of a text table with its first rows of data,
+        reading only the start of the file; see table_header."""
+    (header, sample, dialect) = table_header(input_file, sample_rows)
+    return (validate_header(header), sample, dialect)
 
 def validate_column_label(column):
     """
@@ -377,6 +498,148 @@ def zrep(s):
         return 0
     return s
 
+def geodatabase(path):
+    """ The file geodatabase holding path, or None if it isn't in one."""
+    gdb = path
+    while gdb and not gdb.lower().endswith('.gdb'):
+        parent = os.path.dirname(gdb)
+        if parent == gdb:
+            return None
+        gdb = parent
+    return gdb or None
+
+# files of a file geodatabase which change without its data being edited:
+# its system tables, which list the others, and locks taken by readers.
+SYSTEM_FILES = r'^a0000000[1-4]\.|^gdb$|^timestamps$|\.lock$'
+
+def varuint(n):
+    """ n as the variable length unsigned integer of the file geodatabase
+        format: 7 bits a byte, least significant first."""
+    encoded = ''
+    while n > 0x7f:
+        encoded += chr(n & 0x7f | 0x80)
+        n >>= 7
+    return encoded + chr(n)
+
+def table_files(gdb, name):
+    """
+    Names of the files of the table or feature class `name` within a file
+    geodatabase, or None if they can't be found. Tables are stored in files
+    named for their row in the system catalog, a00000001, which is read
+    here through its index of row offsets, a00000001.gdbtablx.
+    """
+    catalog = os.path.join(gdb, 'a00000001')
+    # names are stored as UTF-8, after their length in bytes.
+    encoded = unicode(name).encode('utf-8')
+    wanted = (varuint(len(encoded)) + encoded).lower()
+    try:
+        with open(catalog + '.gdbtablx', 'rb') as f:
+            (magic, blocks, rows, size) = struct.unpack('<4i', f.read(16))
+            offsets = f.read(blocks * 1024 * size)
+            # catalogs of many tables map their rows to offsets through a
+            # bitmap, which isn't read here.
+            (words, total, present, leading) = \
+                    struct.unpack('<4i', f.read(16))
+            if words != 0:
+                return None
+        with open(catalog + '.gdbtable', 'rb') as table:
+            for row in range(len(offsets) // size):
+                raw = offsets[row * size:(row + 1) * size]
+                offset = sum(ord(b) << (8 * i) for (i, b) in enumerate(raw))
+                # deleted rows have no offset.
+                if offset == 0:
+                    continue
+                table.seek(offset)
+                (length,) = struct.unpack('<i', table.read(4))
+                if wanted in table.read(length).lower():
+                    prefix = 'a{0:08x}.'.format(row + 1)
+                    return [f for f in os.listdir(gdb) \
+                            if f.lower().startswith(prefix)]
+    except (IOError, OSError, struct.error):
+        pass
+    return None
+
+def dataset_signature(input_features):
+    """
+    A value which changes whenever a dataset is edited, for invalidating
+    caches built from it: its path, with the latest modification time of
+    the files backing it. Those are the shapefile and its sidecar files, or
+    the files of the feature class within its file geodatabase, so edits
+    to other data in the geodatabase, such as geneGIS' own tables, leave it
+    as is. Layers also include their selection and definition query.
+    Returns None for data which isn't backed by files, such as in_memory,
+    which can't be cached safely.
+    """
+    desc = arcpy.Describe(input_features)
+    path = desc.catalogPath
+    layer = ()
+    if getattr(desc, 'dataType', None) in ('FeatureLayer', 'Layer'):
+        layer = (getattr(desc, 'FIDSet', ''), \
+                getattr(desc, 'whereClause', ''))
+    if path.lower().startswith('in_memory'):
+        return None
+
+    if os.path.isfile(path):
+        # shapefiles, stored alongside their sidecar files.
+        base = os.path.splitext(path)[0]
+        directory = os.path.dirname(path)
+        files = [os.path.join(directory, f) for f in os.listdir(directory) \
+                if os.path.splitext(os.path.join(directory, f))[0] == base]
+    else:
+        # feature classes live within a geodatabase, perhaps inside a
+        # feature dataset.
+        gdb = geodatabase(path)
+        if gdb is None or not os.path.isdir(gdb):
+            return None
+        names = table_files(gdb, os.path.basename(path))
+        if names is None:
+            # without the catalog, any edit to the geodatabase counts.
+            names = [f for f in os.listdir(gdb) \
+                    if not re.search(SYSTEM_FILES, f)]
+        files = [os.path.join(gdb, f) for f in names]
+
+    mtimes = [os.path.getmtime(f) for f in files if os.path.isfile(f)]
+    if not mtimes:
+        return None
+    return (path, max(mtimes), len(mtimes)) + layer
+
+# number of summaries to keep, see cached_summary.
+SUMMARY_CACHE_SIZE = 64
+_summary_cache = collections.OrderedDict()
+
+def cached_summary(input_features, name, compute):
+    """
+    The summary `name` of input_features, such as its loci fields, as
+    returned by compute(). Results are kept per dataset_signature, so a
+    summary is only recomputed once the dataset has been edited. Callers
+    get their own copy, and can modify it freely.
+    """
+    signature = dataset_signature(input_features)
+    if signature is None:
+        return compute()
+    key = (signature, name)
+    if key in _summary_cache:
+        summary = _summary_cache.pop(key)
+    else:
+        summary = compute()
+    # keep the most recently used summaries at the end.
+    _summary_cache[key] = summary
+    while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+        _summary_cache.popitem(last=False)
+    return copy.deepcopy(summary)
+
+def worker_count():
+    """ Number of worker processes to use for parallel computations."""
+    workers = int(settings.distance_workers)
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    if workers > 1 and settings.mode == 'toolbox' and os.name == 'nt':
+        # within ArcGIS, sys.executable is the host application; start
+        # workers with the Python interpreter instead.
+        multiprocessing.set_executable(
+                os.path.join(sys.exec_prefix, 'pythonw.exe'))
+    return workers
+
 # FIXME: duplicated from Install\utils.py
 def currentLayers():
     # find layers in current map document
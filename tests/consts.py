@@ -8,6 +8,7 @@ data_path = os.path.join(local_path, 'data')
 test_csv_doc = os.path.join(data_path, 'SRGD_example.csv')
 test_csv_with_comment_field = os.path.join(data_path, 'SRGD_with_comment_field.csv')
 test_csv_full = os.path.join(data_path, 'SRGD_export_demodna.csv.gz')
+test_xlsx_doc = os.path.join(data_path, 'SRGD_example.xlsx')
 
 # A File Geodatabasee with an imported SRGD file and test raster.
 test_fgdb = os.path.join(data_path, 'example.gdb')
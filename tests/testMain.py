@@ -7,6 +7,8 @@ import csv
 import datetime
 import gzip
 import hashlib
+import json
+import numpy
 import xlrd
 import zipfile
 from collections import Counter
@@ -22,7 +24,11 @@ utils.addLocalPaths(import_paths)
 from tempdir import TempDir
 from scripts import ClassifiedImport, DistanceMatrix, ShortestDistancePaths, \
         ExtractRasterValuesToPoints, ExportToGenAlEx, ExportToSRGD, ExportToAIS, \
-        ExportToGenepop, IndividualPaths, SelectByAttributes, utils as script_utils
+        ExportToGenepop, IndividualPaths, SelectByAttributes, column_groups, \
+        cost_distance, dates, excel_table, feature_import, genotype, \
+        genotype_qc, geodesy, \
+        haplotype_table, import_record, matrix_store, matrix_writer, \
+        spatial_index, table_import, table_schema, utils as script_utils
 
 # A GDB for our test results
 class CoreFGDB(object):
@@ -149,6 +155,284 @@ class TestQuotedMultilineInput(unittest.TestCase):
         # clean up
         arcpy.Delete_management(self.output_fc)
 
+class TestValidateTable(unittest.TestCase):
+    """ Test the streaming validation of text tables."""
+    def setUp(self):
+        self.input_table = consts.test_csv_with_comment_field
+        self.temp_csv = None
+
+    def testValidateHeader(self):
+        header = script_utils.validate_header(['ID', 'Sample ID', 'ID'])
+        self.assertEqual(header, ['ID_1', 'Sample_ID', 'ID_2'])
+
+    def testHeaderMatchesTable(self):
+        (header, data, dialect) = script_utils.validated_table_results( \
+                self.input_table)
+        (fast_header, sample, fast_dialect) = \
+                script_utils.validated_table_header(self.input_table)
+        self.assertEqual(fast_header, header)
+        self.assertEqual(sample, data[:1])
+
+    def testValidatedCopy(self):
+        (header, data, dialect) = script_utils.validated_table_results( \
+                self.input_table)
+        self.temp_csv = script_utils.validate_table(self.input_table)
+        (copy_header, copy_data, copy_dialect) = \
+                script_utils.parse_table(self.temp_csv)
+        self.assertEqual(copy_header, header)
+        self.assertEqual(copy_data, data)
+
+    def testExcelMatchesText(self):
+        # workbooks are read as rows of text, as their CSV export would be.
+        (header, data, dialect) = script_utils.validated_table_results( \
+                consts.test_csv_doc)
+        (xlsx_header, xlsx_data, xlsx_dialect) = \
+                script_utils.validated_table_results(consts.test_xlsx_doc)
+        self.assertEqual(xlsx_header, header)
+        self.assertEqual(xlsx_data, data)
+
+    def tearDown(self):
+        if self.temp_csv is not None:
+            os.remove(self.temp_csv)
+
+class TestExcelTable(unittest.TestCase):
+    """ Test reading workbooks as rows of text."""
+
+    def setUp(self):
+        self.d = TempDir()
+
+    def testPhoneticRunsLeftOut(self):
+        ns = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+        path = os.path.join(self.d.name, 'phonetic.xlsx')
+        with zipfile.ZipFile(path, 'w') as workbook:
+            workbook.writestr('xl/workbook.xml', '<workbook xmlns="%s" ' \
+                    'xmlns:r="%s"><sheets><sheet name="Samples" sheetId="1" ' \
+                    'r:id="rId1"/></sheets></workbook>' % (ns, \
+                    excel_table.REL_NS))
+            workbook.writestr('xl/_rels/workbook.xml.rels', \
+                    '<Relationships xmlns="%s"><Relationship Id="rId1" ' \
+                    'Target="worksheets/sheet1.xml"/></Relationships>' % \
+                    excel_table.PACKAGE_NS)
+            workbook.writestr('xl/sharedStrings.xml', '<sst xmlns="%s">' \
+                    '<si><t>Sample_ID</t><rPh sb="0" eb="6"><t>x</t></rPh>' \
+                    '</si><si><r><t>Hap</t></r><r><t>lotype</t></r>' \
+                    '<rPh sb="0" eb="3"><t>y</t></rPh></si></sst>' % ns)
+            workbook.writestr('xl/worksheets/sheet1.xml', '<worksheet ' \
+                    'xmlns="%s"><sheetData><row r="1"><c r="A1" t="s">' \
+                    '<v>0</v></c><c r="B1" t="s"><v>1</v></c></row>' \
+                    '<row r="3"><c r="A3"><v>7</v></c><c r="B3" ' \
+                    't="inlineStr"><is><t>A+</t><rPh><t>z</t></rPh></is>' \
+                    '</c></row></sheetData></worksheet>' % ns)
+        self.assertEqual(list(excel_table.sheet_rows(path)), \
+                [['Sample_ID', 'Haplotype'], [], ['7', 'A+']])
+
+class TestDates(unittest.TestCase):
+    """ Test parsing of date columns."""
+
+    def testMixedLayouts(self):
+        values = ['2006-3-18T16:48', '2006-03-18 16:48:05', '9/26/04', \
+                '3/9/2004 13:05', '2006-3-18T16:48']
+        (parsed, failed) = dates.parse_dates(values)
+        self.assertFalse(failed.any())
+        self.assertEqual(parsed.tolist(), [
+                datetime.datetime(2006, 3, 18, 16, 48),
+                datetime.datetime(2006, 3, 18, 16, 48, 5),
+                datetime.datetime(2004, 9, 26),
+                datetime.datetime(2004, 3, 9, 13, 5),
+                datetime.datetime(2006, 3, 18, 16, 48)])
+
+    def testFailuresReported(self):
+        values = ['2006-3-18T16:48', '2005-2-29', '', 'not a date']
+        (parsed, failed) = dates.parse_dates(values)
+        self.assertEqual(failed.tolist(), [False, True, True, True])
+
+        message = dates.describe_failures(values, failed)
+        self.assertTrue(message.startswith("3 dates"))
+        self.assertTrue("4 (`not a date`)" in message)
+
+class TestTableSchema(unittest.TestCase):
+    """ Test column types inferred from a scan of the whole table."""
+
+    def setUp(self):
+        self.d = TempDir()
+
+    def testLateValuesCount(self):
+        path = os.path.join(self.d.name, 'late_values.csv')
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Sample_ID', 'Latitude', 'Date_Time', 'L_Ev1'])
+            for i in range(40):
+                writer.writerow([i, 11, '2006-3-18', 180])
+            writer.writerow(['A-40', 11.5, '9/26/04', 182])
+        kinds = table_schema.scan_table(path, chunk_size=10)
+        self.assertEqual(kinds.values(), ['text', 'float', 'date', 'allele'])
+
+        types = table_schema.protected_schema(path, {'L_Ev1': (4, 'Text')})
+        self.assertEqual(types['Sample_ID'], (1, 'Text'))
+        self.assertEqual(types['L_Ev1'], (4, 'Text'))
+
+    def testCachedByContents(self):
+        input_table = consts.test_csv_doc
+        kinds = table_schema.column_kinds(input_table)
+        self.assertTrue(os.path.exists(table_schema.cache_path(input_table)))
+        self.assertEqual(table_schema.column_kinds(input_table), kinds)
+        self.assertEqual(kinds['Haplotype'], 'category')
+
+class TestTableImport(unittest.TestCase):
+    """ Test streaming text tables into a geodatabase table."""
+
+    def setUp(self):
+        self.d = TempDir()
+        arcpy.CreateFileGDB_management(self.d.name, 'tables')
+        self.output_table = os.path.join(self.d.name, 'tables.gdb', 'late')
+
+    def testLateTextRemovesTable(self):
+        # types are inferred from the first chunk; a later value which
+        # doesn't fit fails the import without leaving a partial table.
+        path = os.path.join(self.d.name, 'late_text.csv')
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Sample_ID', 'Latitude'])
+            for i in range(40):
+                writer.writerow([i, 11])
+            writer.writerow(['A-40', 11.5])
+        with self.assertRaises(ValueError):
+            table_import.import_table(path, self.output_table, chunk_size=10)
+        self.assertFalse(arcpy.Exists(self.output_table))
+
+        # with types from a scan of the whole table, it imports.
+        schema = table_schema.protected_schema(path)
+        count = table_import.import_table(path, self.output_table, schema, \
+                chunk_size=10)
+        self.assertEqual(count, 41)
+
+class TestColumnGroups(unittest.TestCase):
+    """ Test the import dialog's classification of input columns."""
+
+    def setUp(self):
+        self.d = TempDir()
+
+    def testClassifiedOnce(self):
+        input_table = consts.test_csv_doc
+        classification = column_groups.classify(input_table)
+        self.assertTrue(column_groups.classify(input_table) is classification)
+        self.assertEqual(classification.groups['Identification'], \
+                ['Sample_ID', 'Individual_ID'])
+        self.assertEqual(classification.groups['Other'], \
+                ['Date_Time', 'Region'])
+        self.assertEqual(classification.types['Sex'], (7, 'Text'))
+        self.assertEqual(classification.modified_columns(), [])
+
+    def testPreferredTypes(self):
+        types = column_groups.import_types(consts.test_csv_doc, \
+                {'Sample_ID': (1, 'Text')})
+        self.assertEqual(types['Sample_ID'], (1, 'Text'))
+        self.assertEqual(types['Individual_ID'], (2, 'Long'))
+        self.assertEqual(types['Latitude'], (3, 'Double'))
+
+    def testFixedTypes(self):
+        # numeric haplotype codes are still imported as text.
+        path = os.path.join(self.d.name, 'numbered_haplotypes.csv')
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Sample_ID', 'Latitude', 'Longitude', \
+                    'Haplotype'])
+            for i in range(5):
+                writer.writerow([i, 11, -85, i % 2 + 1])
+        types = column_groups.import_types(path)
+        self.assertEqual(types['Haplotype'], (4, 'Text'))
+        self.assertEqual(types['Sample_ID'], (1, 'Long'))
+
+        types = column_groups.import_types(path, {'Haplotype': (4, 'Long')})
+        self.assertEqual(types['Haplotype'], (4, 'Long'))
+
+class TestGenotypeQC(unittest.TestCase):
+    """ Test the checks run over allele columns at import."""
+
+    def setUp(self):
+        self.d = TempDir()
+
+    def testCleanInput(self):
+        (header, columns) = feature_import.read_columns(consts.test_csv_doc)
+        report = genotype_qc.check_columns(header, columns, 'Sample_ID')
+        self.assertEqual(report['samples'], 17)
+        self.assertEqual(report['loci'], 4)
+        self.assertEqual(report['problems'], [])
+        locus = report['loci_summary'][0]
+        self.assertEqual(locus['locus'], 'GATA417')
+        self.assertEqual(locus['digits'], 3)
+
+    def testBrokenCalls(self):
+        path = os.path.join(self.d.name, 'broken.csv')
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Sample_ID', 'L_Ev1_1', 'L_Ev1_2'])
+            for i in range(40):
+                writer.writerow([i, 180, 182])
+            writer.writerow(['typo', '18O', 182])
+            writer.writerow(['partial', 180, 0])
+            writer.writerow(['digit', 1820, 182])
+            writer.writerow(['missing', '', ''])
+        (header, columns) = feature_import.read_columns(path)
+        output_fc = os.path.join(self.d.name, 'qc.gdb', 'broken')
+        report = genotype_qc.check_genotypes(header, columns, output_fc, \
+                'Sample_ID')
+        problems = dict((p['sample'], p['problem']) for p in report['problems'])
+        self.assertEqual(problems, {'typo': 'non-numeric', \
+                'partial': 'partial', 'digit': 'length'})
+        self.assertEqual(report['samples_missing'][0]['sample'], 'missing')
+        self.assertEqual(report['loci_summary'][0]['max'], 1820)
+
+        path = os.path.join(self.d.name, 'broken_QC.json')
+        self.assertEqual(genotype_qc.report_path(output_fc), path)
+        with open(path) as f:
+            self.assertEqual(json.load(f)['problem_counts']['partial'], 1)
+
+    def testChunkedChecks(self):
+        # checking a file a chunk at a time matches checking it whole.
+        input_table = consts.test_csv_full
+        (header, columns) = feature_import.read_columns(input_table)
+        report = genotype_qc.check_columns(header, columns, 'Sample_ID')
+        chunked = genotype_qc.check_chunks(header, lambda: \
+                feature_import.read_chunks(input_table, 100), 'Sample_ID')
+        for key in ('samples', 'problem_counts', 'loci_summary', \
+                'samples_missing'):
+            self.assertEqual(chunked[key], report[key])
+        self.assertAlmostEqual(chunked['missing_rate'], \
+                report['missing_rate'])
+
+class TestFeatureImport(unittest.TestCase):
+    """ Test the NumPy import of text tables as features."""
+
+    def testColumnTypes(self):
+        self.assertEqual(feature_import.column_type( \
+                numpy.array(['1', '', '-20'])), 'LONG')
+        self.assertEqual(feature_import.column_type( \
+                numpy.array(['1', '2147483648'])), 'DOUBLE')
+        self.assertEqual(feature_import.column_type( \
+                numpy.array(['1.5', 'nan'])), 'DOUBLE')
+        self.assertEqual(feature_import.column_type( \
+                numpy.array(['1', 'A-1'])), 'TEXT')
+
+    def testReadChunks(self):
+        (header, columns) = feature_import.read_columns(consts.test_csv_doc)
+        chunks = list(feature_import.read_chunks(consts.test_csv_doc, 5))
+        self.assertEqual([len(c[0]) for (h, c) in chunks], [5, 5, 5, 2])
+        for (i, values) in enumerate(columns):
+            self.assertEqual(numpy.concatenate([c[i] for (h, c) in \
+                    chunks]).tolist(), values.tolist())
+
+    def testCompressedStreamed(self):
+        # compressed input is never read into memory whole.
+        self.assertTrue(feature_import.fits_in_memory(consts.test_csv_doc))
+        self.assertFalse(feature_import.fits_in_memory(consts.test_csv_full))
+        self.assertFalse(feature_import.fits_in_memory(consts.test_xlsx_doc))
+
+    def testLongNumbers(self):
+        # too many digits for a 64-bit integer.
+        values = numpy.array(['12345678901234567890123', '5'])
+        self.assertEqual(feature_import.column_type(values), 'DOUBLE')
+
 # class tests
 class TestLoci(unittest.TestCase):
 
@@ -195,6 +479,151 @@ class TestHaplotype(unittest.TestCase):
         self.assertEqual(haplotype.names, self.haplotype_names)
         self.assertEqual(haplotype.counter, self.counts)
 
+    def testCachedSummary(self):
+        first = script_utils.Haplotype(self.input_features)
+        first.counter['F2'] = 0
+        # summaries are cached, but each instance has its own copy.
+        second = script_utils.Haplotype(self.input_features)
+        self.assertEqual(second.counter, self.counts)
+        self.assertEqual(second.column, 'Haplotype')
+
+class TestDatasetSignature(unittest.TestCase):
+    """ Test the signatures which invalidate cached summaries."""
+
+    def setUp(self):
+        self.input_fc = os.path.join(fgdb.path, 'test_signature')
+        self.other_fc = os.path.join(fgdb.path, 'test_signature_other')
+        arcpy.CopyFeatures_management(fgdb.input_fc, self.input_fc)
+
+    def testTableFiles(self):
+        files = script_utils.table_files(consts.test_fgdb, 'SRGD_tiny_Spatial')
+        self.assertTrue('a00000012.gdbtable' in files)
+        self.assertTrue(all(f.startswith('a00000012.') for f in files))
+        self.assertEqual(script_utils.table_files(consts.test_fgdb, \
+                'SRGD_tiny'), None)
+
+    def testOtherEditsIgnored(self):
+        signature = script_utils.dataset_signature(self.input_fc)
+        # other data in the same geodatabase doesn't change the signature.
+        arcpy.CopyFeatures_management(fgdb.input_fc, self.other_fc)
+        self.assertEqual(script_utils.dataset_signature(self.input_fc), \
+                signature)
+        with arcpy.da.UpdateCursor(self.input_fc, ['Haplotype']) as cursor:
+            for row in cursor:
+                cursor.updateRow(['Z2'])
+                break
+        self.assertNotEqual(script_utils.dataset_signature(self.input_fc), \
+                signature)
+
+    def tearDown(self):
+        for path in (self.input_fc, self.other_fc):
+            if arcpy.Exists(path):
+                arcpy.Delete_management(path)
+
+class TestHaplotypeTable(unittest.TestCase):
+
+    def setUp(self):
+        self.input_fc = os.path.join(fgdb.path, 'test_haplotype_table')
+        arcpy.CopyFeatures_management(fgdb.input_fc, self.input_fc)
+        self.scanned = haplotype_table.scan(self.input_fc, 'Haplotype', \
+                [haplotype_table.ALL, 'Region'])
+
+    def testImportCreatesTable(self):
+        self.assertTrue(arcpy.Exists(haplotype_table.table_path(fgdb.input_fc)))
+
+    def testStoredCounts(self):
+        counts = haplotype_table.haplotype_counts(self.input_fc, 'Haplotype')
+        self.assertEqual(counts, self.scanned.overall())
+        # read back from the table, rather than counted again.
+        stored = haplotype_table.read_table( \
+                haplotype_table.table_path(self.input_fc))
+        self.assertEqual(stored.overall(), self.scanned.overall())
+
+        by_region = haplotype_table.population_counts(self.input_fc, \
+                'Haplotype', 'Region')
+        self.assertEqual(by_region, self.scanned.by_population('Region'))
+
+    def testUpdateCounts(self):
+        haplotype_table.population_counts(self.input_fc, 'Haplotype', 'Region')
+        before = haplotype_table.fingerprint(self.input_fc)
+        with arcpy.da.InsertCursor(self.input_fc, \
+                ['SHAPE@XY', 'Haplotype', 'Region']) as cursor:
+            cursor.insertRow(((-120.0, 35.0), 'Z1', 'Test'))
+        haplotype_table.update_counts(self.input_fc, 'Haplotype', \
+                added=[{'Haplotype': 'Z1', 'Region': 'Test'}], signature=before)
+
+        stored = haplotype_table.read_table( \
+                haplotype_table.table_path(self.input_fc))
+        self.assertEqual(stored.overall()['Z1'], 1)
+        self.assertEqual(stored.by_population('Region')['Test']['Z1'], 1)
+        self.assertEqual(stored.total, \
+                haplotype_table.feature_count(self.input_fc))
+
+    def testEditedValuesRecounted(self):
+        haplotype_table.haplotype_counts(self.input_fc, 'Haplotype')
+        # an edit which leaves the number of features unchanged.
+        with arcpy.da.UpdateCursor(self.input_fc, ['Haplotype']) as cursor:
+            for row in cursor:
+                cursor.updateRow(['Z2'])
+                break
+        counts = haplotype_table.haplotype_counts(self.input_fc, 'Haplotype')
+        self.assertEqual(counts['Z2'], 1)
+
+    def testStoringKeepsSignature(self):
+        signature = script_utils.dataset_signature(self.input_fc)
+        haplotype_table.population_counts(self.input_fc, 'Haplotype', 'Region')
+        # writing the counts isn't an edit of the features.
+        self.assertEqual(script_utils.dataset_signature(self.input_fc), \
+                signature)
+
+    def tearDown(self):
+        arcpy.Delete_management(haplotype_table.table_path(self.input_fc))
+        arcpy.Delete_management(self.input_fc)
+
+class TestGenotype(unittest.TestCase):
+
+    def setUp(self):
+        self.input_features = consts.test_fgdb_fc
+        self.loci = script_utils.Loci(self.input_features)
+
+    def testMatchesCursor(self):
+        genotypes = genotype.genotype_matrix(self.input_features, \
+                'Individual_ID', loci=self.loci)
+        fields = ['Individual_ID'] + self.loci.columns
+        rows = [row for row in arcpy.da.SearchCursor(self.input_features, fields)]
+
+        self.assertEqual(genotypes.count, len(rows))
+        self.assertEqual(genotypes.ids, [row[0] for row in rows])
+        alleles = genotypes.allele_columns().tolist()
+        for (row, values) in zip(rows, alleles):
+            expected = [0 if v in (None, '') else int(v) for v in row[1:]]
+            self.assertEqual(values, expected)
+
+        # each locus is written as its alleles joined by the separator.
+        strings = genotypes.locus_strings(sep='/', missing='0')
+        self.assertEqual(len(strings[0]), self.loci.count)
+        self.assertEqual(strings[0][0], "/".join( \
+                [str(v) if v else '0' for v in alleles[0][:2]]))
+
+    def testPopulationCounts(self):
+        genotypes = genotype.genotype_matrix(self.input_features, \
+                'Individual_ID', order_by='Region', loci=self.loci)
+        counts = genotypes.population_counts()
+
+        self.assertEqual(sum(counts.values()), genotypes.count)
+        self.assertEqual(counts.keys(), sorted(counts.keys()))
+
+    def testInvalidCallsMissing(self):
+        (codes, invalid) = genotype.allele_codes( \
+                [180, None, u'', u'18O', 70000, 182.0, -5, u'204'])
+        self.assertEqual(codes.tolist(), [180, 0, 0, 0, 70000, 182, 0, 204])
+        self.assertEqual(invalid, [3, 6])
+
+    def testCached(self):
+        first = genotype.genotype_matrix(self.input_features, 'Individual_ID')
+        second = genotype.genotype_matrix(self.input_features, 'Individual_ID')
+        self.assertTrue(first is second)
+
 # import tests
 #
 
@@ -228,6 +657,150 @@ class TestClassifiedImport(unittest.TestCase):
         for column in input_columns:
             self.assertTrue(column in output_columns)
 
+    def testClassifiedImportEngines(self, method=ClassifiedImport):
+        # the bulk NumPy import should match the table based import.
+        outputs = {}
+        for engine in ('numpy', 'table'):
+            output_fc = "{0}_{1}".format(self.output_fc, engine)
+            method.main(input_table=consts.test_csv_doc,
+                    sr=None, output_loc=fgdb.dir_path,
+                    output_gdb=fgdb.name, output_fc=output_fc,
+                    genetic=consts.genetic_columns,
+                    identification=consts.id_columns, location=consts.loc_columns,
+                    other=consts.other_columns, mode='script', engine=engine)
+            fields = [(f.name, f.type) for f in arcpy.ListFields(output_fc)]
+            names = ['SHAPE@XY'] + [name for (name, field_type) in fields \
+                    if field_type not in ('OID', 'Geometry')]
+            with arcpy.da.SearchCursor(output_fc, names) as cursor:
+                outputs[engine] = (fields, [row for row in cursor])
+
+        self.assertEqual(outputs['numpy'][0], outputs['table'][0])
+        self.assertEqual(outputs['numpy'][1], outputs['table'][1])
+
+    def testClassifiedImportUnchanged(self, method=ClassifiedImport):
+        # importing the same file the same way again leaves the output as is.
+        kwargs = dict(input_table=consts.test_csv_doc,
+                sr=None, output_loc=fgdb.dir_path,
+                output_gdb=fgdb.name, output_fc=self.output_fc,
+                genetic=consts.genetic_columns,
+                identification=consts.id_columns, location=consts.loc_columns,
+                other=consts.other_columns, mode='script')
+        method.main(**kwargs)
+        record = import_record.read_record(self.output_fc)
+        self.assertEqual(record[1], 17)
+        modified = script_utils.dataset_signature(self.output_fc)
+
+        method.main(**kwargs)
+        self.assertEqual(script_utils.dataset_signature(self.output_fc), modified)
+
+        # a different classification imports the file again.
+        kwargs['other'] = ''
+        method.main(**kwargs)
+        self.assertNotEqual(import_record.read_record(self.output_fc)[0], record[0])
+
+    def testClassifiedImportAppend(self, method=ClassifiedImport):
+        # appending writes only the new and changed rows.
+        kwargs = dict(input_table=consts.test_csv_doc,
+                sr=None, output_loc=fgdb.dir_path,
+                output_gdb=fgdb.name, output_fc=self.output_fc,
+                genetic=consts.genetic_columns,
+                identification=consts.id_columns, location=consts.loc_columns,
+                other=consts.other_columns, mode='script')
+        method.main(**kwargs)
+
+        with open(consts.test_csv_doc, 'rb') as f:
+            rows = [row for row in csv.reader(f)]
+        region = rows[0].index('Region')
+        rows[1][region] = 'Changed Region'
+        added = list(rows[2])
+        added[rows[0].index('Sample_ID')] = '9999'
+        rows.append(added)
+        appended_csv = os.path.join(fgdb.dir_path, 'SRGD_appended.csv')
+        with open(appended_csv, 'wb') as f:
+            csv.writer(f).writerows(rows)
+
+        kwargs.update(input_table=appended_csv, append=True)
+        method.main(**kwargs)
+        with arcpy.da.SearchCursor(self.output_fc, ['Sample_ID', 'Region']) as cursor:
+            regions = dict((row[0], row[1]) for row in cursor)
+        self.assertEqual(len(regions), len(rows) - 1)
+        self.assertEqual(regions[int(rows[1][0])], 'Changed Region')
+        self.assertTrue(9999 in regions)
+        os.remove(appended_csv)
+
+    def testClassifiedImportAppendLongerText(self, method=ClassifiedImport):
+        # text fields aren't sized to the values of the first import.
+        kwargs = dict(input_table=consts.test_csv_doc,
+                sr=None, output_loc=fgdb.dir_path,
+                output_gdb=fgdb.name, output_fc=self.output_fc,
+                genetic=consts.genetic_columns,
+                identification=consts.id_columns, location=consts.loc_columns,
+                other=consts.other_columns, mode='script')
+        method.main(**kwargs)
+
+        with open(consts.test_csv_doc, 'rb') as f:
+            rows = [row for row in csv.reader(f)]
+        region = 'A much longer region name than any in the example ' * 4
+        rows[1][rows[0].index('Region')] = region
+        appended_csv = os.path.join(fgdb.dir_path, 'SRGD_longer.csv')
+        with open(appended_csv, 'wb') as f:
+            csv.writer(f).writerows(rows)
+
+        kwargs.update(input_table=appended_csv, append=True)
+        method.main(**kwargs)
+        where = '"Sample_ID" = {0}'.format(rows[1][0])
+        with arcpy.da.SearchCursor(self.output_fc, ['Region'], where) as cursor:
+            self.assertEqual(cursor.next()[0], region)
+        os.remove(appended_csv)
+
+    def mergeParts(self):
+        """ Split the example into two files with different loci."""
+        with open(consts.test_csv_doc, 'rb') as f:
+            rows = [row for row in csv.reader(f)]
+        parts = {'lab_a.csv': [row[:14] for row in rows[:10]],
+                'lab_b.csv': [rows[0]] + rows[8:]}
+        paths = []
+        for (name, part) in sorted(parts.items()):
+            paths.append(os.path.join(fgdb.dir_path, name))
+            with open(paths[-1], 'wb') as f:
+                csv.writer(f).writerows(part)
+        return paths
+
+    def checkMerged(self, input_table, paths, method=ClassifiedImport):
+        method.main(input_table=input_table,
+                sr=None, output_loc=fgdb.dir_path,
+                output_gdb=fgdb.name, output_fc=self.output_fc,
+                genetic=consts.genetic_columns,
+                identification=consts.id_columns, location=consts.loc_columns,
+                other=consts.other_columns, mode='script')
+        fields = ['Sample_ID', 'L_rw4_10_1', 'Source_File']
+        with arcpy.da.SearchCursor(self.output_fc, fields) as cursor:
+            merged = [row for row in cursor]
+        self.assertEqual(len(merged), 19)
+        self.assertEqual(merged[0][1:], (0, 'lab_a.csv'))
+        self.assertEqual(merged[-1][2], 'lab_b.csv')
+
+        conflicts = os.path.join(fgdb.path, \
+                "test_classified_import_spatial_IdConflicts")
+        with arcpy.da.SearchCursor(conflicts, ['id_field', 'id_value']) as cursor:
+            self.assertTrue(('Sample_ID', '9') in [row for row in cursor])
+
+        # the record covers every merged file.
+        signature = import_record.read_record(self.output_fc)[0]
+        self.assertTrue(signature is not None)
+        for path in paths:
+            os.remove(path)
+
+    def testClassifiedImportMerge(self):
+        # files with different loci are merged, filling missing alleles.
+        paths = self.mergeParts()
+        self.checkMerged(os.path.join(fgdb.dir_path, 'lab_*.csv'), paths)
+
+    def testClassifiedImportMergeList(self):
+        # files may also be given as a semicolon separated string.
+        paths = self.mergeParts()
+        self.checkMerged(";".join(paths), paths)
+
     def testToolboxImport(self):
         self.toolbox = arcpy.ImportToolbox(consts.pyt_file)
         self.assertTrue('ClassifiedImport' in vars(self.toolbox))
@@ -280,6 +853,25 @@ class TestClassifiedImportFullDataset(unittest.TestCase):
             self.assertEqual(oid, 1316)
             self.assertEqual(hap_ev1, 123)
 
+    def testClassifiedImportCompressed(self, method=ClassifiedImport):
+        # read the gzipped file directly, without decompressing it to disk.
+        self.assertEqual(script_utils.file_type(consts.test_csv_full), 'Text')
+        method.main(input_table=consts.test_csv_full,
+                sr=None, output_loc=fgdb.dir_path,
+                output_gdb=fgdb.name, output_fc=self.output_fc,
+                genetic=consts.genetic_columns,
+                identification=consts.id_columns, location=consts.loc_columns,
+                other=consts.other_columns, mode='script')
+
+        fields = ("Sample_ID", "Occurrence_ID", 'L_Ev1_1')
+        where = '"Sample_ID" = 564'
+        with arcpy.da.SearchCursor(self.output_fc, fields, where) as cursor:
+            (sample_id, occurence_id, hap_ev1) = cursor.next()
+
+            self.assertEqual(occurence_id, 'CRC:Fri Jan 23 00:00:00 EST 2004:DT1:1')
+            self.assertEqual(hap_ev1, 123)
+        self.assertEqual(int(arcpy.GetCount_management(self.output_fc).getOutput(0)), 1318)
+
     def testToolboxImport(self):
         self.toolbox = arcpy.ImportToolbox(consts.pyt_file)
         self.assertTrue('ClassifiedImport' in vars(self.toolbox))
@@ -437,6 +1029,89 @@ class TestDistanceMatrix(unittest.TestCase):
         # all the actual assertions happen within the comparison function
         self.compareDistances(ref_dists, self.output_dists, True)
 
+    def testDistanceMatrixRunNumpy(self, method=DistanceMatrix):
+        parameters = {
+            'input_fc': self.input_fc,
+            'dist_unit': 'Kilometers',
+            'matrix_type': 'spagedi',
+            'engine': 'numpy',
+            'output_matrix': self.output_dists
+        }
+
+        method.main(mode='script', **parameters)
+
+        ref_dists = self.geographiclibDistances(self.input_fc)
+        self.compareDistances(ref_dists, self.output_dists, True)
+
+    def testDistanceMatrixRunCondensed(self, method=DistanceMatrix):
+        output_npy = "{}.npy".format(self.output_dists)
+        parameters = {
+            'input_fc': self.input_fc,
+            'dist_unit': 'Kilometers',
+            'matrix_type': 'condensed',
+            'output_matrix': output_npy
+        }
+
+        method.main(mode='script', **parameters)
+
+        ref_dists = self.geographiclibDistances(self.input_fc)
+        matrix = matrix_store.load_condensed(output_npy)
+        for (from_fid, dists) in ref_dists.items():
+            for (to_fid, dist) in dists.items():
+                self.assertAlmostEqual(matrix.distance(from_fid, to_fid),
+                        dist, 3)
+
+        del matrix
+        for path in (output_npy, matrix_store.oid_index_path(output_npy)):
+            os.remove(path)
+
+    def testDistanceMatrixRunPopulations(self, method=DistanceMatrix):
+        parameters = {
+            'input_fc': self.input_fc,
+            'dist_unit': 'Kilometers',
+            'matrix_type': 'Square',
+            'order_by': 'Region',
+            'output_matrix': self.output_dists
+        }
+
+        method.main(mode='script', **parameters)
+
+        with arcpy.da.SearchCursor(self.input_fc, ['Region']) as cursor:
+            regions = sorted(set(str(row[0]).replace(" ", "_")
+                    for row in cursor if row[0] is not None))
+        with open(self.output_dists, 'rU') as outfile:
+            rows = [line.strip().split(',') for line in outfile]
+        self.assertEqual(rows[0][1:], regions)
+        self.assertEqual(len(rows), len(regions) + 1)
+        for (i, row) in enumerate(rows[1:]):
+            self.assertEqual(row[0], regions[i])
+            self.assertEqual(float(row[i + 1]), 0)
+
+    def testDistanceMatrixRunSparse(self, method=DistanceMatrix):
+        output_npz = "{}.npz".format(self.output_dists)
+        max_distance = 300
+        parameters = {
+            'input_fc': self.input_fc,
+            'dist_unit': 'Kilometers',
+            'matrix_type': 'sparse',
+            'max_distance': max_distance,
+            'output_matrix': output_npz
+        }
+
+        method.main(mode='script', **parameters)
+
+        ref_dists = self.geographiclibDistances(self.input_fc)
+        (oids, rows, cols, data) = matrix_store.load_sparse(output_npz)
+        pairs = set()
+        for (i, j, dist) in zip(oids[rows], oids[cols], data):
+            self.assertAlmostEqual(ref_dists[i][j], dist, 3)
+            pairs.add((i, j))
+        for (from_fid, dists) in ref_dists.items():
+            for (to_fid, dist) in dists.items():
+                if from_fid < to_fid and dist <= max_distance:
+                    self.assertTrue((from_fid, to_fid) in pairs)
+        os.remove(output_npz)
+
     def testToolboxImport(self):
         self.toolbox = arcpy.ImportToolbox(consts.pyt_file)
         self.assertTrue('DistanceMatrix' in vars(self.toolbox))
@@ -446,6 +1121,290 @@ class TestDistanceMatrix(unittest.TestCase):
             # clean up from any past runs
             arcpy.Delete_management(self.output_dists)
 
+class TestGeodesy(unittest.TestCase):
+    """ Test the vectorized geodesic kernel against geographiclib."""
+
+    def testReferencePair(self):
+        # the reference pair quoted for the high-performance DLL.
+        dist = geodesy.inverse(8.6583, -83.7453, 11.0253, -85.9176)
+        self.assertAlmostEqual(float(dist), 353995.597, 3)
+
+    def testDistanceBlock(self):
+        lats = [11.0253, 13.7851, 8.708, -45.0, 0.0, 0.5]
+        lons = [-85.9176, -90.2733, -83.7341, 170.0, 0.0, 179.7]
+        block = geodesy.distance_block(lats, lons, 0, len(lats))
+        for i in range(len(lats)):
+            self.assertEqual(block[i][i], 0)
+            for j in range(len(lats)):
+                ref = Geodesic.WGS84.Inverse(
+                    lats[i], lons[i], lats[j], lons[j])['s12']
+                self.assertAlmostEqual(block[i][j], ref, 3)
+
+    def testUniqueLocations(self):
+        lats = [11.0, 12.0, 11.0, 11.0, 12.0]
+        lons = [-85.0, -90.0, -85.0, -86.0, -90.0]
+        (unique_lats, unique_lons, inverse) = \
+                geodesy.unique_locations(lats, lons)
+        self.assertEqual(len(unique_lats), 3)
+        for (i, location) in enumerate(inverse):
+            self.assertEqual(unique_lats[location], lats[i])
+            self.assertEqual(unique_lons[location], lons[i])
+
+    def testGreatCirclePaths(self):
+        (lats, lons, counts) = geodesy.great_circle_paths(
+                [8.6583, 10.0], [-83.7453, 170.0],
+                [11.0253, 20.0], [-85.9176, -170.0])
+        self.assertEqual(sum(counts), len(lats))
+        first = counts[0]
+        # the vertices lie on the path between the end points.
+        total = geodesy.inverse(lats[:first - 1], lons[:first - 1],
+                lats[1:first], lons[1:first]).sum()
+        self.assertAlmostEqual(total, 353995.5973, 0)
+        # crossing the antimeridian, longitudes continue past 180.
+        self.assertEqual(lons[first], 170.0)
+        self.assertAlmostEqual(lons[-1], 190.0)
+        east = lons[first:]
+        self.assertTrue(all(a < b for (a, b) in zip(east[:-1], east[1:])))
+
+    def testGroupCentroids(self):
+        (labels, lats, lons, counts) = geodesy.group_centroids(
+                [10.0, 10.0, 0.0, -5.0], [179.0, -179.0, 0.0, 7.0],
+                ['b', 'b', 'a', 'c'])
+        self.assertEqual(list(labels), ['a', 'b', 'c'])
+        self.assertEqual(list(counts), [1, 2, 1])
+        self.assertAlmostEqual(lats[2], -5.0)
+        self.assertAlmostEqual(lons[2], 7.0)
+        # the centroid of points either side of the antimeridian is on it.
+        self.assertAlmostEqual(abs(lons[1]), 180.0)
+
+class TestMatrixStore(unittest.TestCase):
+    """ Test the tiled, memory-mapped distance matrix store."""
+
+    def setUp(self):
+        self.d = TempDir()
+        self.lats = [11.0253, 13.7851, 8.708, 8.8413, 35.1, 11.0245, 10.983]
+        self.lons = [-85.9176, -90.2733, -83.7341, -83.6498, -120.857,
+                -85.81, -85.8768]
+
+    def testTiledFill(self):
+        count = len(self.lats)
+        store = matrix_store.MatrixStore.temporary(self.d.name, count)
+        # a tile size which doesn't divide the matrix evenly
+        store.fill(self.lats, self.lons, tile_size=3)
+        self.assertEqual(matrix_store.tile_count(count, 3), 6)
+
+        block = geodesy.distance_block(self.lats, self.lons, 0, count)
+        for (i, row) in enumerate(store.rows()):
+            for j in range(count):
+                self.assertAlmostEqual(row[j], block[i][j], 6)
+                self.assertEqual(row[j], store.matrix[j][i])
+
+        path = store.path
+        store.close(delete=True)
+        self.assertFalse(os.path.exists(path))
+
+    def testEmptyStore(self):
+        # an empty input has no distances, but still an (empty) matrix.
+        store = matrix_store.MatrixStore.temporary(self.d.name, 0)
+        store.fill([], [])
+        self.assertEqual(store.matrix.shape, (0, 0))
+        self.assertEqual(list(store.rows()), [])
+        path = store.path
+        store.close(delete=True)
+        self.assertFalse(os.path.exists(path))
+
+    def testParallelFillMatchesSerial(self):
+        count = len(self.lats)
+        serial = matrix_store.MatrixStore.temporary(self.d.name, count)
+        serial.fill(self.lats, self.lons, tile_size=2)
+        parallel = matrix_store.MatrixStore.temporary(self.d.name, count)
+        parallel.fill(self.lats, self.lons, tile_size=2, workers=2)
+
+        for (a, b) in zip(serial.rows(), parallel.rows()):
+            self.assertEqual(list(a), list(b))
+        serial.close(delete=True)
+        parallel.close(delete=True)
+
+    def testCondensedExpand(self):
+        # repeat each location, and expand distances between locations
+        # back out to every point.
+        lats = self.lats * 2
+        lons = self.lons * 2
+        (unique_lats, unique_lons, inverse) = \
+                geodesy.unique_locations(lats, lons)
+        store = matrix_store.MatrixStore.temporary(self.d.name,
+                len(unique_lats))
+        store.fill(unique_lats, unique_lons)
+
+        path = os.path.join(self.d.name, 'expanded.npy')
+        output = matrix_store.CondensedStore(path, range(len(lats)))
+        output.expand(store, inverse)
+        output.close()
+        store.close(delete=True)
+
+        block = geodesy.distance_block(lats, lons, 0, len(lats))
+        matrix = matrix_store.load_condensed(path)
+        for (i, row) in enumerate(matrix.rows()):
+            for j in range(len(lats)):
+                self.assertAlmostEqual(row[j], block[i][j], 6)
+
+    def testCondensedExpandFromCondensed(self):
+        # distances between locations can be kept condensed as well.
+        lats = self.lats * 2
+        lons = self.lons * 2
+        (unique_lats, unique_lons, inverse) = \
+                geodesy.unique_locations(lats, lons)
+        store = matrix_store.CondensedStore.temporary(self.d.name,
+                len(unique_lats))
+        store.fill(unique_lats, unique_lons, tile_size=3)
+
+        path = os.path.join(self.d.name, 'expanded.npy')
+        output = matrix_store.CondensedStore(path, range(len(lats)))
+        output.expand(store, inverse)
+        output.close()
+        store_path = store.path
+        store.close(delete=True)
+        self.assertFalse(os.path.exists(store_path))
+        self.assertFalse(os.path.exists(
+                matrix_store.oid_index_path(store_path)))
+
+        block = geodesy.distance_block(lats, lons, 0, len(lats))
+        matrix = matrix_store.load_condensed(path)
+        for (i, row) in enumerate(matrix.rows()):
+            for j in range(len(lats)):
+                self.assertAlmostEqual(row[j], block[i][j], 6)
+
+    def testCondensedRoundTrip(self):
+        count = len(self.lats)
+        oids = range(1, count + 1)
+        path = os.path.join(self.d.name, 'condensed.npy')
+        store = matrix_store.CondensedStore(path, oids)
+        store.fill(self.lats, self.lons, tile_size=3)
+        store.close()
+        self.assertTrue(os.path.exists(matrix_store.oid_index_path(path)))
+
+        matrix = matrix_store.load_condensed(path)
+        self.assertEqual(len(matrix.data), count * (count - 1) / 2)
+        self.assertEqual(list(matrix.oids), oids)
+
+        block = geodesy.distance_block(self.lats, self.lons, 0, count)
+        for (i, row) in enumerate(matrix.rows()):
+            for j in range(count):
+                self.assertAlmostEqual(row[j], block[i][j], 6)
+                self.assertAlmostEqual(matrix.distance(i + 1, j + 1),
+                        block[i][j], 6)
+
+    def testSparseRoundTrip(self):
+        path = os.path.join(self.d.name, 'sparse.npz')
+        oids = [10, 20, 30, 40]
+        (rows, cols, data) = ([0, 1, 2], [2, 3, 3], [1.5, 2.5, 3.5])
+        matrix_store.save_sparse(path, oids, rows, cols, data)
+        loaded = matrix_store.load_sparse(path)
+        for (values, expected) in zip(loaded, (oids, rows, cols, data)):
+            self.assertEqual(list(values), expected)
+
+class TestMatrixWriter(unittest.TestCase):
+    """ Test streaming matrix output, plain and compressed."""
+
+    def setUp(self):
+        self.d = TempDir()
+
+    def testSpagediLayout(self):
+        expected = "M2\ta\tb\na\t0.0\t1.5\nb\t1.5\t0.0\nEND\n"
+        for name in ('matrix.txt', 'matrix.txt.gz'):
+            path = os.path.join(self.d.name, name)
+            with matrix_writer.MatrixWriter(path, ['a', 'b'], True) as writer:
+                writer.write_row('a', [0.0, 1.5])
+                writer.write_row('b', [1.5, 0.0])
+            if matrix_writer.is_compressed(path):
+                output = gzip.open(path, 'rb')
+            else:
+                output = open(path, 'r')
+            self.assertEqual(output.read(), expected)
+            output.close()
+
+class TestSpatialIndex(unittest.TestCase):
+    """ Test nearest neighbor and radius queries against brute force."""
+
+    def setUp(self):
+        self.lats = [11.0253, 13.7851, 8.708, 8.8413, 35.1, 11.0245, 10.983,
+                8.6583, 41.4106, 18.7063, -33.9, 64.1]
+        self.lons = [-85.9176, -90.2733, -83.7341, -83.6498, -120.857,
+                -85.81, -85.8768, -83.7453, -124.52, -110.9646, 151.2, -21.9]
+        self.dists = geodesy.distance_block(self.lats, self.lons,
+                0, len(self.lats))
+
+    def testPureKDTree(self):
+        vectors = spatial_index.unit_vectors(self.lats, self.lons)
+        tree = spatial_index.KDTree(vectors, leafsize=2)
+        for (i, x) in enumerate(vectors):
+            (chords, positions) = tree.query(x, 3)
+            brute = sorted(((((vectors - x) ** 2).sum(axis=1)) ** 0.5))[:3]
+            for (chord, ref) in zip(chords, brute):
+                self.assertAlmostEqual(chord, ref)
+            self.assertEqual(positions[0], i)
+
+    def testNearest(self):
+        index = spatial_index.SphericalIndex(self.lats, self.lons)
+        for i in range(len(self.lats)):
+            (positions, dists) = index.nearest(self.lats[i], self.lons[i],
+                    3, exclude=i)
+            others = sorted((d, j) for (j, d) in enumerate(self.dists[i])
+                    if j != i)
+            self.assertEqual(list(positions), [j for (d, j) in others[:3]])
+
+    def testWithin(self):
+        index = spatial_index.SphericalIndex(self.lats, self.lons)
+        radius = 500000
+        for i in range(len(self.lats)):
+            (positions, dists) = index.within(self.lats[i], self.lons[i],
+                    radius)
+            expected = [j for (j, d) in enumerate(self.dists[i])
+                    if d <= radius]
+            self.assertEqual(sorted(positions), expected)
+            self.assertTrue(all(dists <= radius))
+
+    def testPairsWithin(self):
+        index = spatial_index.SphericalIndex(self.lats, self.lons)
+        for radius in (1, 300000, 3000000, 25000000):
+            (rows, cols, dists) = index.pairs_within(radius)
+            expected = [(i, j) for i in range(len(self.lats))
+                    for j in range(i + 1, len(self.lats))
+                    if self.dists[i][j] <= radius]
+            self.assertEqual(list(zip(rows, cols)), expected)
+            for (i, j, dist) in zip(rows, cols, dists):
+                self.assertAlmostEqual(dist, self.dists[i][j], 6)
+
+class TestCostDistance(unittest.TestCase):
+    """ Test least-cost distances around a barrier on a small grid."""
+
+    def setUp(self):
+        # a 5 x 5 grid of one degree cells, with a wall of NoData cells
+        # down the middle column, open only at the bottom row.
+        nan = float('nan')
+        self.cost = [[1, 1, nan, 1, 1] for i in range(4)] + [[1] * 5]
+        self.surface = cost_distance.CostSurface(self.cost, 0, 5, 1, 1)
+
+    def testDetour(self):
+        (nodes, moved) = self.surface.locate([0.5, 4.5], [4.5, 4.5])
+        self.assertFalse(moved.any())
+        results = list(cost_distance.search_rows(self.surface, nodes, nodes,
+                [nodes, nodes]))
+        (position, row, paths) = results[0]
+        (xs, ys) = self.surface.centers(paths[1])
+        # the path runs around the bottom of the wall.
+        self.assertEqual(min(ys), 0.5)
+        steps = geodesy.inverse(ys[:-1], xs[:-1], ys[1:], xs[1:])
+        self.assertAlmostEqual(row[1], steps.sum(), 3)
+        self.assertTrue(row[1] > geodesy.inverse(4.5, 0.5, 4.5, 4.5))
+
+    def testLocateMovesOffBarrier(self):
+        (nodes, moved) = self.surface.locate([2.5, 1.5], [4.5, 4.5])
+        self.assertEqual(list(moved), [True, False])
+        (xs, ys) = self.surface.centers(nodes)
+        self.assertEqual(ys[0], 4.5)
+        self.assertTrue(xs[0] in (1.5, 3.5))
+
 class TestShortestDistancePaths(unittest.TestCase):
     """ Test the shortest distance path script works, with
         a shapefile output."""
@@ -454,6 +1413,7 @@ class TestShortestDistancePaths(unittest.TestCase):
         self.input_fc = fgdb.input_fc_mem
         self.output_fc = os.path.join(fgdb.dir_path, 'Test_ShortestDistancePaths')
         self.shape_fn = "{}.shp".format(self.output_fc)
+        self.gdb_fc = os.path.join(fgdb.path, 'Test_ShortestDistancePaths')
 
     def testShortestDistancePathsAvailable(self, method=ShortestDistancePaths):
         self.assertTrue('main' in vars(method))
@@ -480,6 +1440,38 @@ class TestShortestDistancePaths(unittest.TestCase):
             self.assertEqual(dest_id, 8.0)
             self.assertAlmostEqual(dist_m, 3173.9605395)
 
+    def testShortestDistancePathsNearest(self, method=ShortestDistancePaths):
+        parameters = {
+            'input_fc': self.input_fc,
+            'output_fc': self.output_fc,
+            'k_nearest': 2
+        }
+        method.main(mode='script', **parameters)
+
+        row_count = int(arcpy.GetCount_management(self.shape_fn).getOutput(0))
+        input_count = int(arcpy.GetCount_management(self.input_fc).getOutput(0))
+        self.assertEqual(row_count, input_count * 2)
+
+    def checkDistances(self, output_fc, distance_field):
+        fields = ('ID', 'Source_ID', 'Dest_ID', distance_field)
+        with arcpy.da.SearchCursor(output_fc, fields, '"ID" = 272') as cursor:
+            (fid, source_id, dest_id, dist_m) = cursor.next()
+            self.assertEqual(source_id, 17.0)
+            self.assertEqual(dest_id, 8.0)
+            self.assertAlmostEqual(dist_m, 3173.9605395)
+
+    def testShortestDistancePathsShapefile(self, method=ShortestDistancePaths):
+        # field names are truncated to 10 characters in a shapefile.
+        method.main(mode='script', input_fc=self.input_fc,
+                output_fc=self.shape_fn)
+        self.checkDistances(self.shape_fn, 'Distance_i')
+
+    def testShortestDistancePathsGeodatabase(self, method=ShortestDistancePaths):
+        method.main(mode='script', input_fc=self.input_fc,
+                output_fc=self.gdb_fc)
+        self.assertTrue(arcpy.Exists(self.gdb_fc))
+        self.checkDistances(self.gdb_fc, 'Distance_in_km')
+
     def testToolboxImport(self):
         self.toolbox = arcpy.ImportToolbox(consts.pyt_file)
         self.assertTrue('ShortestDistancePaths' in vars(self.toolbox))
@@ -487,6 +1479,8 @@ class TestShortestDistancePaths(unittest.TestCase):
     def tearDown(self):
         if os.path.exists(self.shape_fn):
             arcpy.Delete_management(self.shape_fn)
+        if arcpy.Exists(self.gdb_fc):
+            arcpy.Delete_management(self.gdb_fc)
 
 class TestIndividualPaths(unittest.TestCase):
     """Individual paths -- make a set of paths for selected individuals."""